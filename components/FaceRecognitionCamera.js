@@ -12,7 +12,8 @@ export function FaceRecognitionCamera({ onRecognitionComplete, onRecognitionFail
   const [status, setStatus] = useState(null);
   const [isStreaming, setIsStreaming] = useState(false); // New state to manage streaming
   const cameraRef = useRef(null); // Ref for the camera component
-  const captureIntervalRef = useRef(null); // Ref for the interval to clear it
+  const streamingRef = useRef(false); // Read by socket callbacks, which outlive renders
+  const retryTimeoutRef = useRef(null); // Pending resend after a 'server_overloaded' response
 
   // Initialize Socket.IO connection
   useEffect(() => {
@@ -26,15 +27,26 @@ export function FaceRecognitionCamera({ onRecognitionComplete, onRecognitionFail
       if (newStatus.is_signed_in && newStatus.confirmed_user) {
         onRecognitionComplete(newStatus.confirmed_user);
         stopStreaming(); // Stop streaming and socket when complete
-      } else if (newStatus.detection_count >= 5 && !newStatus.is_signed_in) {
-        // Only trigger failure if it's the final count and not signed in
-        if (!status || status.detection_count < 5) { // Prevent multiple alerts
+      } else if (newStatus.recognition_failed) {
+        // The server may decide before max_detections when the outcome is already clear
+        if (!status || !status.recognition_failed) { // Prevent multiple alerts
              onRecognitionFailed();
              stopStreaming(); // Stop streaming and socket when failed
         }
       }
     });
 
+    // Backpressure: the server grants a credit whenever it can take our next frame,
+    // so frames are captured fresh instead of queueing behind a slow recognition.
+    faceRecognitionService.socket.on('ready_for_frame', () => {
+      sendFrame();
+    });
+
+    faceRecognitionService.socket.on('server_overloaded', (info) => {
+      console.warn('Server overloaded, retrying frame in', info.retry_after_ms, 'ms');
+      retryTimeoutRef.current = setTimeout(sendFrame, info.retry_after_ms);
+    });
+
     // Handle disconnection
     faceRecognitionService.socket.on('disconnect', () => {
       console.log('Socket disconnected from server');
@@ -55,38 +67,46 @@ export function FaceRecognitionCamera({ onRecognitionComplete, onRecognitionFail
   }, [permission]);
 
 
+  const sendFrame = async () => {
+    if (!streamingRef.current || !cameraRef.current) return;
+    try {
+      const photo = await cameraRef.current.takePictureAsync({
+        quality: 0.7, // Lower quality for streaming performance
+      });
+      // Send the JPEG bytes as a binary Socket.IO attachment rather than a base64
+      // string (a third smaller on the wire, no base64 decode on the server)
+      const response = await fetch(photo.uri);
+      const jpeg = await response.arrayBuffer();
+      if (jpeg.byteLength && streamingRef.current) {
+        // The next frame is sent on 'ready_for_frame'
+        faceRecognitionService.socket.emit('process_frame', { image: jpeg });
+      }
+    } catch (error) {
+      console.error("Error capturing frame for streaming:", error);
+      // Try again shortly rather than waiting for a credit that will not come
+      retryTimeoutRef.current = setTimeout(sendFrame, 200);
+    }
+  };
+
   const startStreaming = useCallback(async () => {
     if (cameraRef.current && !isStreaming) {
       setIsStreaming(true);
-      console.log("Starting continuous image streaming...");
+      streamingRef.current = true;
+      console.log("Starting credit-based image streaming...");
 
       // Reset backend state for a new recognition attempt
       await faceRecognitionService.resetRecognitionState();
 
-      captureIntervalRef.current = setInterval(async () => {
-        if (cameraRef.current) {
-          try {
-            const photo = await cameraRef.current.takePictureAsync({
-              quality: 0.7, // Lower quality for streaming performance
-              base64: true,
-            });
-            if (photo.base64) {
-              // Emit the image over Socket.IO
-              faceRecognitionService.socket.emit('image_stream', photo.base64);
-            }
-          } catch (error) {
-            console.error("Error capturing frame for streaming:", error);
-            // Optionally stop streaming on persistent errors
-          }
-        }
-      }, 200); // Send a frame every 200ms (5 frames/sec)
+      // The server answers with 'ready_for_frame', which sends the first frame
+      faceRecognitionService.socket.emit('start_recognition');
     }
   }, [isStreaming]);
 
   const stopStreaming = useCallback(() => {
-    if (captureIntervalRef.current) {
-      clearInterval(captureIntervalRef.current);
-      captureIntervalRef.current = null;
+    streamingRef.current = false;
+    if (retryTimeoutRef.current) {
+      clearTimeout(retryTimeoutRef.current);
+      retryTimeoutRef.current = null;
     }
     if (isStreaming) {
         setIsStreaming(false);
@@ -99,15 +119,17 @@ export function FaceRecognitionCamera({ onRecognitionComplete, onRecognitionFail
   const getStatusColor = () => {
     if (!status) return '#64748B'; // Initializing
     if (status.is_signed_in) return '#059669'; // Green
-    if (status.detection_count >= 5 && !status.is_signed_in) return '#DC2626'; // Red
+    if (status.recognition_failed) return '#DC2626'; // Red
     return '#D97706'; // Orange (Analyzing)
   };
 
   const getStatusMessage = () => {
     if (!status) return 'Initializing recognition...';
     if (status.is_signed_in) return `Welcome ${status.confirmed_user}!`;
-    if (status.detection_count >= 5 && !status.is_signed_in) return 'Recognition failed. Please try again.';
-    if (status.detection_count > 0) return `Analyzing... ${status.detection_count}/5 detections`;
+    if (status.recognition_failed) return 'Recognition failed. Please try again.';
+    // The server skipped the last face as too small, dark, blurry, ... and says how to fix it
+    if (status.quality && status.quality.hint) return status.quality.hint;
+    if (status.detection_count > 0) return `Analyzing... ${status.detection_count}/${status.max_detections} detections`;
     return 'Waiting for face detection...';
   };
 
@@ -154,14 +176,14 @@ export function FaceRecognitionCamera({ onRecognitionComplete, onRecognitionFail
               style={[
                 styles.progressFill,
                 {
-                  width: `${(status.detection_count / 5) * 100}%`,
+                  width: `${(status.detection_count / status.max_detections) * 100}%`,
                   backgroundColor: getStatusColor()
                 }
               ]}
             />
           </View>
           <Text style={styles.progressText}>
-            Detection Progress: {status.detection_count}/5
+            Detection Progress: {status.detection_count}/{status.max_detections}
           </Text>
         </View>
       )}
@@ -2,87 +2,393 @@ from flask import Flask, request, jsonify
 from flask_cors import CORS
 from flask_socketio import SocketIO, emit, join_room, leave_room
 import cv2
-import face_recognition
+import gc
 import numpy as np
 import os
 import time
 from collections import Counter
 import threading
-import base64
 import re
+import uuid
+from gallery import FaceGallery, select_templates
+from gallery_store import GalleryStore, migrate_legacy
+from face_detectors import detector_from_env
+from face_quality import QualityGate, HINTS
+from face_tracking import FaceTracker
+from frame_pipeline import FramePipeline, format_timings, UNREADABLE
+from recognition_pool import RecognitionPool, FrameStream, OVERLOADED, frame_buffer, run_enrollment_photo
+from embedding_cache import EmbeddingCache
+from session_store import SessionStore, RedisSessionStore, redis_client, EXPIRED
+from metrics import Metrics, process_memory, process_uptime
 
 app = Flask(__name__)
 # Allow CORS for HTTP requests and Socket.IO
 CORS(app, resources={r"/*": {"origins": "*"}}) # Adjust origins in production
-socketio = SocketIO(app, cors_allowed_origins="*", async_mode='threading') # Async mode for better performance with threads
+# With several server processes/nodes, point SOCKETIO_MESSAGE_QUEUE at a shared Redis
+# (e.g. redis://host:6379/0) so emit(room=sid) reaches the node holding that socket
+SOCKETIO_MESSAGE_QUEUE = os.environ.get('SOCKETIO_MESSAGE_QUEUE') or None
+# Frames are well under Socket.IO's 1 MB default, but an enrolment may carry several photos
+SOCKETIO_MAX_MESSAGE_BYTES = int(os.environ.get('SOCKETIO_MAX_MESSAGE_BYTES', str(16 * 1024 * 1024)))
+app.config['MAX_CONTENT_LENGTH'] = int(os.environ.get('MAX_UPLOAD_BYTES', str(64 * 1024 * 1024)))
+socketio = SocketIO(app, cors_allowed_origins="*", async_mode='threading', # Async mode for better performance with threads
+                    message_queue=SOCKETIO_MESSAGE_QUEUE, max_http_buffer_size=SOCKETIO_MAX_MESSAGE_BYTES)
+
+# Per-stage latency histograms and counters, served at /metrics (see metrics.py).
+# With METRICS_ENABLED=0 every recording call returns immediately.
+METRICS_ENABLED = os.environ.get('METRICS_ENABLED', '1') == '1'
+metrics = Metrics(enabled=METRICS_ENABLED)
+
+# Importing this module is cheap and starts nothing: `startup()` loads the gallery
+# and dlib's models, forks the recognition workers and starts housekeeping.
+SERVER_HOST = os.environ.get('SERVER_HOST', '0.0.0.0')
+SERVER_PORT = int(os.environ.get('SERVER_PORT', '5000'))
+FLASK_DEBUG = os.environ.get('FLASK_DEBUG', '0') == '1' # Debug pages only; the reloader stays off
+PROCESS_STARTED = time.time() - (process_uptime() or 0.0) # Wall clock time the process was started
 
 ENCODINGS_PATH = 'faces'
 os.makedirs(ENCODINGS_PATH, exist_ok=True)
+GALLERY_STORE_PATH = os.path.join(ENCODINGS_PATH, 'gallery')
+
+# Gallery index backend: 'brute' (exact scan) or 'ivf' (approximate, for large galleries).
+# GALLERY_IVF_NPROBE trades recall (higher) for latency (lower).
+GALLERY_INDEX = os.environ.get('GALLERY_INDEX', 'brute')
+GALLERY_IVF_NPROBE = int(os.environ.get('GALLERY_IVF_NPROBE', '8'))
+# How an identity's templates are scored: 'min', 'centroid' or 'medoid' (see gallery.py)
+GALLERY_AGGREGATION = os.environ.get('GALLERY_AGGREGATION', 'min')
+MAX_TEMPLATES_PER_IDENTITY = int(os.environ.get('MAX_TEMPLATES_PER_IDENTITY', '10'))
+TRAINING_FRAME_INTERVAL = 0.5 # seconds between template captures during /train_face
+ENROLL_MAX_IMAGES = int(os.environ.get('ENROLL_MAX_IMAGES', '20')) # Photos per upload enrolment
+ENROLL_JOB_TTL = 600 # seconds a finished enrolment job stays queryable
+
+# Detect-once, track-afterwards: after a face is found, later frames of the session are
+# only searched inside the last face box grown by TRACK_ROI_EXPANSION on each side.
+TRACKING_ENABLED = os.environ.get('TRACKING_ENABLED', '1') == '1'
+TRACK_ROI_EXPANSION = float(os.environ.get('TRACK_ROI_EXPANSION', '0.5'))
+TRACK_REDETECT_EVERY = int(os.environ.get('TRACK_REDETECT_EVERY', '0')) # 0 = only when the track is lost
+
+# Smallest face to detect, as a fraction of the frame's shorter side; sets the detection scale
+MIN_FACE_FRACTION = float(os.environ.get('MIN_FACE_FRACTION', '0.2'))
+# Decode large JPEG frames straight to 1/2, 1/4 or 1/8 size when detection allows it
+REDUCED_DECODE = os.environ.get('REDUCED_DECODE', '1') == '1'
+# Detector backend and its tuning come from FACE_DETECTOR, <BACKEND>_UPSAMPLE etc.
+# (see face_detectors.detector_from_env); e.g. FACE_DETECTOR=cascade screens with Haar, confirms with HOG
+face_detector = detector_from_env()
+
+# Near-duplicate frames (a user standing still) reuse the previous encoding: face crops are
+# keyed by a perceptual hash, looked up first in the session's cache (tolerating up to
+# SESSION_CACHE_MAX_DISTANCE differing hash bits), then in each worker's global cache (exact
+# hash only, as it is shared between sessions). Reused encodings also reuse their gallery
+# match while the gallery is unchanged. A cache size of 0 disables that cache.
+SESSION_CACHE_SIZE = int(os.environ.get('SESSION_CACHE_SIZE', '8'))
+SESSION_CACHE_MAX_DISTANCE = int(os.environ.get('SESSION_CACHE_MAX_DISTANCE', '12')) # of 256 bits
+GLOBAL_CACHE_SIZE = int(os.environ.get('GLOBAL_CACHE_SIZE', '256'))
+EMBEDDING_CACHE_TTL = float(os.environ.get('EMBEDDING_CACHE_TTL', '10')) # seconds
+
+# Quality gate before encoding (see face_quality.py): faces smaller than QUALITY_MIN_FACE
+# pixels, with mean brightness outside QUALITY_MIN/MAX_BRIGHTNESS, a Laplacian variance
+# below QUALITY_MIN_SHARPNESS or turned more than QUALITY_MAX_YAW degrees are not encoded
+# and cast no vote; the client gets the reason in recognition_status to coach the user.
+# A threshold of 0 switches that check off, QUALITY_GATE=0 the whole gate.
+QUALITY_GATE = os.environ.get('QUALITY_GATE', '1') == '1'
+quality_gate = QualityGate(
+    min_face=int(os.environ.get('QUALITY_MIN_FACE', '64')),
+    min_brightness=float(os.environ.get('QUALITY_MIN_BRIGHTNESS', '50')),
+    max_brightness=float(os.environ.get('QUALITY_MAX_BRIGHTNESS', '205')),
+    min_sharpness=float(os.environ.get('QUALITY_MIN_SHARPNESS', '40')),
+    max_yaw=float(os.environ.get('QUALITY_MAX_YAW', '35')) or None,
+) if QUALITY_GATE else None
+
+frame_pipeline = FramePipeline(min_face_fraction=MIN_FACE_FRACTION, detect=face_detector,
+                               cache_size=GLOBAL_CACHE_SIZE, cache_ttl=EMBEDDING_CACHE_TTL,
+                               quality_gate=quality_gate)
+
+# Frames are decoded, detected and encoded in a fixed-size process pool, never on the
+# Socket.IO handler thread. At most RECOGNITION_MAX_PENDING frames (one per session) are
+# in flight; beyond that clients get an explicit 'server_overloaded' response. A frame
+# arriving while its session is busy replaces that session's older waiting frame, and
+# clients are sent 'ready_for_frame' whenever the server can take their next one.
+RECOGNITION_WORKERS = int(os.environ.get('RECOGNITION_WORKERS', str(os.cpu_count() or 1)))
+RECOGNITION_MAX_PENDING = int(os.environ.get('RECOGNITION_MAX_PENDING', str(max(1, RECOGNITION_WORKERS) * 2)))
+OVERLOAD_RETRY_AFTER_MS = 500
+# Micro-batching: frames from different sessions dispatched within RECOGNITION_BATCH_WAIT_MS
+# share one worker task (one dlib encoding batch) and one gallery match. Off by default
+# (batch size 1): on CPU-only dlib it trades per-frame latency for throughput.
+RECOGNITION_BATCH_SIZE = int(os.environ.get('RECOGNITION_BATCH_SIZE', '1'))
+RECOGNITION_BATCH_WAIT_MS = float(os.environ.get('RECOGNITION_BATCH_WAIT_MS', '5'))
+
+# Per wire format ('binary' attachments vs legacy 'base64' strings): bytes received and
+# time spent unwrapping and decoding, to measure what the binary transport saves.
+frame_transport_stats = {}
+frame_transport_lock = threading.Lock()
+
+def record_frame_transport(transport):
+    with frame_transport_lock:
+        stats = frame_transport_stats.setdefault(transport["format"], {
+            "frames": 0, "reduced_frames": 0, "wire_bytes": 0, "jpeg_bytes": 0,
+            "b64_decode_ms": 0.0, "image_decode_ms": 0.0,
+        })
+        stats["frames"] += 1
+        if transport["reduction"] > 1:
+            stats["reduced_frames"] += 1
+        for key in ("wire_bytes", "jpeg_bytes", "b64_decode_ms", "image_decode_ms"):
+            stats[key] += transport[key]
+    metrics.observe('b64_decode', transport["b64_decode_ms"])
+    metrics.observe('image_decode', transport["image_decode_ms"])
+
+def record_frame_metrics(result, state, was_complete, received=None):
+    """Stage timings and outcome counters for one processed frame."""
+    if not metrics.enabled:
+        return
+    if "error" in result:
+        metrics.inc('frames', outcome='error', help="Frames processed, by outcome.")
+    else:
+        # The pipeline's own 'total' is worker time; 'server' below is receipt to reply
+        metrics.observe_timings({('pipeline' if stage == 'total' else stage): ms
+                                 for stage, ms in result["timings"].items()})
+        quality = result.get("quality")
+        if result["encodings"]:
+            outcome = 'face'
+        else:
+            outcome = 'low_quality' if quality and quality["reason"] else 'no_face'
+        metrics.inc('frames', outcome=outcome, help="Frames processed, by outcome.")
+        if quality is not None:
+            metrics.inc('quality_checks', outcome='rejected' if quality["reason"] else 'accepted',
+                        reason=quality["reason"] or 'ok', help="Faces checked by the quality gate, by outcome.")
+    if received is not None:
+        metrics.observe('server', (time.perf_counter() - received) * 1000.0)
+    if state is not None and not was_complete:
+        if state.is_signed_in:
+            metrics.inc('sign_ins', help="Sessions that confirmed a user.")
+        elif state.recognition_failed:
+            metrics.inc('recognition_failures', help="Attempts that ended unknown, inconclusive or without a face.")
+
+# Gallery matches of cached encodings, keyed by (face hash, gallery version)
+match_cache = EmbeddingCache(GLOBAL_CACHE_SIZE, EMBEDDING_CACHE_TTL) if GLOBAL_CACHE_SIZE > 0 else None
+embedding_cache_outcomes = Counter() # 'session' / 'global' hits and misses, over all frames
+embedding_cache_lock = threading.Lock()
+
+def record_cache_outcome(result):
+    if "cache" in result:
+        with embedding_cache_lock:
+            embedding_cache_outcomes[result["cache"]] += 1
+
+def match_results(results):
+    """
+    Matches the first face of every frame in a batch against the gallery in one
+    computation; faces whose encoding came from the embedding cache reuse the
+    cached match when the gallery has not changed since.
+    """
+    snapshot = gallery.snapshot()
+    pending = []
+    for result in results:
+        if not result.get("encodings"):
+            continue
+        key = (result["face_keys"][0], snapshot.version) if result.get("face_keys") else None
+        if match_cache is not None and key is not None and result.get("cache") in ('session', 'global'):
+            result["match"] = match_cache.get(key)
+            if result["match"] is not None:
+                continue
+        pending.append((result, key))
+    if not pending:
+        return
+    with metrics.timer('match'):
+        matches = snapshot.match_batch([result["encodings"][0] for result, _ in pending], tolerance=MATCH_TOLERANCE)
+    for (result, key), match in zip(pending, matches):
+        result["match"] = match
+        if match_cache is not None and key is not None:
+            match_cache.put(key, match)
+
+recognition_pool = RecognitionPool(
+    RECOGNITION_WORKERS, RECOGNITION_MAX_PENDING,
+    {
+        'min_face_fraction': MIN_FACE_FRACTION, 'reduced_decode': REDUCED_DECODE, 'detect': face_detector,
+        'cache_size': GLOBAL_CACHE_SIZE, 'cache_ttl': EMBEDDING_CACHE_TTL, 'quality_gate': quality_gate,
+    },
+    batch_size=RECOGNITION_BATCH_SIZE, batch_wait_ms=RECOGNITION_BATCH_WAIT_MS,
+    on_batch=match_results,
+)
 
 # --- Face Recognition State Management (modified for Socket.IO and per-session) ---
-# For a production app, you would use a proper session management system
-# (e.g., Flask sessions, Redis) to store FaceDetectionState per connected client.
-# For simplicity, we'll use a dictionary mapping session IDs to states.
-session_states = {}
+# FaceDetectionState per connected client, in a sharded, LRU-ordered store (see
+# session_store.py): idle sessions expire after SESSION_TIMEOUT, and beyond MAX_SESSIONS
+# the least recently active ones are evicted. SESSION_BACKEND=redis keeps them in Redis
+# instead (REDIS_URL), so any server process or node can handle any session.
 SESSION_TIMEOUT = 300 # seconds (5 minutes)
+MAX_SESSIONS = int(os.environ.get('MAX_SESSIONS', '10000'))
+SESSION_STORE_SHARDS = int(os.environ.get('SESSION_STORE_SHARDS', '16'))
+SESSION_SWEEP_INTERVAL = 10 # seconds between expiry sweeps
+SESSION_BACKEND = os.environ.get('SESSION_BACKEND', 'memory') # 'memory' or 'redis'
+REDIS_URL = os.environ.get('REDIS_URL', 'redis://localhost:6379/0')
+
+# Sign-in decision. 'sequential' accumulates distance-weighted evidence per candidate and
+# decides as soon as the outcome is clear; 'majority' is the original fixed 3-of-5 vote.
+DECISION_MODE = os.environ.get('DECISION_MODE', 'sequential')
+MAX_DETECTIONS = int(os.environ.get('MAX_DETECTIONS', '5')) # Face frames per attempt
+MAX_NO_FACE_FRAMES = int(os.environ.get('MAX_NO_FACE_FRAMES', '15')) # Frames without a face before giving up
+MATCH_TOLERANCE = float(os.environ.get('MATCH_TOLERANCE', '0.6'))
+STRONG_MATCH_DISTANCE = float(os.environ.get('STRONG_MATCH_DISTANCE', '0.4')) # Distance worth a full vote
+AMBIGUOUS_MARGIN = float(os.environ.get('AMBIGUOUS_MARGIN', '0.05')) # Smaller margins scale the vote down
+CONFIRM_EVIDENCE = float(os.environ.get('CONFIRM_EVIDENCE', '1.5')) # Evidence needed to decide
+CONFIRM_LEAD = float(os.environ.get('CONFIRM_LEAD', '1.0')) # Required lead over the runner-up
+# Least a match within MATCH_TOLERANCE is worth, so 3 weak matches still confirm as the 3-of-5 vote did
+MIN_MATCH_EVIDENCE = float(os.environ.get('MIN_MATCH_EVIDENCE', '0.5'))
+
+def match_evidence(distance, margin):
+    """
+    Vote weight in [0, 1] for one known-face match: 1 at STRONG_MATCH_DISTANCE or
+    closer, falling to MIN_MATCH_EVIDENCE at MATCH_TOLERANCE.
+    """
+    if distance is None:
+        return 1.0
+    closeness = min(1.0, max(0.0, (MATCH_TOLERANCE - distance) / (MATCH_TOLERANCE - STRONG_MATCH_DISTANCE)))
+    weight = MIN_MATCH_EVIDENCE + (1.0 - MIN_MATCH_EVIDENCE) * closeness
+    if margin is not None and margin < AMBIGUOUS_MARGIN:
+        weight *= margin / AMBIGUOUS_MARGIN # Nearly tied with another identity
+    return min(1.0, max(0.0, weight))
+
+def unknown_evidence(distance):
+    """
+    Vote weight in [0, 1] for an "Unknown" face, by how far its nearest identity
+    missed: 0 just past MATCH_TOLERANCE, 1 as far past it as STRONG_MATCH_DISTANCE
+    is inside it. A borderline miss is weak evidence of a stranger.
+    """
+    if distance is None:
+        return 1.0 # Empty gallery
+    return min(1.0, max(0.0, (distance - MATCH_TOLERANCE) / (MATCH_TOLERANCE - STRONG_MATCH_DISTANCE)))
 
 class FaceDetectionState:
     def __init__(self, sid):
         self.sid = sid # Store session ID
         self.detection_history = []
-        self.detection_count = 0
+        self.detection_count = 0 # Frames with a face; "NoFace" frames are counted separately
+        self.no_face_count = 0
+        self.quality_reason = None # Why the last frame's face was not encoded (face_quality reason code)
+        self.quality_rejects = 0
+        self.evidence = {} # name (or "Unknown") -> accumulated vote weight
         self.confirmed_user = None
         self.sign_in_time = None
         self.is_signed_in = False
+        self.recognition_failed = False
         self.last_update_time = time.time()
-        self.lock = threading.Lock() # For thread-safe updates
+        self.attempt = 0 # Bumped on reset, so other nodes know to drop their stream for this session
+        # While set, emit_status only keeps the newest status here for the caller to send
+        # later, e.g. once it has released the session lock (see on_frame_processed)
+        self.held_status = None
+        self.hold_status = False
+        # Re-entrant: add_detection -> determine_user/emit_status -> get_status all take it
+        self.lock = threading.RLock()
+        # Last face box for ROI-only detection on the next frame, and recent face encodings
+        self.stream = FrameStream(
+            FaceTracker(expansion=TRACK_ROI_EXPANSION, redetect_every=TRACK_REDETECT_EVERY) if TRACKING_ENABLED else None,
+            EmbeddingCache(SESSION_CACHE_SIZE, EMBEDDING_CACHE_TTL, SESSION_CACHE_MAX_DISTANCE)
+            if SESSION_CACHE_SIZE > 0 else None,
+        )
+
+    def is_complete(self):
+        with self.lock:
+            return self.is_signed_in or self.recognition_failed
 
-    def add_detection(self, name):
+    def add_detection(self, name, distance=None, margin=None):
         with self.lock:
             self.last_update_time = time.time()
-            if self.is_signed_in:
-                return # Already signed in, no more detections needed for this session
+            if self.is_complete():
+                return # Already decided, no more detections needed until reset
 
-            if self.detection_count < 5:
-                self.detection_count += 1
-                self.detection_history.append(name)
-                print(f"[{self.sid}] Detection {self.detection_count}: {name}")
+            if name != "LowQuality":
+                self.quality_reason = None
+            if name in ("NoFace", "LowQuality"):
+                # A face too poor to encode casts no vote, but counts towards giving up like a missing one
+                self.no_face_count += 1
+                if self.no_face_count >= MAX_NO_FACE_FRAMES:
+                    self.recognition_failed = True
+                    print(f"[{self.sid}] ⚠️  NO FACE in {self.no_face_count} frames - Please try again")
+                    self.emit_status()
+                return
+
+            self.detection_count += 1
+            self.detection_history.append(name)
+            weight = unknown_evidence(distance) if name == "Unknown" else match_evidence(distance, margin)
+            self.evidence[name] = self.evidence.get(name, 0.0) + weight
+            print(f"[{self.sid}] Detection {self.detection_count}: {name} (evidence +{weight:.2f})")
 
-                if self.detection_count == 5:
-                    self.determine_user()
-                    self.emit_status() # Emit status immediately after determining
-            elif self.detection_count == 5 and not self.is_signed_in:
-                # If 5 detections reached and still not signed in (e.g., mostly 'Unknown' or inconclusive)
-                # Ensure the final 'failed' state is emitted
-                self.emit_status()
+            if DECISION_MODE == 'sequential' or self.detection_count >= MAX_DETECTIONS:
+                self.determine_user()
+                if self.is_complete():
+                    self.emit_status() # Emit status immediately after deciding
+
+    def add_quality_reject(self, reason):
+        with self.lock:
+            if self.is_complete():
+                return
+            self.quality_reason = reason
+            self.quality_rejects += 1
+            self.add_detection("LowQuality")
 
     def determine_user(self):
         with self.lock:
             if self.is_signed_in:
                 return
+            if DECISION_MODE == 'sequential':
+                self._decide_sequential()
+            else:
+                self._decide_majority()
 
-            name_counts = Counter(self.detection_history)
-            most_common = name_counts.most_common(1)
+    def _decide_majority(self):
+        name_counts = Counter(self.detection_history)
+        most_common = name_counts.most_common(1)
+        self.recognition_failed = True # Overridden below on success
 
-            if most_common and most_common[0][1] >= 3:
-                self.confirmed_user = most_common[0][0]
-                if self.confirmed_user != "Unknown":
-                    self.sign_in_time = time.strftime("%Y-%m-%d %H:%M:%S")
-                    self.is_signed_in = True
-                    print(f"[{self.sid}] ✅ USER CONFIRMED: {self.confirmed_user}")
-                else:
-                    print(f"[{self.sid}] ❌ UNKNOWN USER - Access Denied (Most frequent was 'Unknown')")
+        if most_common and most_common[0][1] >= MAX_DETECTIONS // 2 + 1: # Strict majority of the frames
+            self.confirmed_user = most_common[0][0]
+            if self.confirmed_user != "Unknown":
+                self._sign_in()
+            else:
+                print(f"[{self.sid}] ❌ UNKNOWN USER - Access Denied (Most frequent was 'Unknown')")
+        else:
+            print(f"[{self.sid}] ⚠️  INCONCLUSIVE RESULTS - Please try again")
+
+    def _decide_sequential(self):
+        ranked = sorted(self.evidence.items(), key=lambda item: item[1], reverse=True)
+        best_name, best = ranked[0]
+        runner_up = ranked[1][1] if len(ranked) > 1 else 0.0
+
+        if best >= CONFIRM_EVIDENCE and best - runner_up >= CONFIRM_LEAD:
+            self.confirmed_user = best_name
+            if best_name != "Unknown":
+                self._sign_in()
             else:
-                print(f"[{self.sid}] ⚠️  INCONCLUSIVE RESULTS - Please try again")
+                self.recognition_failed = True
+                print(f"[{self.sid}] ❌ UNKNOWN USER - Access Denied after {self.detection_count} detections")
+            return
+
+        # Stop early once no known candidate can reach the threshold in the frames left
+        remaining = MAX_DETECTIONS - self.detection_count
+        best_known = max((v for n, v in self.evidence.items() if n != "Unknown"), default=0.0)
+        if best_known + remaining < CONFIRM_EVIDENCE or remaining <= 0:
+            self.recognition_failed = True
+            print(f"[{self.sid}] ⚠️  INCONCLUSIVE RESULTS after {self.detection_count} detections - Please try again")
+
+    def _sign_in(self):
+        self.sign_in_time = time.strftime("%Y-%m-%d %H:%M:%S")
+        self.is_signed_in = True
+        self.recognition_failed = False
+        print(f"[{self.sid}] ✅ USER CONFIRMED: {self.confirmed_user} after {self.detection_count} detections")
 
     def reset(self):
         with self.lock:
             self.detection_history = []
             self.detection_count = 0
+            self.no_face_count = 0
+            self.quality_reason = None
+            self.quality_rejects = 0
+            self.evidence = {}
             self.confirmed_user = None
             self.sign_in_time = None
             self.is_signed_in = False
+            self.recognition_failed = False
             self.last_update_time = time.time()
+            self.attempt += 1
+            self.stream.reset() # A new attempt may be a different person
             print(f"[{self.sid}] 🔄 Detection state reset.")
             self.emit_status() # Emit reset status
 
@@ -90,80 +396,305 @@ class FaceDetectionState:
         with self.lock:
             status = {
                 "is_signed_in": self.is_signed_in,
+                "recognition_failed": self.recognition_failed,
                 "confirmed_user": self.confirmed_user,
                 "detection_count": self.detection_count,
+                "no_face_count": self.no_face_count,
+                "quality": {
+                    "reason": self.quality_reason,
+                    "hint": HINTS.get(self.quality_reason),
+                    "rejected_frames": self.quality_rejects,
+                },
+                "max_detections": MAX_DETECTIONS,
                 "sign_in_time": self.sign_in_time,
+                "decision": {
+                    "mode": DECISION_MODE,
+                    "evidence": {name: round(v, 3) for name, v in self.evidence.items()},
+                    "confirm_evidence": CONFIRM_EVIDENCE,
+                    "confirm_lead": CONFIRM_LEAD,
+                    "strong_match_distance": STRONG_MATCH_DISTANCE,
+                    "match_tolerance": MATCH_TOLERANCE,
+                },
                 "message": "Recognition in progress"
             }
             if status["is_signed_in"]:
                 status["message"] = f"User '{status['confirmed_user']}' confirmed."
-            elif status["detection_count"] >= 5 and not status["is_signed_in"]:
-                status["message"] = "Recognition failed or inconclusive after 5 detections."
+            elif status["recognition_failed"]:
+                status["message"] = f"Recognition failed or inconclusive after {self.detection_count} detections."
+            elif self.quality_reason is not None:
+                status["message"] = HINTS.get(self.quality_reason, "Face not clear enough")
             elif status["detection_count"] == 0:
                 status["message"] = "Waiting for face detection..."
             else:
-                status["message"] = f"Analyzing... {self.detection_count}/5 detections"
+                status["message"] = f"Analyzing... {self.detection_count}/{MAX_DETECTIONS} detections"
             return status
 
     def emit_status(self):
         # Emits the current state to the client associated with this SID
         current_status = self.get_status()
-        socketio.emit('recognition_status', current_status, room=self.sid)
-        print(f"[{self.sid}] Emitted status: {current_status['message']}")
+        if self.hold_status:
+            self.held_status = current_status
+            return
+        self.send_status(current_status)
+
+    def send_status(self, status):
+        with metrics.timer('emit'):
+            socketio.emit('recognition_status', status, room=self.sid)
+        print(f"[{self.sid}] Emitted status: {status['message']}")
+
+    # Fields shared through the Redis session backend. The stream (face track and
+    # embedding cache) stays on the node that processed the frames.
+    SHARED_FIELDS = (
+        'detection_history', 'detection_count', 'no_face_count', 'quality_reason', 'quality_rejects', 'evidence',
+        'confirmed_user', 'sign_in_time', 'is_signed_in', 'recognition_failed', 'last_update_time', 'attempt',
+    )
+
+    def to_dict(self):
+        with self.lock:
+            return {field: getattr(self, field) for field in self.SHARED_FIELDS}
+
+    @classmethod
+    def from_dict(cls, sid, data):
+        state = cls(sid)
+        for field in cls.SHARED_FIELDS:
+            if field in data:
+                setattr(state, field, data[field])
+        return state
+
+def on_session_evicted(sid, state, reason):
+    print(f"[{sid}] Session {reason}, removing its state")
+    recognition_pool.discard(sid)
+    socketio.emit('session_expired', {
+        'reason': reason,
+        'message': 'Recognition session ended due to inactivity' if reason == EXPIRED
+                   else 'Recognition session ended because the server is at its session limit',
+    }, room=sid)
+
+if SESSION_BACKEND == 'redis':
+    # This node's streams, reused while the session's attempt is unchanged
+    local_streams = SessionStore(SESSION_TIMEOUT, max_sessions=MAX_SESSIONS, shards=SESSION_STORE_SHARDS)
+
+    def load_session_state(sid, data):
+        state = FaceDetectionState.from_dict(sid, data)
+        local = local_streams.get(sid)
+        if local is not None and local[0] == state.attempt:
+            state.stream = local[1]
+        else:
+            local_streams[sid] = (state.attempt, state.stream)
+        return state
+
+    def save_session_state(state):
+        local_streams[state.sid] = (state.attempt, state.stream)
+        return state.to_dict()
+
+    session_states = RedisSessionStore(redis_client(REDIS_URL), SESSION_TIMEOUT,
+                                       dumps=save_session_state, loads=load_session_state)
+else:
+    session_states = SessionStore(SESSION_TIMEOUT, max_sessions=MAX_SESSIONS, shards=SESSION_STORE_SHARDS,
+                                  on_evict=on_session_evicted)
 
 
 # --- Utility Functions ---
-def load_encodings(encodings_path):
-    encodings = []
-    class_names = []
-    for file in os.listdir(encodings_path):
-        if file.endswith("_encoding.npy"):
-            class_name = file.split('_')[0]
-            try:
-                encoding = np.load(os.path.join(encodings_path, file))
-                encodings.append(encoding)
-                class_names.append(class_name)
-            except Exception as e:
-                print(f"Error loading encoding from {file}: {e}")
-    return encodings, class_names
+def load_encodings(store):
+    if not store.exists():
+        # First start after upgrading: pull in the old per-person .npy files once
+        migrated = migrate_legacy(ENCODINGS_PATH, store)
+        print(f"Migrated {len(migrated)} legacy encodings into {store.root}")
+    return store.read_all()
+
+def build_gallery(encodings, names):
+    options = {'aggregation': GALLERY_AGGREGATION, 'max_templates': MAX_TEMPLATES_PER_IDENTITY}
+    if GALLERY_INDEX == 'ivf':
+        options['nprobe'] = GALLERY_IVF_NPROBE
+    return FaceGallery(encodings, names, index=GALLERY_INDEX, **options)
+
+gallery_store = GalleryStore(GALLERY_STORE_PATH)
+gallery = build_gallery([], []) # Replaced by the stored gallery in startup()
+
+def save_face_encoding(name, frames):
+    """
+    Enrols `name` from one or more frames; every frame with a face adds a template.
+    Near-duplicate templates are dropped and the rest capped per identity.
+    """
+    import face_recognition
+    templates = []
+    saved_image = False
+    for frame in frames:
+        img_rgb = cv2.cvtColor(frame, cv2.COLOR_BGR2RGB)
+        encodings = face_recognition.face_encodings(img_rgb)
+        if not encodings:
+            continue
+        templates.append(encodings[0])
+        if not saved_image:
+            cv2.imwrite(os.path.join(ENCODINGS_PATH, f'{name}.jpg'), frame)
+            saved_image = True
+
+    if not templates:
+        return False
+
+    enroll_templates(name, templates)
+    return True
+
+def enroll_templates(name, templates, photo=None):
+    """Replaces `name`'s stored templates and updates the live gallery. Returns how many were kept."""
+    templates = select_templates(templates, max_templates=MAX_TEMPLATES_PER_IDENTITY)
+    if photo is not None:
+        cv2.imwrite(os.path.join(ENCODINGS_PATH, f'{name}.jpg'), photo)
+    gallery_store.append(name, templates)
+    print(f"{len(templates)} template(s) saved for {name}")
+
+    # Swap just this person's rows into the live gallery; no directory reload,
+    # and in-flight recognitions keep matching against their own snapshot.
+    gallery.upsert(name, templates)
+    return len(templates)
+
+def enrollment_name_error(name):
+    if not name:
+        return "Name is required."
+    if len(name) > 128 or name.startswith('.') or re.search(r'[\\/\x00]', name):
+        return "Name must be 1-128 characters, without path separators or a leading dot."
+    return None
+
+# Upload enrolment: photos are decoded, detected and encoded on the recognition pool's
+# workers, one task per photo, while the request returns a job id at once. Progress goes
+# to the Socket.IO room of the job; the gallery is updated live when the last photo is in.
+class EnrollmentJob:
+    def __init__(self, name, images):
+        self.id = uuid.uuid4().hex
+        self.name = name
+        self.images = images
+        self.total = len(images)
+        self.created = time.time()
+        self.finished = None
+        self.status = 'running' # 'running', 'done' or 'failed'
+        self.processed = 0
+        self.accepted = [] # (photo index, encoding)
+        self.rejected = [] # {"index", "reason", "detail"}
+        self.templates = 0
+        self.message = "Processing photos"
+        self.lock = threading.Lock()
 
-known_encodings, class_names = load_encodings(ENCODINGS_PATH)
-print(f"Loaded known classes: {class_names}")
+    @property
+    def room(self):
+        return f"enrollment:{self.id}"
 
-def save_face_encoding(name, frame):
-    img_rgb = cv2.cvtColor(frame, cv2.COLOR_BGR2RGB)
-    encodings = face_recognition.face_encodings(img_rgb)
+    def start(self):
+        for index, image in enumerate(self.images):
+            future = recognition_pool.run_task(run_enrollment_photo, image)
+            future.add_done_callback(lambda f, index=index: self._photo_done(index, f))
 
-    if encodings:
-        img_path = os.path.join(ENCODINGS_PATH, f'{name}.jpg')
-        cv2.imwrite(img_path, frame)
+    def _photo_done(self, index, future):
+        try:
+            status, detail, encoding = future.result()
+        except Exception as e:
+            status, detail, encoding = UNREADABLE, str(e), None
+        metrics.inc('enrollment_photos', outcome=status, help="Uploaded enrolment photos, by outcome.")
+        with self.lock:
+            self.processed += 1
+            if status == 'ok':
+                self.accepted.append((index, encoding))
+            else:
+                self.rejected.append({"index": index, "reason": status, "detail": detail})
+            finished = self.processed == self.total
+        progress = self.to_dict()
+        progress["photo"] = {"index": index, "status": status, "detail": detail}
+        socketio.emit('enrollment_progress', progress, room=self.room)
+        if finished:
+            self._finish()
+
+    def _finish(self):
+        try:
+            if self.accepted:
+                self.accepted.sort(key=lambda item: item[0])
+                buffer, _ = frame_buffer(self.images[self.accepted[0][0]])
+                photo = cv2.imdecode(np.frombuffer(buffer, np.uint8), cv2.IMREAD_COLOR)
+                self.templates = enroll_templates(self.name, [enc for _, enc in self.accepted], photo)
+                self.status = 'done'
+                self.message = f"Face for {self.name} enrolled from {len(self.accepted)} of {self.total} photo(s)."
+            else:
+                self.status = 'failed'
+                self.message = "No usable face in any photo."
+        except Exception as e:
+            print(f"Enrolment job {self.id} for {self.name} failed: {e}")
+            self.status = 'failed'
+            self.message = f"Enrolment failed: {e}"
+        self.finished = time.time()
+        self.images = None # Drop the uploads; the job only reports from here on
+        print(f"Enrolment job {self.id}: {self.message}")
+        socketio.emit('enrollment_complete', self.to_dict(), room=self.room)
 
-        np.save(os.path.join(ENCODINGS_PATH, f'{name}_encoding.npy'), encodings[0])
-        print(f"Image and encoding saved for {name}")
+    def to_dict(self):
+        with self.lock:
+            return {
+                "job_id": self.id,
+                "name": self.name,
+                "status": self.status,
+                "success": self.status == 'done',
+                "total": self.total,
+                "processed": self.processed,
+                "accepted": len(self.accepted),
+                "rejected": list(self.rejected),
+                "templates": self.templates,
+                "message": self.message,
+            }
 
-        global known_encodings, class_names # Update global list for real-time recognition
-        known_encodings, class_names = load_encodings(ENCODINGS_PATH)
-        return True
-    return False
+enrollment_jobs = {}
+enrollment_jobs_lock = threading.Lock()
+
+def create_enrollment(name, images):
+    """Validates an upload and registers its job (not yet started). Returns (job, error)."""
+    error = enrollment_name_error(name)
+    if error is None and not images:
+        error = "At least one image is required."
+    if error is None and len(images) > ENROLL_MAX_IMAGES:
+        error = f"At most {ENROLL_MAX_IMAGES} images per enrolment."
+    if error is not None:
+        return None, error
+    job = EnrollmentJob(name, images)
+    now = time.time()
+    with enrollment_jobs_lock:
+        for job_id in [job_id for job_id, old in enrollment_jobs.items()
+                       if old.finished is not None and now - old.finished > ENROLL_JOB_TTL]:
+            del enrollment_jobs[job_id]
+        enrollment_jobs[job.id] = job
+    return job, None
 
 def process_image_for_recognition(image_np, state: FaceDetectionState):
     """
     Performs face recognition on a single image and updates the detection state.
     Emits status if state changes.
     """
-    global known_encodings, class_names
+    if state.is_complete():
+        # If already signed in or the attempt has failed,
+        # don't process new frames until reset.
+        return
 
-    with state.lock:
-        if state.is_signed_in or (state.detection_count >= 5 and not state.is_signed_in):
-            # If already signed in or reached max detections for an inconclusive result,
-            # don't process new frames until reset.
-            return
+    received = time.perf_counter()
+    result = frame_pipeline.process(image_np, tracker=state.stream.tracker, max_faces=1, cache=state.stream.cache)
+    record_cache_outcome(result)
+    match_results([result])
+    apply_recognition_result(result, state)
+    record_frame_metrics(result, state, was_complete=False, received=received)
+
+def apply_recognition_result(result, state: FaceDetectionState):
+    """
+    Matches the encodings produced by the frame pipeline against the gallery and
+    updates the detection state. Emits status if state changes.
+    """
+    if state.is_complete():
+        return
 
-    rgb_frame = cv2.cvtColor(image_np, cv2.COLOR_BGR2RGB)
-    face_locations = face_recognition.face_locations(rgb_frame)
-    face_encodings = face_recognition.face_encodings(rgb_frame, face_locations)
+    face_encodings = result["encodings"]
+    height, width = result["frame_shape"]
+    print(f"[{state.sid}] Frame {width}x{height} at scale {result['scale']:.2f}, "
+          f"batch of {result.get('batch_size', 1)} (ms: {format_timings(result['timings'])})")
 
-    current_name = "Unknown"
+    quality = result.get("quality")
+    if not face_encodings and quality and quality["reason"]:
+        print(f"[{state.sid}] Face not encoded: {quality['reason']} ({quality})")
+        state.add_quality_reject(quality["reason"])
+        state.emit_status()
+        return
 
     if not face_encodings:
         # print(f"[{state.sid}] No face detected in the received image.")
@@ -171,45 +702,42 @@ def process_image_for_recognition(image_np, state: FaceDetectionState):
         state.emit_status() # Emit status to show "Analyzing... (X/5)" or "Waiting..."
         return
 
-    # For simplicity, we'll assume one face per image for sign-in
-    face_encoding = face_encodings[0]
-    matches = face_recognition.compare_faces(known_encodings, face_encoding, tolerance=0.6)
+    # For simplicity, we'll assume one face per image for sign-in.
+    # Nearest identity wins (not the first one within tolerance). Frames from the
+    # recognition pool arrive already matched, together with the rest of their batch.
+    match = result.get("match")
+    if match is None:
+        with metrics.timer('match'):
+            match = gallery.match(face_encodings[0], tolerance=MATCH_TOLERANCE)
+    current_name = match["name"]
+    if match["candidates"]:
+        print(f"[{state.sid}] Top candidates: {match['candidates']} (margin: {match['margin']})")
 
-    if True in matches:
-        first_match_index = matches.index(True)
-        current_name = class_names[first_match_index]
-
-    state.add_detection(current_name)
+    state.add_detection(current_name, distance=match["distance"], margin=match["margin"])
     state.emit_status() # Emit status whenever a detection is added
 
 # --- Flask HTTP Endpoints (for training and session management) ---
 
-# Cleanup inactive sessions
+# Cleanup inactive sessions; each sweep only touches the sessions that actually expired
 def cleanup_sessions():
     while True:
-        time.sleep(60) # Check every minute
-        current_time = time.time()
-        inactive_sids = []
-        with threading.Lock(): # Protect session_states dictionary
-            for sid, state in session_states.items():
-                with state.lock:
-                    if (current_time - state.last_update_time) > SESSION_TIMEOUT:
-                        inactive_sids.append(sid)
-            for sid in inactive_sids:
-                print(f"Cleaning up inactive session: {sid}")
-                del session_states[sid]
-
-# Start session cleanup thread
-session_cleanup_thread = threading.Thread(target=cleanup_sessions, daemon=True)
-session_cleanup_thread.start()
+        time.sleep(SESSION_SWEEP_INTERVAL)
+        expired = session_states.expire()
+        if SESSION_BACKEND == 'redis':
+            local_streams.expire() # Redis expires the shared state; drop this node's leftover streams
+        if expired:
+            print(f"Cleaned up {expired} inactive session(s)")
 
 
 @app.route('/train_face', methods=['POST'])
 def train_face_http():
     # This endpoint remains for training, which usually involves a manual capture.
-    name = request.json.get('name')
-    if not name:
-        return jsonify({"success": False, "message": "Name is required."}), 400
+    # It needs a webcam and a display on the server; headless hosts use /enroll instead.
+    name = (request.json.get('name') or '').strip()
+    # Validated before the camera opens: the name becomes a file name and a gallery key
+    error = enrollment_name_error(name)
+    if error is not None:
+        return jsonify({"success": False, "message": error}), 400
 
     cap = cv2.VideoCapture(0)
     if not cap.isOpened():
@@ -218,33 +746,32 @@ def train_face_http():
     print(f"Starting face capture for {name} for training...")
     start_time = time.time()
     capture_duration = 10
-    face_captured = False
+    captured_frames = [] # One template candidate per frame, spread over the window
+    last_capture_time = 0
 
     # This part typically runs on a dedicated training machine, not the main server
     # to avoid UI blocking. You might remove or adapt the cv2.imshow for serverless.
     cv2.namedWindow(f"Capture Face for {name}", cv2.WINDOW_NORMAL)
     cv2.resizeWindow(f"Capture Face for {name}", 640, 480)
 
-    while (time.time() - start_time) < capture_duration and not face_captured:
+    while (time.time() - start_time) < capture_duration and len(captured_frames) < MAX_TEMPLATES_PER_IDENTITY:
         ret, frame = cap.read()
         if not ret:
             print("Failed to grab frame during training capture.")
             break
 
         rgb_frame = cv2.cvtColor(frame, cv2.COLOR_BGR2RGB)
-        face_locations = face_recognition.face_locations(rgb_frame)
+        face_locations = face_detector(rgb_frame)
 
         display_frame = frame.copy()
         if face_locations:
-            face_captured = save_face_encoding(name, frame)
+            if time.time() - last_capture_time >= TRAINING_FRAME_INTERVAL:
+                captured_frames.append(frame)
+                last_capture_time = time.time()
             y1, x2, y2, x1 = face_locations[0]
             cv2.rectangle(display_frame, (x1, y1), (x2, y2), (0, 255, 0), 2)
-            cv2.putText(display_frame, "Face Detected! Capturing...", (10, 30), cv2.FONT_HERSHEY_SIMPLEX, 1, (0, 255, 0), 2)
-            if face_captured:
-                cv2.putText(display_frame, "Face Captured Successfully!", (10, 70), cv2.FONT_HERSHEY_SIMPLEX, 1, (0, 255, 0), 2)
-                cv2.imshow(f"Capture Face for {name}", display_frame)
-                cv2.waitKey(2000)
-                break
+            cv2.putText(display_frame, f"Face Detected! Capturing... {len(captured_frames)}/{MAX_TEMPLATES_PER_IDENTITY}", (10, 30), cv2.FONT_HERSHEY_SIMPLEX, 1, (0, 255, 0), 2)
+            cv2.putText(display_frame, "Turn your head slightly between captures.", (10, 70), cv2.FONT_HERSHEY_SIMPLEX, 0.7, (0, 255, 0), 2)
         else:
             cv2.putText(display_frame, "No face detected. Please look at camera.", (10, 30), cv2.FONT_HERSHEY_SIMPLEX, 0.7, (0, 0, 255), 2)
 
@@ -256,11 +783,37 @@ def train_face_http():
     cap.release()
     cv2.destroyAllWindows()
 
+    face_captured = save_face_encoding(name, captured_frames)
     if face_captured:
         return jsonify({"success": True, "message": f"Face for {name} trained successfully."})
     else:
         return jsonify({"success": False, "message": "Failed to capture or detect face for training."}), 400
 
+@app.route('/enroll', methods=['POST'])
+def enroll_http():
+    """
+    Starts an enrolment from uploaded photos: multipart/form-data with a 'name' field
+    and one or more 'images' files, or a single raw image body with ?name=.
+    Returns 202 with a job id; follow it with GET /enroll/<job_id> or, over Socket.IO,
+    'watch_enrollment' for progress events.
+    """
+    name = (request.form.get('name') or request.args.get('name') or '').strip()
+    images = [upload.read() for upload in request.files.getlist('images')]
+    if not images and (request.content_type or '').startswith('image/'):
+        images = [request.get_data()]
+    job, error = create_enrollment(name, images)
+    if error is not None:
+        return jsonify({"success": False, "message": error}), 400
+    job.start()
+    return jsonify({"success": True, "job_id": job.id, "status_url": f"/enroll/{job.id}", "total": job.total}), 202
+
+@app.route('/enroll/<job_id>', methods=['GET'])
+def get_enrollment_http(job_id):
+    job = enrollment_jobs.get(job_id)
+    if job is None:
+        return jsonify({"success": False, "message": f"Enrolment job {job_id} not found."}), 404
+    return jsonify(job.to_dict())
+
 @app.route('/reset_recognition_state', methods=['POST'])
 def reset_recognition_state_http():
     try:
@@ -271,9 +824,14 @@ def reset_recognition_state_http():
         data = request.get_json() or {}
         session_id = data.get('session_id')
         
-        if session_id and session_id in session_states:
-            # Reset specific session
-            session_states[session_id].reset()
+        found = False
+        if session_id:
+            with session_states.transaction(session_id) as state:
+                if state is not None:
+                    # Reset specific session (on whichever node holds its socket, with a shared backend)
+                    state.reset()
+                    found = True
+        if found:
             return jsonify({"success": True, "message": f"Session {session_id} recognition state reset."})
         elif session_id:
             # Session ID provided but not found
@@ -290,8 +848,9 @@ def reset_recognition_state_http():
 @app.route('/get_session_status/<session_id>', methods=['GET'])
 def get_session_status_http(session_id):
     """HTTP endpoint to check session status without Socket.IO"""
-    if session_id in session_states:
-        status = session_states[session_id].get_status()
+    state = session_states.peek(session_id)
+    if state is not None:
+        status = state.get_status()
         return jsonify({"success": True, "status": status})
     else:
         return jsonify({"success": False, "message": "Session not found."}), 404
@@ -301,14 +860,16 @@ def get_session_status_http(session_id):
 @socketio.on('connect')
 def handle_connect():
     sid = request.sid
+    note_first_request()
     print(f"[{sid}] Client connected")
     
     # Create a new detection state for this session
-    session_states[sid] = FaceDetectionState(sid)
+    state = FaceDetectionState(sid)
+    session_states[sid] = state
     join_room(sid)  # Join a room with the session ID for targeted emissions
     
     # Send initial status
-    emit('recognition_status', session_states[sid].get_status())
+    emit('recognition_status', state.get_status())
     emit('connection_confirmed', {'sid': sid, 'message': 'Connected successfully'})
 
 @socketio.on('disconnect')
@@ -317,8 +878,10 @@ def handle_disconnect():
     print(f"[{sid}] Client disconnected")
     
     # Clean up the session state
-    if sid in session_states:
-        del session_states[sid]
+    session_states.pop(sid)
+    if SESSION_BACKEND == 'redis':
+        local_streams.pop(sid)
+    recognition_pool.discard(sid)
     leave_room(sid)
 
 @socketio.on('start_recognition')
@@ -326,80 +889,155 @@ def handle_start_recognition():
     sid = request.sid
     print(f"[{sid}] Starting recognition session")
     
-    if sid not in session_states:
-        session_states[sid] = FaceDetectionState(sid)
-    else:
-        # Reset existing state for fresh recognition
-        session_states[sid].reset()
+    with session_states.transaction(sid) as state:
+        if state is None:
+            session_states[sid] = FaceDetectionState(sid)
+        else:
+            # Reset existing state for fresh recognition
+            state.reset()
     
     emit('recognition_started', {'message': 'Recognition session started'})
+    emit('ready_for_frame', {'credits': 1})
 
 @socketio.on('process_frame')
 def handle_process_frame(data):
     sid = request.sid
     
-    if sid not in session_states:
+    state = session_states.get(sid)
+    if state is None:
         emit('error', {'message': 'No active recognition session. Call start_recognition first.'})
         return
     
-    state = session_states[sid]
-    
     # Check if recognition is already complete
-    if state.is_signed_in or (state.detection_count >= 5 and not state.is_signed_in):
+    if state.is_complete():
         emit('recognition_complete', state.get_status())
         return
     
+    # Either a binary JPEG attachment (bytes) or a base64 / data-URL string from older clients
+    image_data = data.get('image') if isinstance(data, dict) else data
+    if not image_data:
+        emit('error', {'message': 'No image data provided'})
+        return
+
+    # Decode, detection and encoding happen in the recognition pool;
+    # on_frame_processed picks up the result.
+    received = time.perf_counter()
+    attempt = state.attempt # A reset while the frame is in flight makes its result stale
+    admission = recognition_pool.submit(
+        sid, image_data,
+        lambda: state.stream,
+        lambda result, stream: on_frame_processed(sid, result, stream, received, attempt),
+    )
+    if admission == OVERLOADED:
+        print(f"[{sid}] Server overloaded, frame rejected")
+        metrics.inc('frames_rejected', help="Frames refused because the recognition pool was full.")
+        emit('server_overloaded', {
+            'message': 'Server is at capacity, please retry shortly',
+            'retry_after_ms': OVERLOAD_RETRY_AFTER_MS,
+        })
+
+def on_frame_processed(sid, result, stream, received=None, attempt=None):
+    # Runs on a recognition pool thread, outside the Socket.IO request context;
+    # errors are reported to the client here rather than left to the pool
     try:
-        image_data_b64 = data.get('image')
-        if not image_data_b64:
-            emit('error', {'message': 'No image data provided'})
-            return
-        
-        # Clean the base64 string (remove 'data:image/jpeg;base64,' prefix if present)
-        if ',' in image_data_b64:
-            image_data_b64 = image_data_b64.split(',')[1]
-        
-        # Decode base64 string to bytes
-        img_bytes = base64.b64decode(image_data_b64)
-        
-        # Convert bytes to numpy array
-        np_arr = np.frombuffer(img_bytes, np.uint8)
-        img_np = cv2.imdecode(np_arr, cv2.IMREAD_COLOR)
-        
-        if img_np is None:
-            emit('error', {'message': 'Could not decode image'})
-            return
-        
-        # Process the frame for recognition
-        process_image_for_recognition(img_np, state)
-        
-        # Check if recognition is now complete
-        if state.is_signed_in or (state.detection_count >= 5 and not state.is_signed_in):
-            emit('recognition_complete', state.get_status())
-        
+        if "transport" in result:
+            record_frame_transport(result["transport"])
+        record_cache_outcome(result)
+
+        # Only the state update runs under the session lock (a distributed one with the
+        # Redis backend); the emits, which may go through the message queue, wait until
+        # it is released so a slow emit cannot outlast the lock's expiry.
+        events = []
+        with session_states.transaction(sid) as state:
+            if state is None:
+                return # Session ended while the frame was in flight
+            if attempt is not None and state.attempt != attempt:
+                # Reset while in flight: the frame must not vote in the new attempt, nor
+                # replace its fresh stream with the previous person's track and cache
+                print(f"[{sid}] Dropping a frame of attempt {attempt} (now {state.attempt})")
+                return
+
+            was_complete = state.is_complete()
+            state.hold_status = True
+            try:
+                if "error" in result:
+                    print(f"[{sid}] {result['error']}")
+                    events.append(('error', {'message': result['error']}))
+                else:
+                    if stream is not None:
+                        state.stream = stream # The worker advanced a copy of the session's track and cache
+                    apply_recognition_result(result, state)
+            except Exception as e:
+                print(f"[{sid}] Error processing frame: {e}")
+                events.append(('error', {'message': f'Error processing frame: {str(e)}'}))
+            finally:
+                state.hold_status = False
+                status, state.held_status = state.held_status, None
+
+            if state.is_complete():
+                recognition_pool.discard(sid) # Any frame still waiting is no longer needed
+                events.append(('recognition_complete', state.get_status()))
+            elif not recognition_pool.has_waiting(sid):
+                # Credit: the client may send its next frame now (a waiting frame gets its own later)
+                events.append(('ready_for_frame', {'credits': 1}))
+            record_frame_metrics(result, state, was_complete, received)
+
+        if status is not None:
+            state.send_status(status)
+        for event, data in events:
+            socketio.emit(event, data, room=sid)
     except Exception as e:
-        print(f"[{sid}] Error processing frame: {e}")
-        emit('error', {'message': f'Error processing frame: {str(e)}'})
+        print(f"[{sid}] Error handling processed frame: {e}")
+        socketio.emit('error', {'message': f'Error processing frame: {str(e)}'}, room=sid)
+
+@socketio.on('enroll_face')
+def handle_enroll_face(data):
+    """{'name': ..., 'images': [binary JPEG attachments or base64 strings]}"""
+    data = data if isinstance(data, dict) else {}
+    images = data.get('images') or []
+    if not isinstance(images, list):
+        images = [images]
+    job, error = create_enrollment((data.get('name') or '').strip(), images)
+    if error is not None:
+        emit('enrollment_error', {'message': error})
+        return
+    join_room(job.room) # Before starting, so no progress event is missed
+    emit('enrollment_started', job.to_dict())
+    job.start()
+
+@socketio.on('watch_enrollment')
+def handle_watch_enrollment(data):
+    job = enrollment_jobs.get((data or {}).get('job_id'))
+    if job is None:
+        emit('enrollment_error', {'message': 'Unknown enrolment job'})
+        return
+    join_room(job.room)
+    emit('enrollment_complete' if job.finished is not None else 'enrollment_progress', job.to_dict())
 
 @socketio.on('reset_session')
 def handle_reset_session():
     sid = request.sid
     print(f"[{sid}] Resetting recognition session")
     
-    if sid in session_states:
-        session_states[sid].reset()
+    with session_states.transaction(sid) as state:
+        if state is not None:
+            state.reset()
+        else:
+            # Create new session if doesn't exist
+            session_states[sid] = FaceDetectionState(sid)
+    if state is not None:
         emit('session_reset', {'message': 'Recognition session reset successfully'})
     else:
-        # Create new session if doesn't exist
-        session_states[sid] = FaceDetectionState(sid)
         emit('session_reset', {'message': 'New recognition session created'})
+    emit('ready_for_frame', {'credits': 1})
 
 @socketio.on('get_status')
 def handle_get_status():
     sid = request.sid
     
-    if sid in session_states:
-        status = session_states[sid].get_status()
+    state = session_states.get(sid)
+    if state is not None:
+        status = state.get_status()
         emit('recognition_status', status)
     else:
         emit('error', {'message': 'No active session found'})
@@ -409,9 +1047,10 @@ def handle_end_session():
     sid = request.sid
     print(f"[{sid}] Ending recognition session")
     
-    if sid in session_states:
-        final_status = session_states[sid].get_status()
-        del session_states[sid]
+    state = session_states.pop(sid)
+    if state is not None:
+        final_status = state.get_status()
+        recognition_pool.discard(sid)
         emit('session_ended', {'message': 'Recognition session ended', 'final_status': final_status})
     else:
         emit('session_ended', {'message': 'No active session to end'})
@@ -426,13 +1065,121 @@ def get_active_sessions():
         sessions_info[sid] = {
             'detection_count': state.detection_count,
             'is_signed_in': state.is_signed_in,
+            'recognition_failed': state.recognition_failed,
             'confirmed_user': state.confirmed_user,
+            'embedding_cache': state.stream.cache.stats() if state.stream.cache is not None else None,
             'last_update': state.last_update_time
         }
-    return jsonify({"active_sessions": sessions_info, "total": len(sessions_info)})
+    return jsonify({"active_sessions": sessions_info, "total": len(sessions_info), "store": session_states.stats()})
+
+@app.route('/frame_stats', methods=['GET'])
+def get_frame_stats():
+    """Debug endpoint: frame transport, recognition pool and embedding cache counters"""
+    with frame_transport_lock:
+        transport = {fmt: dict(stats) for fmt, stats in frame_transport_stats.items()}
+    with embedding_cache_lock:
+        outcomes = dict(embedding_cache_outcomes)
+    lookups = sum(outcomes.values())
+    embedding_cache = {
+        "outcomes": outcomes,
+        "hit_rate": (lookups - outcomes.get('miss', 0)) / lookups if lookups else 0.0,
+    }
+    return jsonify({
+        "transport": transport,
+        "pool": recognition_pool.stats(),
+        "embedding_cache": embedding_cache,
+        "match_cache": match_cache.stats() if match_cache is not None else None,
+        "latency_ms": metrics.stages(),
+        "startup": startup_stats,
+    })
+
+metrics.gauge('active_sessions', lambda: len(session_states), "Recognition sessions currently held.")
+metrics.gauge('frames_in_flight', lambda: recognition_pool.stats()["pending"],
+              "Sessions with a frame queued or being processed.")
+metrics.gauge('frames_waiting', lambda: recognition_pool.stats()["waiting"],
+              "Newer frames waiting behind a session's in-flight frame.")
+metrics.gauge('startup_seconds', lambda: startup_stats.get('ready_s', 0),
+              "Seconds from process start until the server was ready to serve.")
+metrics.gauge('first_request_seconds', lambda: startup_stats.get('first_request_s', 0),
+              "Seconds from process start until the first request or connection.")
+metrics.gauge('master_rss_bytes', lambda: int(process_memory().get('rss_mb', 0) * 2 ** 20),
+              "Resident memory of the server (master) process.")
+metrics.gauge('workers_private_bytes',
+              lambda: int(sum(process_memory(pid).get('private_mb', 0) for pid in recognition_pool.worker_pids()) * 2 ** 20),
+              "Memory the recognition workers do not share with the master (copy-on-write pages they dirtied).")
+
+@app.route('/metrics', methods=['GET'])
+def get_metrics():
+    """Prometheus scrape endpoint"""
+    if not metrics.enabled:
+        return "Metrics are disabled (METRICS_ENABLED=0)\n", 404, {'Content-Type': 'text/plain'}
+    return metrics.render(), 200, {'Content-Type': 'text/plain; version=0.0.4; charset=utf-8'}
+
+# --- Startup ---
+# The master process loads the gallery and dlib's models once, then forks the
+# recognition workers: they inherit those pages copy-on-write instead of each
+# loading their own copy, and the fork happens before any server thread exists.
+startup_stats = {}
+startup_lock = threading.Lock()
+
+def startup():
+    """Loads the gallery and models, forks the recognition workers and starts the session sweeper. Idempotent."""
+    global gallery
+    with startup_lock:
+        if 'ready_s' in startup_stats:
+            return startup_stats
+        started = time.perf_counter()
+        gallery = build_gallery(*load_encodings(gallery_store))
+        gallery_loaded = time.perf_counter()
+        frame_pipeline.warm_up()
+        models_loaded = time.perf_counter()
+        # Park everything allocated so far outside the cyclic GC: a collection in a
+        # worker would otherwise write to, and so copy, every page holding a tracked object
+        gc.collect()
+        gc.freeze()
+        recognition_pool.warm_up()
+        workers_ready = time.perf_counter()
+        threading.Thread(target=cleanup_sessions, daemon=True).start()
+
+        workers = [process_memory(pid) for pid in recognition_pool.worker_pids()]
+        startup_stats.update({
+            "ready_s": round(time.time() - PROCESS_STARTED, 3),
+            "gallery_s": round(gallery_loaded - started, 3),
+            "models_s": round(models_loaded - gallery_loaded, 3),
+            "workers_s": round(workers_ready - models_loaded, 3),
+            "memory_mb": {
+                "master": process_memory(),
+                "workers": len(workers),
+                "workers_rss": round(sum(w.get('rss_mb', 0) for w in workers), 1),
+                "workers_private": round(sum(w.get('private_mb', 0) for w in workers), 1),
+            },
+        })
+    memory = startup_stats["memory_mb"]
+    print(f"Ready {startup_stats['ready_s']:.2f}s after process start (gallery {startup_stats['gallery_s']:.2f}s, "
+          f"models {startup_stats['models_s']:.2f}s, workers {startup_stats['workers_s']:.2f}s); "
+          f"master RSS {memory['master'].get('rss_mb', 0):.0f} MB, {memory['workers']} worker(s) "
+          f"RSS {memory['workers_rss']:.0f} MB of which {memory['workers_private']:.0f} MB private")
+    return startup_stats
+
+def note_first_request():
+    if 'first_request_s' not in startup_stats:
+        startup_stats['first_request_s'] = round(time.time() - PROCESS_STARTED, 3)
+        print(f"First request {startup_stats['first_request_s']:.2f}s after process start")
+
+@app.before_request
+def record_first_request():
+    # Socket.IO traffic bypasses Flask's request hooks; handle_connect notes it instead
+    if 'first_request_s' not in startup_stats:
+        note_first_request()
 
 if __name__ == '__main__':
     print("Starting Socket.IO Face Recognition Server...")
-    print(f"Loaded {len(class_names)} known faces: {class_names}")
-    # Use socketio.run instead of app.run for Socket.IO support
-    socketio.run(app, host='0.0.0.0', port=5000, debug=True)
\ No newline at end of file
+    print(f"Face detector: {face_detector}")
+    startup()
+    print(f"Loaded {len(gallery)} known faces: {gallery.names}")
+    print(f"Recognition pool ready: {RECOGNITION_WORKERS} worker(s), max {RECOGNITION_MAX_PENDING} pending frames")
+    # Use socketio.run instead of app.run for Socket.IO support. No reloader: it would
+    # load the models and fork the workers twice. allow_unsafe_werkzeug lets the
+    # threading server run outside debug mode.
+    socketio.run(app, host=SERVER_HOST, port=SERVER_PORT, debug=FLASK_DEBUG, use_reloader=False,
+                 allow_unsafe_werkzeug=True)
\ No newline at end of file
@@ -0,0 +1,94 @@
+"""
+Benchmark the gallery index backends on synthetic 128-d galleries.
+
+For every gallery size it builds each backend, replays noisy copies of gallery
+rows as probes (one probe per query, like process_frame does) and reports
+recall@1 against the exact answer plus p50/p99 query latency.
+
+Usage:
+    python benchmark_index.py
+    python benchmark_index.py --sizes 10000,100000 --nprobe 4,16,64 --queries 500
+"""
+import argparse
+import time
+
+import numpy as np
+
+from gallery import ENCODING_DIM
+from gallery_index import BruteForceIndex, IVFIndex
+
+
+def synthetic_gallery(size, rng):
+    # dlib encodings are roughly unit-scale vectors; sample on a sphere of radius ~1
+    gallery = rng.standard_normal((size, ENCODING_DIM)).astype(np.float32)
+    gallery /= np.linalg.norm(gallery, axis=1, keepdims=True)
+    return gallery
+
+
+def synthetic_probes(gallery, count, noise, rng):
+    rows = rng.choice(len(gallery), count, replace=False)
+    probes = gallery[rows] + noise * rng.standard_normal((count, ENCODING_DIM)).astype(np.float32)
+    return probes.astype(np.float32)
+
+
+def exact_top1(gallery, probes):
+    index = BruteForceIndex().build(gallery)
+    ids, _ = index.search(probes, 1)
+    return ids[:, 0]
+
+
+def time_queries(index, probes):
+    top1 = np.empty(len(probes), dtype=np.int64)
+    latencies = np.empty(len(probes))
+    for i in range(len(probes)):
+        start = time.perf_counter()
+        ids, _ = index.search(probes[i:i + 1], 1)
+        latencies[i] = time.perf_counter() - start
+        top1[i] = ids[0, 0]
+    return top1, latencies
+
+
+def report(label, size, build_seconds, top1, truth, latencies):
+    recall = float(np.mean(top1 == truth))
+    p50, p99 = np.percentile(latencies, [50, 99]) * 1000
+    print(f"{size:>9} {label:<16} build {build_seconds:7.2f}s  recall@1 {recall:.3f}  "
+          f"p50 {p50:7.3f} ms  p99 {p99:7.3f} ms")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--sizes', default='10000,100000,1000000', help="Comma-separated gallery sizes")
+    parser.add_argument('--queries', type=int, default=200, help="Probes per gallery size")
+    parser.add_argument('--nprobe', default='1,4,16', help="Comma-separated IVF nprobe values to sweep")
+    parser.add_argument('--nlist', type=int, default=None, help="IVF cell count (default sqrt(size))")
+    parser.add_argument('--noise', type=float, default=0.05, help="Probe noise around the true gallery row")
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+
+    rng = np.random.default_rng(args.seed)
+    sizes = [int(s) for s in args.sizes.split(',')]
+    nprobes = [int(n) for n in args.nprobe.split(',')]
+
+    print(f"{'size':>9} {'backend':<16}")
+    for size in sizes:
+        gallery = synthetic_gallery(size, rng)
+        probes = synthetic_probes(gallery, min(args.queries, size), args.noise, rng)
+        truth = exact_top1(gallery, probes)
+
+        start = time.perf_counter()
+        brute = BruteForceIndex().build(gallery)
+        build_seconds = time.perf_counter() - start
+        top1, latencies = time_queries(brute, probes)
+        report('brute', size, build_seconds, top1, truth, latencies)
+
+        start = time.perf_counter()
+        ivf = IVFIndex(nlist=args.nlist, seed=args.seed).build(gallery)
+        build_seconds = time.perf_counter() - start
+        for nprobe in nprobes:
+            ivf.nprobe = nprobe
+            top1, latencies = time_queries(ivf, probes)
+            report(f'ivf nprobe={nprobe}', size, build_seconds, top1, truth, latencies)
+
+
+if __name__ == '__main__':
+    main()
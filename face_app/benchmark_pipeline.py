@@ -0,0 +1,293 @@
+"""
+Reproducible offline benchmark of the recognition pipeline.
+
+Replays the sample images in faces/ - and seeded synthetic variants at several
+resolutions and face counts, with brightness, noise and mirroring jitter -
+through the two ways frames reach the pipeline:
+
+  direct    app.process_image_for_recognition in this process
+            (detection, encoding, gallery match and sign-in decision)
+  socketio  the Socket.IO 'process_frame' handler through Flask-SocketIO's test
+            client: binary JPEG transport, the recognition pool and the
+            ready_for_frame credit loop, one frame in flight at a time
+
+Each scenario (path x resolution x face count) reports throughput, p50/p95/p99
+frame latency, per-stage latency from the app's metrics and resident memory of
+the server and its recognition workers. --save-baseline writes the results as
+JSON; --baseline compares against such a file and exits with status 1 when
+throughput drops or p95 latency or memory grows by more than --tolerance.
+
+Usage:
+    python benchmark_pipeline.py
+    python benchmark_pipeline.py --save-baseline benchmarks/baseline.json
+    python benchmark_pipeline.py --baseline benchmarks/baseline.json --tolerance 0.15
+    python benchmark_pipeline.py --paths socketio --resolutions 640x480 --faces 1 --workers 2
+"""
+import argparse
+import contextlib
+import json
+import math
+import os
+import platform
+import resource
+import sys
+import time
+
+import cv2
+import numpy as np
+
+FACES_DIR = 'faces'
+IMAGE_EXTENSIONS = ('.jpg', '.jpeg', '.png')
+ORIGINAL = 'original' # Resolution name for the unmodified sample images
+JPEG_QUALITY = 85 # Roughly what the app's camera component sends
+FRAME_TIMEOUT = 30.0 # seconds to wait for the server's reply to one frame
+
+
+def load_faces(directory):
+    images = []
+    for name in sorted(os.listdir(directory)):
+        if name.lower().endswith(IMAGE_EXTENSIONS):
+            image = cv2.imread(os.path.join(directory, name), cv2.IMREAD_COLOR)
+            if image is not None:
+                images.append((name, image))
+    return images
+
+
+def compose(faces, size, rng):
+    """Places `faces` on a grid over a plain background of `size` (width, height)."""
+    width, height = size
+    canvas = np.full((height, width, 3), int(rng.integers(60, 200)), np.uint8)
+    cols = math.ceil(math.sqrt(len(faces)))
+    rows = math.ceil(len(faces) / cols)
+    cell_w, cell_h = width // cols, height // rows
+    for i, face in enumerate(faces):
+        scale = 0.9 * min(cell_w / face.shape[1], cell_h / face.shape[0])
+        resized = cv2.resize(face, (max(1, int(face.shape[1] * scale)), max(1, int(face.shape[0] * scale))),
+                             interpolation=cv2.INTER_AREA)
+        top = (i // cols) * cell_h + (cell_h - resized.shape[0]) // 2
+        left = (i % cols) * cell_w + (cell_w - resized.shape[1]) // 2
+        canvas[top:top + resized.shape[0], left:left + resized.shape[1]] = resized
+    return canvas
+
+
+def jitter(frame, rng):
+    """Camera-like variation: exposure, sensor noise and mirroring."""
+    frame = cv2.convertScaleAbs(frame, alpha=rng.uniform(0.75, 1.25), beta=rng.uniform(-20, 20))
+    noise = rng.normal(0, rng.uniform(0, 6), frame.shape)
+    frame = np.clip(frame.astype(np.float32) + noise, 0, 255).astype(np.uint8)
+    return cv2.flip(frame, 1) if rng.random() < 0.5 else frame
+
+
+def scenario_frames(faces, resolution, face_count, frames, seed):
+    """The same frames for the same arguments on every run."""
+    if resolution == ORIGINAL:
+        return [image for _, image in faces][:frames] if face_count == 1 else []
+    width, height = (int(v) for v in resolution.split('x'))
+    rng = np.random.default_rng([seed, width, height, face_count])
+    variants = []
+    for _ in range(frames):
+        picked = [faces[i][1] for i in rng.integers(0, len(faces), face_count)]
+        variants.append(jitter(compose(picked, (width, height), rng), rng))
+    return variants
+
+
+def rss_mb(pid='self'):
+    try:
+        with open(f'/proc/{pid}/statm') as f:
+            return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE') / 2 ** 20
+    except (OSError, ValueError):
+        return 0.0
+
+
+def memory_report(app):
+    workers = sum(rss_mb(pid) for pid in app.recognition_pool.worker_pids())
+    server = rss_mb()
+    return {
+        "server_rss_mb": round(server, 1),
+        "workers_rss_mb": round(workers, 1),
+        "peak_rss_mb": round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.0, 1), # KiB on Linux
+    }
+
+
+def run_direct(app, frames, warmup):
+    state = app.FaceDetectionState('benchmark-direct')
+    latencies = []
+    for i, frame in enumerate(frames[:warmup] + frames):
+        if i == warmup:
+            app.metrics.reset()
+        if state.is_complete():
+            state.reset()
+        started = time.perf_counter()
+        app.process_image_for_recognition(frame, state)
+        if i >= warmup:
+            latencies.append(time.perf_counter() - started)
+    return latencies
+
+
+def wait_for_reply(client):
+    """Returns the event names received until the server is ready for the next frame."""
+    deadline = time.perf_counter() + FRAME_TIMEOUT
+    names = []
+    while time.perf_counter() < deadline:
+        names += [message['name'] for message in client.get_received()]
+        if any(name in ('ready_for_frame', 'recognition_complete', 'error', 'server_overloaded') for name in names):
+            return names
+        time.sleep(0.0005)
+    raise TimeoutError(f"No reply to a frame within {FRAME_TIMEOUT}s")
+
+
+def run_socketio(app, frames, warmup):
+    jpegs = [cv2.imencode('.jpg', frame, [cv2.IMWRITE_JPEG_QUALITY, JPEG_QUALITY])[1].tobytes() for frame in frames]
+    client = app.socketio.test_client(app.app)
+    client.emit('start_recognition')
+    wait_for_reply(client)
+    latencies = []
+    try:
+        for i, jpeg in enumerate(jpegs[:warmup] + jpegs):
+            if i == warmup:
+                app.metrics.reset()
+            started = time.perf_counter()
+            client.emit('process_frame', {'image': jpeg})
+            names = wait_for_reply(client)
+            if i >= warmup:
+                latencies.append(time.perf_counter() - started)
+            if 'recognition_complete' in names:
+                client.emit('start_recognition') # Next attempt, as the kiosk does
+                wait_for_reply(client)
+    finally:
+        client.disconnect()
+    return latencies
+
+
+PATHS = {'direct': run_direct, 'socketio': run_socketio}
+
+
+def summarize(app, latencies):
+    ms = np.array(latencies) * 1000.0
+    p50, p95, p99 = np.percentile(ms, [50, 95, 99])
+    return {
+        "frames": len(ms),
+        "fps": round(len(ms) / (ms.sum() / 1000.0), 2),
+        "latency_ms": {"p50": round(p50, 3), "p95": round(p95, 3), "p99": round(p99, 3),
+                       "mean": round(float(ms.mean()), 3)},
+        "stages_ms": app.metrics.stages(),
+        "memory": memory_report(app),
+    }
+
+
+def compare(results, baseline, tolerance, min_delta_ms):
+    """Returns the regressions of `results` against `baseline` as readable strings."""
+    regressions = []
+    for name, current in results["scenarios"].items():
+        base = baseline["scenarios"].get(name)
+        if base is None:
+            continue
+        if current["fps"] < base["fps"] * (1 - tolerance):
+            regressions.append(f"{name}: throughput {current['fps']} fps < baseline {base['fps']} fps")
+        p95, base_p95 = current["latency_ms"]["p95"], base["latency_ms"]["p95"]
+        if p95 > base_p95 * (1 + tolerance) and p95 - base_p95 > min_delta_ms:
+            regressions.append(f"{name}: p95 latency {p95} ms > baseline {base_p95} ms")
+        for key in ("server_rss_mb", "workers_rss_mb"):
+            used, base_used = current["memory"][key], base["memory"].get(key, 0.0)
+            if base_used and used > base_used * (1 + tolerance):
+                regressions.append(f"{name}: {key} {used} > baseline {base_used}")
+    return regressions
+
+
+def report(name, summary):
+    latency = summary["latency_ms"]
+    stages = ", ".join(f"{stage} {s['p50']:.1f}" for stage, s in summary["stages_ms"].items())
+    print(f"{name:<28} {summary['fps']:8.2f} fps  p50 {latency['p50']:8.2f}  p95 {latency['p95']:8.2f}  "
+          f"p99 {latency['p99']:8.2f} ms  rss {summary['memory']['server_rss_mb']:.0f}"
+          f"+{summary['memory']['workers_rss_mb']:.0f} MB")
+    print(f"{'':<28} stage p50 ms: {stages}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--paths', default='direct,socketio', help="Comma-separated: direct, socketio")
+    parser.add_argument('--resolutions', default=f'{ORIGINAL},320x240,640x480,1280x720',
+                        help=f"Comma-separated WIDTHxHEIGHT values, or '{ORIGINAL}' for the images as they are")
+    parser.add_argument('--faces', default='1,2,4', help="Comma-separated faces per synthetic frame")
+    parser.add_argument('--frames', type=int, default=30, help="Measured frames per scenario")
+    parser.add_argument('--warmup', type=int, default=3, help="Unmeasured frames before each scenario")
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--workers', type=int, default=None, help="RECOGNITION_WORKERS for the socketio path")
+    parser.add_argument('--save-baseline', metavar='PATH', help="Write the results to this JSON file")
+    parser.add_argument('--baseline', metavar='PATH', help="Compare against this JSON file; exit 1 on regressions")
+    parser.add_argument('--tolerance', type=float, default=0.15, help="Allowed relative regression")
+    parser.add_argument('--min-delta-ms', type=float, default=1.0,
+                        help="Ignore latency regressions smaller than this (timer noise)")
+    parser.add_argument('--verbose', action='store_true', help="Keep the server's per-frame log output")
+    args = parser.parse_args()
+
+    # The app resolves faces/ and its configuration at import time
+    os.chdir(os.path.dirname(os.path.abspath(__file__)))
+    if args.workers is not None:
+        os.environ['RECOGNITION_WORKERS'] = str(args.workers)
+    os.environ['METRICS_ENABLED'] = '1'
+    import app
+
+    faces = load_faces(FACES_DIR)
+    if not faces:
+        sys.exit(f"No images found in {FACES_DIR}/")
+
+    results = {
+        "meta": {
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "cpus": os.cpu_count(),
+            "opencv": cv2.__version__,
+            "numpy": np.__version__,
+            "detector": repr(app.face_detector),
+            "workers": app.RECOGNITION_WORKERS,
+            "batch_size": app.RECOGNITION_BATCH_SIZE,
+            "images": [name for name, _ in faces],
+            "frames": args.frames,
+            "warmup": args.warmup,
+            "seed": args.seed,
+        },
+        "scenarios": {},
+    }
+    results["meta"]["startup"] = app.startup()
+    results["meta"]["gallery_size"] = len(app.gallery)
+    quiet = contextlib.nullcontext() if args.verbose else contextlib.redirect_stdout(open(os.devnull, 'w'))
+
+    try:
+        for path in args.paths.split(','):
+            for resolution in args.resolutions.split(','):
+                for face_count in (int(n) for n in args.faces.split(',')):
+                    frames = scenario_frames(faces, resolution, face_count, args.frames, args.seed)
+                    if not frames:
+                        continue
+                    with quiet:
+                        latencies = PATHS[path](app, frames, min(args.warmup, len(frames)))
+                    name = f"{path} {resolution} x{face_count}"
+                    results["scenarios"][name] = summarize(app, latencies)
+                    report(name, results["scenarios"][name])
+    finally:
+        app.recognition_pool.shutdown()
+
+    if args.save_baseline:
+        os.makedirs(os.path.dirname(os.path.abspath(args.save_baseline)), exist_ok=True)
+        with open(args.save_baseline, 'w') as f:
+            json.dump(results, f, indent=2)
+        print(f"Baseline written to {args.save_baseline}")
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        if baseline["meta"].get("cpus") != results["meta"]["cpus"] or \
+                baseline["meta"].get("detector") != results["meta"]["detector"]:
+            print("Warning: baseline was recorded with a different CPU count or detector")
+        regressions = compare(results, baseline, args.tolerance, args.min_delta_ms)
+        if regressions:
+            print(f"{len(regressions)} regression(s) beyond {args.tolerance:.0%}:")
+            for regression in regressions:
+                print(f"  {regression}")
+            sys.exit(1)
+        print(f"No regressions beyond {args.tolerance:.0%} against {args.baseline}")
+
+
+if __name__ == '__main__':
+    main()
@@ -2,7 +2,8 @@ print("Starting the training image capture process...")
 import cv2
 import face_recognition
 import os
-import numpy as np
+from gallery import select_templates
+from gallery_store import GalleryStore, migrate_legacy
 print("Starting the training image capture process...")
 
 # Create a directory to store training images if it doesn't exist
@@ -26,8 +27,11 @@ if not cap.isOpened():
 
 print("\n--- Training Image Capture ---")
 print(f"Capturing image for: {name}")
-print("Press 'c' to CAPTURE the image.")
-print("Press 'q' to QUIT without capturing.")
+print("Press 'c' to CAPTURE an image (repeat with different lighting/poses for better recognition).")
+print("Press 's' to SAVE the captured templates and exit.")
+print("Press 'q' to QUIT without saving.")
+
+templates = []
 
 while True:
     success, frame = cap.read()
@@ -42,24 +46,38 @@ while True:
 
     # Capture the frame when 'c' is pressed
     if key == ord('c'):
-        img_path = os.path.join(output_folder, f'{name}.jpg')
-        cv2.imwrite(img_path, frame)  # Save the original frame
-        print(f"Image saved at: {img_path}")
-
         # Convert the frame to RGB and find encodings
         img_rgb = cv2.cvtColor(frame, cv2.COLOR_BGR2RGB)
         encodings = face_recognition.face_encodings(img_rgb)
 
         if encodings:
-            # Save the face encoding as a numpy array
-            np.save(os.path.join(output_folder, f'{name}_encoding.npy'), encodings[0])
-            print(f"Encoding saved for {name}")
-            print("Image and encoding saved. You can now run the real-time recognition script.")
-            break # Exit after successful capture and encoding
+            if not templates:
+                img_path = os.path.join(output_folder, f'{name}.jpg')
+                cv2.imwrite(img_path, frame)  # Save the first good frame
+                print(f"Image saved at: {img_path}")
+            templates.append(encodings[0])
+            print(f"Template {len(templates)} captured for {name}. Press 'c' for another or 's' to save.")
         else:
             print("No face detected in the captured image. Please try again with your face clearly visible.")
             # Do not break, allow user to try again
-            
+
+    # Save all captured templates when 's' is pressed
+    elif key == ord('s'):
+        if not templates:
+            print("Nothing captured yet. Press 'c' to capture an image first.")
+            continue
+        # Drop near-duplicate captures, then append the templates to the gallery store
+        kept = select_templates(templates)
+        store = GalleryStore(os.path.join(output_folder, 'gallery'))
+        if not store.exists():
+            # Same first-start migration as the server, so legacy enrolments are not shadowed
+            migrated = migrate_legacy(output_folder, store)
+            print(f"Migrated {len(migrated)} legacy encodings into {store.root}")
+        store.append(name, kept)
+        print(f"{len(kept)} template(s) saved for {name}")
+        print("Image and encodings saved. You can now run the real-time recognition script.")
+        break
+
     # Exit the loop when 'q' is pressed
     elif key == ord('q'):
         print("Exiting capture process.")
@@ -0,0 +1,16 @@
+import importlib
+import os
+
+import pytest
+
+
+@pytest.fixture(scope='session')
+def server(tmp_path_factory):
+    """The app module, recognising inline (no worker processes) with its faces/ directory in a temp dir."""
+    os.environ['RECOGNITION_WORKERS'] = '0'
+    cwd = os.getcwd()
+    os.chdir(tmp_path_factory.mktemp('server'))
+    try:
+        return importlib.import_module('app')
+    finally:
+        os.chdir(cwd)
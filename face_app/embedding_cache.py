@@ -0,0 +1,134 @@
+"""
+Caches that let near-duplicate frames skip the face encoding.
+
+A kiosk user standing still sends nearly identical frames, so the face crop is
+keyed by a perceptual hash (dHash of the downscaled grayscale crop): frames
+whose crops differ only by sensor noise or compression hash within a few bits
+of each other. A cache hit returns the encoding computed for the earlier
+frame, skipping landmarks and the dlib network entirely.
+
+Entries expire after `ttl` seconds and the least recently used entry is
+evicted beyond `max_entries`. With `max_distance` > 0 a lookup that misses
+the exact hash falls back to the nearest stored hash within that many
+differing bits (a linear scan, so keep such caches small).
+"""
+import threading
+import time
+from collections import OrderedDict
+
+import cv2
+import numpy as np
+
+# 16x16 gradient bits -> 256-bit hash: long enough that crops of two different
+# people essentially never share a hash, while noise only flips a few bits
+HASH_SIZE = 16
+
+
+def face_hash(rgb_image, box, hash_size=HASH_SIZE):
+    """dHash of the face crop `box` (top, right, bottom, left) as an int."""
+    top, right, bottom, left = box
+    crop = rgb_image[top:bottom, left:right]
+    if crop.size == 0:
+        return None
+    gray = cv2.cvtColor(crop, cv2.COLOR_RGB2GRAY)
+    small = cv2.resize(gray, (hash_size + 1, hash_size), interpolation=cv2.INTER_AREA)
+    bits = small[:, 1:] > small[:, :-1]
+    return int.from_bytes(np.packbits(bits).tobytes(), 'big')
+
+
+def hamming(a, b):
+    return bin(a ^ b).count('1')
+
+
+class EmbeddingCache:
+    def __init__(self, max_entries=64, ttl=10.0, max_distance=0):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.max_distance = max_distance
+        self._entries = OrderedDict() # key -> (stored_at, value), least recently used first
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.near_hits = 0 # Hits on a different hash within max_distance bits
+        self.misses = 0
+        self.expirations = 0
+        self.evictions = 0
+
+    def __getstate__(self):
+        # Session caches travel to worker processes with their frames
+        state = self.__dict__.copy()
+        del state['_lock']
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def lookup(self, key, now=None):
+        """Returns (stored key, value) for `key` or its nearest near-duplicate, else None."""
+        if key is None:
+            return None
+        now = time.monotonic() if now is None else now
+        with self._lock:
+            found = key if key in self._entries else self._nearest(key)
+            if found is not None:
+                stored_at, value = self._entries[found]
+                if now - stored_at > self.ttl:
+                    del self._entries[found]
+                    self.expirations += 1
+                    found = None
+            if found is None:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(found)
+            if found == key:
+                self.hits += 1
+            else:
+                self.near_hits += 1
+            return found, value
+
+    def get(self, key, now=None):
+        entry = self.lookup(key, now)
+        return entry[1] if entry is not None else None
+
+    def put(self, key, value, now=None):
+        if key is None or self.max_entries <= 0:
+            return
+        now = time.monotonic() if now is None else now
+        with self._lock:
+            self._entries[key] = (now, value)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+                self.evictions += 1
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def _nearest(self, key):
+        if self.max_distance <= 0 or not isinstance(key, int):
+            return None
+        best, best_distance = None, self.max_distance + 1
+        for stored in self._entries:
+            distance = hamming(key, stored)
+            if distance < best_distance:
+                best, best_distance = stored, distance
+        return best
+
+    def stats(self):
+        with self._lock:
+            lookups = self.hits + self.near_hits + self.misses
+            return {
+                "entries": len(self._entries),
+                "max_entries": self.max_entries,
+                "ttl": self.ttl,
+                "hits": self.hits,
+                "near_hits": self.near_hits,
+                "misses": self.misses,
+                "hit_rate": (self.hits + self.near_hits) / lookups if lookups else 0.0,
+                "expirations": self.expirations,
+                "evictions": self.evictions,
+            }
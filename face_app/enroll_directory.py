@@ -0,0 +1,181 @@
+"""
+Headless bulk enrolment from a directory tree of photos.
+
+    photos/
+      alice/          one identity per sub-directory (any depth below it) ...
+        badge.jpg
+        2023.png
+      bob.jpg         ... or one file per identity in the root, named after it
+
+Every file is hashed first: images whose SHA-256 content hash is already
+enrolled, or that repeat earlier in the same run, are skipped without being
+decoded, and so are images filed under a name the gallery cannot store. The
+rest are decoded, detected and encoded across all cores with a process pool,
+using the same detector configuration as the server (FACE_DETECTOR,
+HOG_UPSAMPLE, ...). An image must show exactly one face; unreadable images
+and images with no or several faces are reported as rejects (--report writes
+them as CSV).
+
+Each identity's new templates are merged with those already stored,
+de-duplicated and capped like /train_face, and the whole import is written to
+the gallery store as one new generation - it becomes visible all at once or
+not at all. A running server keeps its in-memory gallery until it restarts.
+
+Usage:
+    python enroll_directory.py photos/
+    python enroll_directory.py photos/ --workers 8 --report rejects.csv
+    python enroll_directory.py photos/ --dry-run
+"""
+import argparse
+import csv
+import hashlib
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+import cv2
+import numpy as np
+
+from face_detectors import detector_from_env
+from frame_pipeline import ENROLL_MAX_SIDE, encode_photo
+from gallery import select_templates
+from gallery_store import GalleryStore, check_name, migrate_legacy
+
+IMAGE_EXTENSIONS = ('.jpg', '.jpeg', '.png', '.bmp', '.webp')
+INVALID_NAME = 'invalid_name'
+
+_detector = None # Per-process detector, created by _init_worker
+
+
+def find_images(root):
+    """Yields (name, path): sub-directories name their identity, root files name themselves."""
+    for entry in sorted(os.listdir(root)):
+        path = os.path.join(root, entry)
+        if os.path.isdir(path):
+            for directory, _, files in sorted(os.walk(path)):
+                for file in sorted(files):
+                    if file.lower().endswith(IMAGE_EXTENSIONS):
+                        yield entry, os.path.join(directory, file)
+        elif entry.lower().endswith(IMAGE_EXTENSIONS):
+            yield os.path.splitext(entry)[0], path
+
+
+def content_hash(path):
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(1 << 20), b''):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def _init_worker():
+    global _detector
+    _detector = detector_from_env()
+
+
+def encode_image(path, max_side=ENROLL_MAX_SIDE, num_jitters=1):
+    """Worker: returns (status, detail, encoding or None) for one image file."""
+    return encode_photo(cv2.imread(path, cv2.IMREAD_COLOR), _detector, max_side, num_jitters)
+
+
+def stored_templates(store):
+    encodings, names = store.read_all()
+    by_name = {}
+    for name, encoding in zip(names, encodings):
+        by_name.setdefault(name, []).append(np.array(encoding))
+    return by_name
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('directory', help="Directory tree of photos to enrol")
+    parser.add_argument('--faces', default='faces', help="The server's faces directory")
+    parser.add_argument('--store', default=None, help="Gallery store directory (default <faces>/gallery)")
+    parser.add_argument('--workers', type=int, default=os.cpu_count() or 1)
+    parser.add_argument('--max-templates', type=int,
+                        default=int(os.environ.get('MAX_TEMPLATES_PER_IDENTITY', '10')),
+                        help="Templates kept per identity, as MAX_TEMPLATES_PER_IDENTITY on the server")
+    parser.add_argument('--max-side', type=int, default=ENROLL_MAX_SIDE,
+                        help="Larger photos are downscaled to this many pixels before detection")
+    parser.add_argument('--jitters', type=int, default=1, help="dlib num_jitters per encoding (slower, steadier)")
+    parser.add_argument('--replace', action='store_true',
+                        help="Replace an identity's stored templates instead of adding to them")
+    parser.add_argument('--report', metavar='PATH', help="Write rejected images as CSV")
+    parser.add_argument('--dry-run', action='store_true', help="Encode and report, but do not write the gallery")
+    args = parser.parse_args()
+
+    store = GalleryStore(args.store or os.path.join(args.faces, 'gallery'))
+    if not store.exists():
+        # Same first-start migration as the server, so legacy enrolments are not shadowed
+        migrated = migrate_legacy(args.faces, store)
+        print(f"Migrated {len(migrated)} legacy encodings into {store.root}")
+
+    started = time.perf_counter()
+    enrolled_names = set(store.read_all()[1])
+    # Hashes of removed identities no longer count as enrolled
+    enrolled = {digest for digest, name in store.sources().items() if name in enrolled_names}
+    seen, todo, skipped, duplicates, rejects = {}, [], 0, 0, []
+    for name, path in find_images(args.directory):
+        try:
+            check_name(name) # Before encoding, so a bad name cannot waste the whole pass
+        except ValueError as e:
+            rejects.append((path, name, INVALID_NAME, str(e)))
+            continue
+        digest = content_hash(path)
+        if digest in enrolled:
+            skipped += 1
+        elif digest in seen:
+            duplicates += 1
+            if seen[digest] != name:
+                print(f"Warning: {path} is the same image as one filed under '{seen[digest]}'")
+        else:
+            seen[digest] = name
+            todo.append((name, path, digest))
+    print(f"{len(todo)} new image(s), {skipped} already enrolled, {duplicates} duplicate(s) in this run")
+
+    if rejects:
+        print(f"{len(rejects)} image(s) filed under an invalid name will not be enrolled")
+    new_templates, sources = {}, {}
+    with ProcessPoolExecutor(max_workers=max(1, args.workers), initializer=_init_worker) as executor:
+        outputs = executor.map(encode_image, [path for _, path, _ in todo],
+                               [args.max_side] * len(todo), [args.jitters] * len(todo),
+                               chunksize=max(1, min(16, len(todo) // (4 * max(1, args.workers)))))
+        for done, ((name, path, digest), (status, detail, encoding)) in enumerate(zip(todo, outputs), 1):
+            if status == 'ok':
+                new_templates.setdefault(name, []).append(encoding)
+                sources[digest] = name
+            else:
+                rejects.append((path, name, status, detail))
+            if done % 100 == 0 or done == len(todo):
+                elapsed = time.perf_counter() - started
+                print(f"  {done}/{len(todo)} images, {len(rejects)} rejected ({done / elapsed:.1f} images/s)")
+
+    existing = {} if args.replace else stored_templates(store)
+    templates = {
+        name: select_templates(existing.get(name, []) + encodings, max_templates=args.max_templates)
+        for name, encodings in new_templates.items()
+    }
+
+    by_reason = {}
+    for _, _, status, _ in rejects:
+        by_reason[status] = by_reason.get(status, 0) + 1
+    print(f"Encoded {len(sources)} image(s) for {len(templates)} identit{'y' if len(templates) == 1 else 'ies'}; "
+          f"rejected {len(rejects)} {by_reason or ''}")
+    if args.report and rejects:
+        with open(args.report, 'w', newline='') as f:
+            writer = csv.writer(f)
+            writer.writerow(['path', 'name', 'reason', 'detail'])
+            writer.writerows(rejects)
+        print(f"Rejects written to {args.report}")
+
+    if args.dry_run:
+        print("Dry run: gallery not changed")
+    elif templates:
+        store.bulk_upsert(templates, sources)
+        print(f"Wrote {sum(len(t) for t in templates.values())} template(s) for {len(templates)} "
+              f"identities to '{store.root}' in {time.perf_counter() - started:.1f}s. "
+              f"Restart the server to load them.")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,284 @@
+"""
+Face detector backends.
+
+A detector is a callable taking an RGB uint8 image and returning face boxes in
+face_recognition's (top, right, bottom, left) order, so any of them can be
+passed as `FramePipeline(detect=...)` or to `FaceTracker.locate`. Each one
+also reports `min_face`, the smallest face (in pixels) it finds reliably,
+which the pipeline uses to pick its detection scale.
+
+  hog     - dlib HOG through face_recognition (default)
+  cnn     - dlib CNN (mmod) through face_recognition; best recall, slow without a GPU
+  haar    - OpenCV Haar cascade (bundled with the opencv-python 4.x wheels)
+  lbp     - OpenCV LBP cascade; faster than Haar, needs a local cascade XML file
+  dnn     - OpenCV DNN res10 300x300 SSD from local Caffe model files
+  cascade - a cheap `screen` detector runs on the whole frame; the expensive
+            `confirm` detector then only runs around its candidates, and a
+            frame without candidates costs just the screening pass
+
+`upsample` is the per-backend number_of_times_to_upsample: dlib backends pass
+it through, OpenCV backends enlarge the image 2x per step. Each step halves
+`min_face` and roughly quadruples the detection cost.
+
+Models are loaded on first use, so detectors can be created at import time
+and sent to a process pool. That includes dlib's: importing face_recognition
+loads all of its models (about a second and ~100 MB), so it is imported inside
+the functions that need it rather than at module level.
+"""
+import os
+
+import cv2
+import numpy as np
+
+from face_tracking import expand_box
+
+MODELS_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'models')
+DNN_PROTOTXT = 'deploy.prototxt'
+DNN_WEIGHTS = 'res10_300x300_ssd_iter_140000.caffemodel'
+LBP_CASCADE = 'lbpcascade_frontalface_improved.xml'
+
+
+class _Detector:
+    name = None
+    base_min_face = 80
+
+    def __init__(self, upsample=0):
+        self.upsample = upsample
+
+    @property
+    def min_face(self):
+        return self.base_min_face / (2 ** self.upsample)
+
+    def __repr__(self):
+        return f"{type(self).__name__}(upsample={self.upsample})"
+
+
+class HOGDetector(_Detector):
+    name = 'hog'
+    base_min_face = 80 # dlib's 80x80 HOG window
+
+    def __call__(self, rgb_image):
+        import face_recognition
+        return face_recognition.face_locations(rgb_image, number_of_times_to_upsample=self.upsample, model='hog')
+
+
+class CNNDetector(_Detector):
+    name = 'cnn'
+    base_min_face = 40 # dlib's mmod face detector window
+
+    def __call__(self, rgb_image):
+        import face_recognition
+        return face_recognition.face_locations(rgb_image, number_of_times_to_upsample=self.upsample, model='cnn')
+
+
+class _OpenCVDetector(_Detector):
+    """Shared upsampling and lazy model loading; the loaded model is never pickled."""
+
+    def __init__(self, upsample=0):
+        super().__init__(upsample)
+        self._model = None
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state['_model'] = None
+        return state
+
+    def __call__(self, rgb_image):
+        if self._model is None:
+            self._model = self._load()
+        factor = 2 ** self.upsample
+        if factor > 1:
+            rgb_image = cv2.resize(rgb_image, (0, 0), fx=factor, fy=factor, interpolation=cv2.INTER_LINEAR)
+        boxes = self._detect(rgb_image)
+        if factor > 1:
+            boxes = [tuple(int(v / factor) for v in box) for box in boxes]
+        return boxes
+
+    def _load(self):
+        raise NotImplementedError
+
+    def _detect(self, rgb_image):
+        raise NotImplementedError
+
+
+class HaarDetector(_OpenCVDetector):
+    name = 'haar'
+
+    def __init__(self, upsample=0, cascade_path=None, scale_factor=1.1, min_neighbors=5, min_size=30):
+        super().__init__(upsample)
+        self.cascade_path = cascade_path or self.default_cascade()
+        if not self.cascade_path or not os.path.exists(self.cascade_path):
+            raise FileNotFoundError(f"{self.name} cascade file not found: {self.cascade_path}")
+        self.scale_factor = scale_factor
+        self.min_neighbors = min_neighbors
+        self.min_size = min_size
+        self.base_min_face = min_size
+
+    def _load(self):
+        return cv2.CascadeClassifier(self.cascade_path)
+
+    def _detect(self, rgb_image):
+        gray = cv2.equalizeHist(cv2.cvtColor(rgb_image, cv2.COLOR_RGB2GRAY))
+        faces = self._model.detectMultiScale(
+            gray, scaleFactor=self.scale_factor, minNeighbors=self.min_neighbors,
+            minSize=(self.min_size, self.min_size),
+        )
+        return [(int(y), int(x + w), int(y + h), int(x)) for x, y, w, h in faces]
+
+    @staticmethod
+    def default_cascade():
+        data = getattr(cv2, 'data', None) # Bundled with the opencv-python 4.x wheels
+        if data is None or not hasattr(data, 'haarcascades'):
+            return None
+        return os.path.join(data.haarcascades, 'haarcascade_frontalface_default.xml')
+
+
+class LBPDetector(HaarDetector):
+    name = 'lbp'
+
+    @staticmethod
+    def default_cascade():
+        # Not shipped with the opencv-python wheels; copy it from OpenCV's data/lbpcascades
+        return os.path.join(MODELS_DIR, LBP_CASCADE)
+
+
+class DNNDetector(_OpenCVDetector):
+    name = 'dnn'
+    base_min_face = 40 # Faces much smaller than this are lost in the 300x300 input
+
+    def __init__(self, upsample=0, model_dir=MODELS_DIR, confidence=0.5, input_size=300):
+        super().__init__(upsample)
+        self.prototxt = os.path.join(model_dir, DNN_PROTOTXT)
+        self.weights = os.path.join(model_dir, DNN_WEIGHTS)
+        for path in (self.prototxt, self.weights):
+            if not os.path.exists(path):
+                raise FileNotFoundError(f"DNN face detector model file not found: {path}")
+        self.confidence = confidence
+        self.input_size = input_size
+
+    def _load(self):
+        return cv2.dnn.readNetFromCaffe(self.prototxt, self.weights)
+
+    def _detect(self, rgb_image):
+        height, width = rgb_image.shape[:2]
+        size = (self.input_size, self.input_size)
+        # The model was trained on BGR input with these channel means
+        blob = cv2.dnn.blobFromImage(cv2.resize(rgb_image, size), 1.0, size, (104.0, 177.0, 123.0), swapRB=True)
+        self._model.setInput(blob)
+        detections = self._model.forward()[0, 0]
+        boxes = []
+        for detection in detections[detections[:, 2] >= self.confidence]:
+            left, top, right, bottom = (detection[3:7] * [width, height, width, height]).astype(int)
+            top, left = max(0, top), max(0, left)
+            bottom, right = min(height, bottom), min(width, right)
+            if bottom > top and right > left:
+                boxes.append((int(top), int(right), int(bottom), int(left)))
+        return boxes
+
+
+class CascadeDetector:
+    """Runs `confirm` only inside the (expanded) candidate boxes found by `screen`."""
+    name = 'cascade'
+
+    def __init__(self, screen, confirm, expansion=0.5, min_overlap=0.5):
+        self.screen = screen
+        self.confirm = confirm
+        self.expansion = expansion # Context around a candidate, as for ROI tracking
+        self.min_overlap = min_overlap # Confirmed boxes overlapping more than this are merged
+        self.screened_frames = 0
+        self.rejected_frames = 0
+
+    @property
+    def min_face(self):
+        return max(self.screen.min_face, self.confirm.min_face)
+
+    def __call__(self, rgb_image):
+        self.screened_frames += 1
+        candidates = self.screen(rgb_image)
+        if not candidates:
+            self.rejected_frames += 1
+            return []
+
+        confirmed = []
+        for candidate in candidates:
+            if any(_overlap(candidate, kept) > self.min_overlap for kept in confirmed):
+                continue # Already confirmed through an overlapping candidate
+            top, right, bottom, left = expand_box(candidate, rgb_image.shape, self.expansion)
+            crop = np.ascontiguousarray(rgb_image[top:bottom, left:right])
+            for t, r, b, l in self.confirm(crop):
+                box = (t + top, r + left, b + top, l + left)
+                if all(_overlap(box, kept) <= self.min_overlap for kept in confirmed):
+                    confirmed.append(box)
+        return confirmed
+
+    def __repr__(self):
+        return f"CascadeDetector(screen={self.screen!r}, confirm={self.confirm!r})"
+
+
+def _overlap(a, b):
+    """Intersection over union of two (top, right, bottom, left) boxes."""
+    height = min(a[2], b[2]) - max(a[0], b[0])
+    width = min(a[1], b[1]) - max(a[3], b[3])
+    if height <= 0 or width <= 0:
+        return 0.0
+    inter = height * width
+    area = lambda box: (box[2] - box[0]) * (box[1] - box[3])
+    return inter / float(area(a) + area(b) - inter)
+
+
+DETECTOR_BACKENDS = {
+    HOGDetector.name: HOGDetector,
+    CNNDetector.name: CNNDetector,
+    HaarDetector.name: HaarDetector,
+    LBPDetector.name: LBPDetector,
+    DNNDetector.name: DNNDetector,
+}
+
+
+def make_detector(kind='hog', screen='haar', confirm='hog', screen_options=None, confirm_options=None, **options):
+    """
+    Builds a detector by name. For kind='cascade', `screen` and `confirm` name
+    the two stages and `screen_options` / `confirm_options` configure them.
+    """
+    if kind == CascadeDetector.name:
+        return CascadeDetector(
+            make_detector(screen, **(screen_options or {})),
+            make_detector(confirm, **(confirm_options or {})),
+            **options,
+        )
+    try:
+        backend = DETECTOR_BACKENDS[kind]
+    except KeyError:
+        expected = sorted(DETECTOR_BACKENDS) + [CascadeDetector.name]
+        raise ValueError(f"Unknown face detector '{kind}', expected one of {expected}")
+    return backend(**options)
+
+
+def detector_from_env(environ=os.environ):
+    """
+    Builds the detector configured through the environment:
+      FACE_DETECTOR            hog (default), cnn, haar, lbp, dnn or cascade
+      CASCADE_SCREEN_DETECTOR  screening stage of the cascade (default haar)
+      CASCADE_CONFIRM_DETECTOR confirming stage of the cascade (default hog)
+      <BACKEND>_UPSAMPLE       per-backend upsampling, e.g. HOG_UPSAMPLE=1
+      HAAR_CASCADE_PATH, LBP_CASCADE_PATH, DNN_MODEL_DIR, DNN_CONFIDENCE
+    """
+    def options_for(kind):
+        options = {}
+        upsample = environ.get(f'{kind.upper()}_UPSAMPLE')
+        if upsample is not None:
+            options['upsample'] = int(upsample)
+        if kind in ('haar', 'lbp') and environ.get(f'{kind.upper()}_CASCADE_PATH'):
+            options['cascade_path'] = environ[f'{kind.upper()}_CASCADE_PATH']
+        if kind == 'dnn':
+            options['model_dir'] = environ.get('DNN_MODEL_DIR', MODELS_DIR)
+            options['confidence'] = float(environ.get('DNN_CONFIDENCE', '0.5'))
+        return options
+
+    kind = environ.get('FACE_DETECTOR', 'hog')
+    if kind == CascadeDetector.name:
+        screen = environ.get('CASCADE_SCREEN_DETECTOR', 'haar')
+        confirm = environ.get('CASCADE_CONFIRM_DETECTOR', 'hog')
+        return make_detector(kind, screen=screen, confirm=confirm,
+                             screen_options=options_for(screen), confirm_options=options_for(confirm))
+    return make_detector(kind, **options_for(kind))
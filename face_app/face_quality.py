@@ -0,0 +1,124 @@
+"""
+Pre-encoding face quality gate.
+
+The 128-d encoding is the most expensive step per face, and a face that is too
+small, blurred, badly lit or turned away mostly produces an "Unknown" vote
+that costs the user a retry. `QualityGate` rejects such faces before they are
+encoded, from measures that are cheap next to the encoding itself:
+
+  too_small   - face box narrower than `min_face` pixels in the original frame
+  too_dark    - mean brightness of the face crop below `min_brightness` (0-255)
+  too_bright  - mean brightness above `max_brightness`
+  blurry      - variance of the Laplacian of the face crop below `min_sharpness`;
+                the crop is resized to CROP_SIZE first, so the threshold does not
+                depend on the face's resolution
+  turned_away - yaw estimated from the landmarks above `max_yaw` degrees; the
+                landmarks are the ones the encoder computes anyway
+
+Each check returns (reason or None, measures). They run cheapest first, and a
+threshold of 0 (None for max_yaw) switches a check off. `HINTS` holds a short
+message per reason that a client can show to coach the user.
+"""
+import math
+
+import cv2
+import numpy as np
+
+TOO_SMALL = 'too_small'
+TOO_DARK = 'too_dark'
+TOO_BRIGHT = 'too_bright'
+BLURRY = 'blurry'
+TURNED_AWAY = 'turned_away'
+
+HINTS = {
+    TOO_SMALL: "Move closer to the camera",
+    TOO_DARK: "Find more light on your face",
+    TOO_BRIGHT: "Avoid direct light on your face",
+    BLURRY: "Hold still",
+    TURNED_AWAY: "Look straight at the camera",
+}
+
+CROP_SIZE = 96 # Side the face crop is resized to before measuring sharpness
+
+# Eye points, nose point and the nose's depth in front of the eyes (in half
+# eye distances) for dlib's 68- and 5-point landmark models. The depth is a
+# typical adult's; the yaw is only a rough estimate, good enough to gate on.
+_POSE_POINTS = {
+    68: (range(36, 42), range(42, 48), 30, 0.7), # Eye contours, nose tip
+    5: ((0, 1), (2, 3), 4, 0.45), # Eye corners, base of the nose
+}
+
+
+class QualityGate:
+    def __init__(self, min_face=64, min_brightness=50, max_brightness=205, min_sharpness=40.0, max_yaw=35.0):
+        self.min_face = min_face
+        self.min_brightness = min_brightness
+        self.max_brightness = max_brightness
+        self.min_sharpness = min_sharpness
+        self.max_yaw = max_yaw
+
+    def __repr__(self):
+        return (f"QualityGate(min_face={self.min_face}, brightness={self.min_brightness}-{self.max_brightness}, "
+                f"min_sharpness={self.min_sharpness}, max_yaw={self.max_yaw})")
+
+    def check_size(self, box):
+        """`box` in original-frame pixels."""
+        top, right, bottom, left = box
+        face_px = min(bottom - top, right - left)
+        if self.min_face and face_px < self.min_face:
+            return TOO_SMALL, {"face_px": face_px}
+        return None, {"face_px": face_px}
+
+    def check_crop(self, rgb_image, box):
+        """Exposure and sharpness of the face crop; `box` in `rgb_image` coordinates."""
+        top, right, bottom, left = box
+        crop = rgb_image[max(0, top):bottom, max(0, left):right]
+        if crop.size == 0:
+            return None, {}
+        gray = cv2.cvtColor(crop, cv2.COLOR_RGB2GRAY)
+        brightness = float(gray.mean())
+        measures = {"brightness": round(brightness, 1)}
+        if self.min_brightness and brightness < self.min_brightness:
+            return TOO_DARK, measures
+        if self.max_brightness and brightness > self.max_brightness:
+            return TOO_BRIGHT, measures
+        if self.min_sharpness:
+            interpolation = cv2.INTER_AREA if gray.shape[0] > CROP_SIZE else cv2.INTER_LINEAR
+            gray = cv2.resize(gray, (CROP_SIZE, CROP_SIZE), interpolation=interpolation)
+            sharpness = float(cv2.Laplacian(gray, cv2.CV_64F).var())
+            measures["sharpness"] = round(sharpness, 1)
+            if sharpness < self.min_sharpness:
+                return BLURRY, measures
+        return None, measures
+
+    def check_pose(self, landmarks):
+        """`landmarks` is a dlib full_object_detection from the 68- or 5-point model."""
+        if self.max_yaw is None:
+            return None, {}
+        yaw = estimate_yaw(landmarks)
+        if yaw is None:
+            return None, {}
+        if abs(yaw) > self.max_yaw:
+            return TURNED_AWAY, {"yaw": round(yaw, 1)}
+        return None, {"yaw": round(yaw, 1)}
+
+
+def estimate_yaw(landmarks):
+    """
+    Degrees the face is turned left or right (sign depends on the model's point
+    order), from how far the nose sits off the midpoint between the eyes, along
+    the eye line so head roll does not count. None for unknown landmark models.
+    """
+    points = _POSE_POINTS.get(landmarks.num_parts)
+    if points is None:
+        return None
+    first_eye, second_eye, nose, depth = points
+    part = lambda i: np.array((landmarks.part(i).x, landmarks.part(i).y), dtype=np.float64)
+    eye_a = np.mean([part(i) for i in first_eye], axis=0)
+    eye_b = np.mean([part(i) for i in second_eye], axis=0)
+    half_distance = np.linalg.norm(eye_b - eye_a) / 2.0
+    if half_distance == 0:
+        return None
+    axis = (eye_b - eye_a) / (2.0 * half_distance)
+    offset = float(np.dot(part(nose) - (eye_a + eye_b) / 2.0, axis))
+    return math.degrees(math.atan(offset / (half_distance * depth)))
@@ -0,0 +1,78 @@
+"""
+Detect-once, track-afterwards face localisation for a stream of frames.
+
+Consecutive frames from one session show the same face in nearly the same
+place, so after a full-frame detection the next frames only run the detector
+inside the last face box expanded by `expansion` on every side. When the face
+is not found there the track is dropped and the same frame is searched again
+in full.
+
+Boxes use face_recognition's (top, right, bottom, left) order.
+"""
+import numpy as np
+
+
+def expand_box(box, frame_shape, expansion):
+    """Grows `box` by `expansion` x its size on each side, clamped to the frame."""
+    top, right, bottom, left = box
+    height, width = frame_shape[:2]
+    pad_y = int((bottom - top) * expansion)
+    pad_x = int((right - left) * expansion)
+    return (
+        max(0, top - pad_y),
+        min(width, right + pad_x),
+        min(height, bottom + pad_y),
+        max(0, left - pad_x),
+    )
+
+
+class FaceTracker:
+    def __init__(self, expansion=0.5, redetect_every=0):
+        self.expansion = expansion
+        self.redetect_every = redetect_every # Force a full-frame pass every N tracked frames (0 = never)
+        self.reset()
+
+    def reset(self):
+        self.last_face_box = None
+        self.frame_shape = None
+        self.tracked_frames = 0
+        self.full_detections = 0
+        self.roi_detections = 0
+        self.lost_tracks = 0
+
+    def locate(self, rgb_frame, detect):
+        """
+        Returns face locations in full-frame coordinates. `detect` is called with
+        an image (the full frame or an ROI crop) and returns face boxes in that
+        image's coordinates.
+        """
+        if rgb_frame.shape[:2] != self.frame_shape:
+            # The box is in the previous frame's coordinates (e.g. a different detection scale)
+            self.last_face_box = None
+            self.frame_shape = rgb_frame.shape[:2]
+
+        due_for_full = self.redetect_every and self.tracked_frames >= self.redetect_every
+        if self.last_face_box is not None and not due_for_full:
+            top, right, bottom, left = expand_box(self.last_face_box, rgb_frame.shape, self.expansion)
+            self.roi_detections += 1
+            # dlib wants a contiguous buffer; the crop copy is small compared to the frame
+            locations = detect(np.ascontiguousarray(rgb_frame[top:bottom, left:right]))
+            if locations:
+                locations = [(t + top, r + left, b + top, l + left) for t, r, b, l in locations]
+                self.last_face_box = locations[0]
+                self.tracked_frames += 1
+                return locations
+            self.lost_tracks += 1 # Face left the ROI; fall back to the whole frame
+
+        self.full_detections += 1
+        self.tracked_frames = 0
+        locations = detect(rgb_frame)
+        self.last_face_box = locations[0] if locations else None
+        return locations
+
+    def stats(self):
+        return {
+            "full_detections": self.full_detections,
+            "roi_detections": self.roi_detections,
+            "lost_tracks": self.lost_tracks,
+        }
@@ -0,0 +1,426 @@
+"""
+Adaptive downscaling pipeline shared by the Socket.IO server (app.py) and the
+desktop script (realtime_face_recognition.py).
+
+The detection scale is picked per frame from the input size: the smallest face
+we care about is `min_face_fraction` of the frame's shorter side, and the frame
+is shrunk until that face is just large enough for the detector
+(`detector_min_face` pixels, taken from the detector backend; see
+face_detectors.py). A 4032x3024 phone photo is therefore detected at
+roughly VGA, while a 640x480 webcam frame is barely touched.
+
+Encodings are computed on the downscaled frame when the face there is already
+at least `encode_min_face` pixels (dlib aligns faces to 150x150 chips); smaller
+faces are encoded on the full-resolution frame so accuracy is kept. Boxes are
+always returned in original-frame coordinates, together with per-stage timings
+in milliseconds.
+
+JPEG frames can skip most of the full-resolution decode: `decode` reads the
+image size from the JPEG header, and libjpeg then decodes straight to 1/2, 1/4
+or 1/8 size (DCT-domain scaling) whenever that is still at least the detection
+scale. Only faces too small to encode from the reduced frame trigger a second,
+full-resolution decode, and only the region around them is used.
+
+`process_batch` handles frames from several sessions together, computing all
+of their face encodings in one dlib call instead of one call per frame.
+
+Near-duplicate faces skip encoding altogether: each face crop is hashed and
+looked up in the caller's per-session cache, then in the pipeline's global
+cache (see embedding_cache.py).
+
+With a `quality_gate` (see face_quality.py), faces that are too small,
+badly exposed, blurred or turned away are not encoded: the size check runs
+before any full-resolution re-decode, and the pose check reuses the landmarks
+the encoder needs anyway, so a rejected face skips the descriptor network.
+
+`encode_photo` is the still-photo counterpart used for enrolment (uploads and
+enroll_directory.py): the photo must show exactly one face.
+
+dlib's models load on the first detection or encoding (face_recognition and
+dlib are imported lazily, see face_detectors.py); `warm_up` loads them up front, e.g.
+in a server's master process before it forks its workers.
+"""
+import time
+
+import cv2
+import numpy as np
+
+from embedding_cache import EmbeddingCache, face_hash
+from face_detectors import HOGDetector
+from face_tracking import expand_box
+
+DETECTOR_MIN_FACE = 80 # Smallest face dlib's HOG detector finds without upsampling (for detectors without min_face)
+ENCODE_MIN_FACE = 150 # dlib's aligned face chip size
+DEFAULT_MIN_FACE_FRACTION = 0.2
+ENCODE_CROP_EXPANSION = 0.5 # Context kept around faces encoded from a full-resolution re-decode
+CHIP_PADDING = 0.25 # Padding dlib's compute_face_descriptor uses when it cuts the chip itself
+
+REDUCED_DECODE_FLAGS = {
+    8: cv2.IMREAD_REDUCED_COLOR_8,
+    4: cv2.IMREAD_REDUCED_COLOR_4,
+    2: cv2.IMREAD_REDUCED_COLOR_2,
+}
+# Start-of-frame markers (baseline, progressive, ...); 0xC4, 0xC8 and 0xCC are not frames
+_SOF_MARKERS = frozenset(range(0xC0, 0xD0)) - {0xC4, 0xC8, 0xCC}
+
+
+def jpeg_size(buffer):
+    """Reads (height, width) from a JPEG's frame header without decoding it; None if not found."""
+    data = memoryview(buffer)
+    if len(data) < 4 or data[0] != 0xFF or data[1] != 0xD8:
+        return None
+    offset = 2
+    while offset + 9 <= len(data):
+        if data[offset] != 0xFF:
+            return None
+        marker = data[offset + 1]
+        if marker == 0xFF: # Fill byte
+            offset += 1
+        elif marker in _SOF_MARKERS:
+            return ((data[offset + 5] << 8) | data[offset + 6], (data[offset + 7] << 8) | data[offset + 8])
+        elif marker == 0x01 or 0xD0 <= marker <= 0xD8: # Markers without a length field
+            offset += 2
+        else:
+            offset += 2 + ((data[offset + 2] << 8) | data[offset + 3])
+    return None
+
+
+class FramePipeline:
+    def __init__(self, min_face_fraction=DEFAULT_MIN_FACE_FRACTION, detector_min_face=None,
+                 encode_min_face=ENCODE_MIN_FACE, min_scale=0.05, detect=None, reduced_decode=True,
+                 cache_size=0, cache_ttl=10.0, cache_max_distance=0, quality_gate=None):
+        """
+        `detect` is any face_detectors backend (HOG by default) or a callable with
+        the same contract; `detector_min_face` defaults to the detector's min_face.
+        `cache_size` > 0 enables the global embedding cache shared by all callers.
+        `quality_gate` is a face_quality.QualityGate, or None to encode every face.
+        """
+        detect = detect or HOGDetector()
+        if detector_min_face is None:
+            detector_min_face = getattr(detect, 'min_face', DETECTOR_MIN_FACE)
+        self.min_face_fraction = min_face_fraction
+        self.detector_min_face = detector_min_face
+        self.encode_min_face = encode_min_face
+        self.min_scale = min_scale
+        self.detect = detect
+        self.reduced_decode = reduced_decode
+        self.cache = EmbeddingCache(cache_size, cache_ttl, cache_max_distance) if cache_size > 0 else None
+        self.quality_gate = quality_gate
+
+    def warm_up(self):
+        """
+        Loads the detector and dlib's landmark and encoder models now rather than
+        on the first frame. Returns the milliseconds it took.
+        """
+        started = time.perf_counter()
+        blank = np.zeros((ENCODE_MIN_FACE * 2, ENCODE_MIN_FACE * 2, 3), np.uint8)
+        self.detect(blank)
+        import face_recognition
+        face_recognition.face_encodings(blank, [(0, ENCODE_MIN_FACE, ENCODE_MIN_FACE, 0)])
+        return _ms_since(started)
+
+    def choose_scale(self, frame_shape):
+        min_face = self.min_face_fraction * min(frame_shape[:2])
+        if min_face <= 0:
+            return 1.0
+        return max(self.min_scale, min(1.0, self.detector_min_face / min_face))
+
+    def reduction_for(self, frame_shape):
+        """Largest JPEG decode reduction (8, 4, 2 or 1) that still keeps the detection scale."""
+        scale = self.choose_scale(frame_shape)
+        for factor in REDUCED_DECODE_FLAGS:
+            if 1.0 / factor >= scale:
+                return factor
+        return 1
+
+    def decode(self, buffer):
+        """
+        Decodes a JPEG (or any imdecode-able) buffer, at reduced size when the
+        detection scale allows it. Returns (bgr_frame, original_shape, reduction);
+        bgr_frame is None when the buffer cannot be decoded.
+        """
+        array = np.frombuffer(buffer, np.uint8)
+        size = jpeg_size(buffer) if self.reduced_decode else None
+        reduction = self.reduction_for(size) if size else 1
+        if reduction == 1:
+            frame = cv2.imdecode(array, cv2.IMREAD_COLOR)
+            return frame, (frame.shape[:2] if frame is not None else None), 1
+
+        frame = cv2.imdecode(array, REDUCED_DECODE_FLAGS[reduction])
+        if frame is None:
+            return None, None, reduction
+        height, width = size
+        if (frame.shape[0] > frame.shape[1]) != (height > width):
+            height, width = width, height # imdecode applied the EXIF orientation
+        return frame, (height, width), reduction
+
+    def process(self, bgr_frame, tracker=None, encode=True, max_faces=None, original_shape=None, load_full=None,
+                cache=None):
+        """
+        Detects (and optionally encodes) faces in a BGR frame. Only the first
+        `max_faces` faces are encoded when given.
+
+        `bgr_frame` may be a reduced decode of a larger image (see `decode`); then
+        `original_shape` is the full (height, width) and `load_full()` returns the
+        full-resolution frame, used only for faces too small to encode otherwise.
+        `cache` is the caller's own (e.g. per-session) EmbeddingCache, if any.
+
+        Returns a dict with:
+          locations - face boxes (top, right, bottom, left) in original coordinates
+          encodings - one 128-d encoding per encoded box (empty if encode=False)
+          frame_shape - (height, width) of the original frame
+          scale     - detection scale that was used
+          timings   - milliseconds spent in resize, color, detect, encode and total
+                      (plus full_decode when a full-resolution re-decode was needed,
+                      and quality when a quality gate ran)
+          cache     - 'session', 'global' or 'miss' when caching is enabled
+          face_keys - cache key of each encoded face
+          quality   - with a quality gate, for frames with a face that missed the
+                      cache: "reason" (None when accepted) and the measures taken;
+                      no face is encoded unless all of them pass
+        """
+        started = time.perf_counter()
+        result, small_rgb, small_locations = self._detect(bgr_frame, tracker, original_shape)
+        if encode and not self._from_cache(result, small_rgb, small_locations, max_faces, cache):
+            mark = time.perf_counter()
+            if self._passes_gate(result, 'check_size', result["locations"][:max_faces]):
+                image, boxes = self._encoding_input(result, bgr_frame, small_rgb, small_locations, max_faces, load_full)
+                if boxes and self._passes_gate(result, 'check_crop', [image] * len(boxes), boxes):
+                    import face_recognition
+                    # face_recognition.face_encodings in two steps, so the pose check can use the landmarks
+                    landmarks = face_recognition.api._raw_face_landmarks(image, boxes, model='small')
+                    if self._passes_gate(result, 'check_pose', landmarks):
+                        encoder = face_recognition.api.face_encoder
+                        result["encodings"] = [np.array(encoder.compute_face_descriptor(image, shape))
+                                               for shape in landmarks]
+            result["timings"]['encode'] = _ms_since(mark) - result["timings"].get('quality', 0.0)
+            self._remember(result, cache)
+        result["timings"]['total'] = _ms_since(started)
+        return result
+
+    def process_batch(self, frames, max_faces=None):
+        """
+        `process` for several frames at once (e.g. from different sessions):
+        detection runs frame by frame, then landmarks and encodings of all their
+        faces run as a single dlib batch. `frames` holds (bgr_frame, tracker, cache,
+        original_shape, load_full) tuples. Returns one result per frame; encode and
+        total timings are those of the whole batch, which every frame waited for.
+        """
+        started = time.perf_counter()
+        results, inputs = [], []
+        for bgr_frame, tracker, cache, original_shape, load_full in frames:
+            result, small_rgb, small_locations = self._detect(bgr_frame, tracker, original_shape)
+            results.append(result)
+            if (self._from_cache(result, small_rgb, small_locations, max_faces, cache)
+                    or not self._passes_gate(result, 'check_size', result["locations"][:max_faces])):
+                inputs.append((None, []))
+                continue
+            image, boxes = self._encoding_input(result, bgr_frame, small_rgb, small_locations, max_faces, load_full)
+            if boxes and not self._passes_gate(result, 'check_crop', [image] * len(boxes), boxes):
+                boxes = []
+            inputs.append((image, boxes))
+
+        import dlib
+        import face_recognition
+        mark = time.perf_counter()
+        chips, owners = [], []
+        for i, (image, boxes) in enumerate(inputs):
+            if not boxes:
+                continue
+            # 5-point model, as face_encodings and process() use, so chips align like the enrolled templates'
+            landmarks = face_recognition.api._raw_face_landmarks(image, boxes, model='small')
+            if not self._passes_gate(results[i], 'check_pose', landmarks):
+                continue
+            for shape in landmarks:
+                chips.append(dlib.get_face_chip(image, shape, size=ENCODE_MIN_FACE, padding=CHIP_PADDING))
+                owners.append(i)
+        if chips:
+            descriptors = face_recognition.api.face_encoder.compute_face_descriptor(chips)
+            for i, descriptor in zip(owners, descriptors):
+                results[i]["encodings"].append(np.array(descriptor))
+        encode_ms = _ms_since(mark)
+
+        total_ms = _ms_since(started)
+        for result, (_, _, cache, _, _), (_, boxes) in zip(results, frames, inputs):
+            if boxes:
+                result["timings"]['encode'] = encode_ms
+                self._remember(result, cache)
+            result["timings"]['total'] = total_ms
+            result["batch_size"] = len(frames)
+        return results
+
+    def _detect(self, bgr_frame, tracker, original_shape):
+        """Resize, color conversion and detection. Returns (result, small_rgb, small_locations)."""
+        timings = {}
+        original_shape = tuple(original_shape or bgr_frame.shape[:2])
+        frame_scale = bgr_frame.shape[0] / original_shape[0] # Below 1.0 for a reduced decode
+        resize = min(1.0, self.choose_scale(original_shape) / frame_scale)
+        scale = resize * frame_scale
+
+        mark = time.perf_counter()
+        if resize < 1.0:
+            small = cv2.resize(bgr_frame, (0, 0), fx=resize, fy=resize, interpolation=cv2.INTER_AREA)
+        else:
+            small = bgr_frame
+        timings['resize'] = _ms_since(mark)
+
+        mark = time.perf_counter()
+        small_rgb = cv2.cvtColor(small, cv2.COLOR_BGR2RGB)
+        timings['color'] = _ms_since(mark)
+
+        mark = time.perf_counter()
+        if tracker is not None:
+            small_locations = tracker.locate(small_rgb, self.detect)
+        else:
+            small_locations = self.detect(small_rgb)
+        timings['detect'] = _ms_since(mark)
+
+        # Map boxes from the detection scale back to the original frame
+        height, width = original_shape
+        locations = [_scale_box(box, 1.0 / scale, width, height) for box in small_locations]
+
+        result = {
+            "locations": locations,
+            "encodings": [],
+            "frame_shape": original_shape,
+            "scale": scale,
+            "timings": timings,
+        }
+        return result, small_rgb, small_locations
+
+    def _from_cache(self, result, small_rgb, small_locations, max_faces, cache):
+        """
+        Hashes the face crops and fills result["encodings"] from the session
+        cache, else the global one, when every face hits. Returns True on a hit.
+        """
+        if (cache is None and self.cache is None) or not small_locations:
+            return False
+        mark = time.perf_counter()
+        count = len(small_locations) if max_faces is None else max_faces
+        keys = [face_hash(small_rgb, box) for box in small_locations[:count]]
+        result["face_keys"] = keys
+        result["cache"] = 'miss'
+        for source, level in (('session', cache), ('global', self.cache)):
+            if level is None:
+                continue
+            entries = [level.lookup(key) for key in keys]
+            if all(entry is not None for entry in entries):
+                result["face_keys"] = [stored_key for stored_key, _ in entries]
+                result["encodings"] = [encoding for _, encoding in entries]
+                result["cache"] = source
+                if source == 'global' and cache is not None:
+                    for stored_key, encoding in entries:
+                        cache.put(stored_key, encoding)
+                break
+        result["timings"]['hash'] = _ms_since(mark)
+        return result["cache"] != 'miss'
+
+    def _remember(self, result, cache):
+        for key, encoding in zip(result.get("face_keys", ()), result["encodings"]):
+            for level in (cache, self.cache):
+                if level is not None:
+                    level.put(key, encoding)
+
+    def _passes_gate(self, result, check, *faces):
+        """
+        Runs one QualityGate check (by name) on each face to encode, stopping at
+        the first rejection. Records it in result["quality"]; True when all pass.
+        """
+        if self.quality_gate is None or not len(faces[0]):
+            return True
+        mark = time.perf_counter()
+        quality = result.setdefault("quality", {"reason": None})
+        for face in zip(*faces):
+            reason, measures = getattr(self.quality_gate, check)(*face)
+            quality.update(measures)
+            if reason is not None:
+                quality["reason"] = reason
+                break
+        result["timings"]['quality'] = result["timings"].get('quality', 0.0) + _ms_since(mark)
+        return quality["reason"] is None
+
+    def _encoding_input(self, result, bgr_frame, small_rgb, small_locations, max_faces, load_full):
+        """
+        Picks the smallest image the faces can be encoded from at full accuracy.
+        Returns (rgb_image, boxes in that image); boxes is empty when there is no face.
+        """
+        if not small_locations:
+            return None, []
+        count = len(small_locations) if max_faces is None else max_faces
+        scale = result["scale"]
+        frame_scale = bgr_frame.shape[0] / result["frame_shape"][0]
+        face_size = min(min(b - t, r - l) for t, r, b, l in small_locations[:count])
+        if face_size >= self.encode_min_face or scale >= 1.0:
+            return small_rgb, small_locations[:count]
+        if frame_scale >= 1.0 or load_full is None or face_size * frame_scale / scale >= self.encode_min_face:
+            # The frame as given (full size, or a reduced decode) has enough pixels
+            frame_height, frame_width = bgr_frame.shape[:2]
+            frame_locations = [_scale_box(box, frame_scale / scale, frame_width, frame_height)
+                               for box in small_locations[:count]]
+            return cv2.cvtColor(bgr_frame, cv2.COLOR_BGR2RGB), frame_locations
+
+        mark = time.perf_counter()
+        full_frame = load_full()
+        result["timings"]['full_decode'] = _ms_since(mark)
+        return _region_input(full_frame, result["locations"][:count])
+
+
+def _region_input(bgr_frame, locations):
+    """Crops the region around the faces, saving the full-frame color conversion."""
+    top = min(t for t, _, _, _ in locations)
+    right = max(r for _, r, _, _ in locations)
+    bottom = max(b for _, _, b, _ in locations)
+    left = min(l for _, _, _, l in locations)
+    top, right, bottom, left = expand_box((top, right, bottom, left), bgr_frame.shape, ENCODE_CROP_EXPANSION)
+    region_rgb = cv2.cvtColor(bgr_frame[top:bottom, left:right], cv2.COLOR_BGR2RGB)
+    shifted = [(t - top, r - left, b - top, l - left) for t, r, b, l in locations]
+    return region_rgb, shifted
+
+
+def _scale_box(box, factor, width, height):
+    top, right, bottom, left = box
+    return (
+        max(0, int(round(top * factor))),
+        min(width, int(round(right * factor))),
+        min(height, int(round(bottom * factor))),
+        max(0, int(round(left * factor))),
+    )
+
+
+def _ms_since(mark):
+    return (time.perf_counter() - mark) * 1000.0
+
+
+def format_timings(timings):
+    return ", ".join(f"{stage} {ms:.1f}" for stage, ms in timings.items())
+
+
+# --- Still photos (enrolment) ---
+
+ENROLL_MAX_SIDE = 1024 # Staff photos are often 12 MP; faces in them stay far above dlib's 150 px chip
+NO_FACE = 'no_face'
+MULTIPLE_FACES = 'multiple_faces'
+UNREADABLE = 'unreadable'
+
+
+def encode_photo(image, detect, max_side=ENROLL_MAX_SIDE, num_jitters=1):
+    """
+    Encodes the single face in a BGR photo (None if it could not be decoded).
+    Returns (status, detail, encoding or None); status is 'ok' or a reject reason.
+    """
+    if image is None:
+        return UNREADABLE, "could not decode image", None
+    scale = max_side / max(image.shape[:2])
+    if scale < 1.0:
+        image = cv2.resize(image, (0, 0), fx=scale, fy=scale, interpolation=cv2.INTER_AREA)
+    rgb = cv2.cvtColor(image, cv2.COLOR_BGR2RGB)
+    boxes = detect(rgb)
+    if not boxes:
+        return NO_FACE, "no face found", None
+    if len(boxes) > 1:
+        return MULTIPLE_FACES, f"{len(boxes)} faces found", None
+    import face_recognition
+    encodings = face_recognition.face_encodings(rgb, known_face_locations=boxes, num_jitters=num_jitters)
+    if not encodings:
+        return NO_FACE, "face could not be encoded", None
+    return 'ok', "", np.asarray(encodings[0], dtype=np.float32)
@@ -0,0 +1,328 @@
+"""
+In-memory face gallery used for matching probe encodings against enrolled people.
+
+All known encodings are held in one contiguous float32 (N x 128) matrix together
+with a precomputed squared-norm vector, so a probe (or a batch of probes) is
+matched with a single matrix product instead of a Python loop over the gallery.
+The nearest-neighbour search itself is delegated to a pluggable index backend
+(see gallery_index.py), exact brute force by default.
+
+Enrolment updates the gallery in place without blocking matching. Readers always
+match against an immutable GallerySnapshot; a writer appends the new row past
+the end of every published snapshot, marks a replaced row as removed from the
+next version on, and then publishes a new snapshot with one attribute swap.
+
+An identity may carry several templates (e.g. captured under different lighting
+or poses). How they are scored is chosen per gallery with `aggregation`:
+
+  min      - keep every template, an identity scores its nearest template
+  centroid - keep one row per identity, the mean of its templates
+  medoid   - keep one row per identity, the template closest to all the others
+
+Templates are de-duplicated and capped with `select_templates` before they are
+stored, so storage and match cost stay bounded per identity.
+"""
+import copy
+import threading
+
+import numpy as np
+
+from gallery_index import make_index
+
+ENCODING_DIM = 128
+DEFAULT_TOLERANCE = 0.6 # Same default as face_recognition.compare_faces
+DEFAULT_TOP_K = 3
+AGGREGATIONS = ('min', 'centroid', 'medoid')
+DEFAULT_MAX_TEMPLATES = 10
+DEFAULT_TEMPLATE_SPACING = 0.1 # Templates closer than this to a kept one add nothing
+
+_INITIAL_CAPACITY = 64
+_NEVER_REMOVED = np.iinfo(np.int64).max
+_COMPACT_MIN_REMOVED = 64 # Don't bother compacting tiny galleries
+
+
+class GallerySnapshot:
+    """
+    Immutable view of the gallery at one version. Rows past `len(matrix)` may be
+    written by a concurrent enrolment, and rows replaced after `version` stay
+    visible here, so a match never sees a half-applied update.
+    """
+
+    def __init__(self, version, matrix, sq_norms, row_names, removed_at, has_removed, index,
+                 rows_per_identity):
+        self.version = version
+        self.matrix = matrix
+        self.sq_norms = sq_norms
+        self._row_names = row_names # Shared append-only list; only the first len(matrix) are ours
+        self._removed_at = removed_at
+        self._has_removed = has_removed
+        self.index = index
+        self.rows_per_identity = rows_per_identity # Upper bound, used to widen row searches
+
+    def alive_mask(self):
+        if not self._has_removed:
+            return None
+        return self._removed_at[:len(self.matrix)] > self.version
+
+    def names(self):
+        alive = self.alive_mask()
+        count = len(self.matrix)
+        names = (self._row_names[i] for i in range(count) if alive is None or alive[i])
+        return list(dict.fromkeys(names))
+
+    def match_batch(self, probes, k=DEFAULT_TOP_K, tolerance=DEFAULT_TOLERANCE):
+        """
+        Matches every probe in one batched distance computation.
+        Returns one result dict per probe (see `FaceGallery.match`).
+        """
+        probes = np.asarray(probes, dtype=np.float32).reshape(-1, ENCODING_DIM)
+        if len(self.matrix) == 0:
+            return [_empty_result() for _ in range(len(probes))]
+
+        # An identity may own several rows; fetch enough rows to fill k distinct identities
+        k = max(1, k)
+        ids, dists = self.index.search(probes, k * self.rows_per_identity, self.alive_mask())
+
+        results = []
+        for row_ids, row_dists in zip(ids, dists):
+            candidates = []
+            seen = set()
+            for i, d in zip(row_ids, row_dists):
+                if i < 0 or self._row_names[i] in seen:
+                    continue
+                seen.add(self._row_names[i])
+                candidates.append((self._row_names[i], float(d)))
+                if len(candidates) == k:
+                    break
+            if not candidates:
+                results.append(_empty_result())
+                continue
+            results.append(_build_result(candidates, tolerance))
+        return results
+
+
+class FaceGallery:
+    def __init__(self, encodings=None, names=None, index='brute', aggregation='min',
+                 max_templates=DEFAULT_MAX_TEMPLATES, **index_options):
+        encodings = [] if encodings is None else encodings
+        names = [] if names is None else names
+        if len(encodings) != len(names):
+            raise ValueError("encodings and names must have the same length")
+        if aggregation not in AGGREGATIONS:
+            raise ValueError(f"Unknown aggregation '{aggregation}', expected one of {AGGREGATIONS}")
+        self.aggregation = aggregation
+        self.max_templates = max_templates
+
+        # `index` is either a backend name or a prototype index instance
+        if isinstance(index, str):
+            self._new_index = lambda: make_index(index, **index_options)
+        else:
+            self._new_index = lambda: copy.copy(index)
+
+        self._write_lock = threading.Lock() # Serialises writers only; readers never take it
+        matrix = np.asarray(encodings, dtype=np.float32).reshape(-1, ENCODING_DIM)
+        names = list(names)
+        if len(set(names)) != len(names):
+            matrix, names = self._aggregate_all(matrix, names)
+        self._reset_storage(matrix, names, version=0)
+
+    # --- Reading ---
+
+    def snapshot(self):
+        return self._snapshot
+
+    @property
+    def names(self):
+        return self._snapshot.names()
+
+    def __len__(self):
+        return len(self._rows_of)
+
+    def match_batch(self, probes, k=DEFAULT_TOP_K, tolerance=DEFAULT_TOLERANCE):
+        return self._snapshot.match_batch(probes, k=k, tolerance=tolerance)
+
+    def match(self, probe, k=DEFAULT_TOP_K, tolerance=DEFAULT_TOLERANCE):
+        """
+        Returns a dict with:
+          name       - best identity, or "Unknown" if its distance exceeds tolerance
+          distance   - distance to the best identity (None for an empty gallery)
+          candidates - top-k (name, distance) pairs, nearest first
+          margin     - second-best distance minus best distance (None if < 2 candidates)
+        """
+        return self.match_batch([probe], k=k, tolerance=tolerance)[0]
+
+    # --- Writing ---
+
+    def upsert(self, name, encodings):
+        """
+        Adds `name`, or replaces all of its templates if already enrolled.
+        `encodings` is one encoding or a list of templates. Amortised O(templates).
+        """
+        rows = self._aggregate(np.asarray(encodings, dtype=np.float32).reshape(-1, ENCODING_DIM))
+        with self._write_lock:
+            version = self._snapshot.version + 1
+            self._ensure_capacity(self._count + len(rows))
+
+            for old_row in self._rows_of.get(name, ()):
+                self._removed_at[old_row] = version
+                self._removed_count += 1
+
+            start = self._count
+            self._buffer[start:start + len(rows)] = rows
+            self._sq_buffer[start:start + len(rows)] = np.einsum('ij,ij->i', rows, rows)
+            self._row_names.extend([name] * len(rows))
+            self._rows_of[name] = list(range(start, start + len(rows)))
+            self._rows_per_identity = max(self._rows_per_identity, len(rows))
+            self._count += len(rows)
+
+            self._publish(version)
+            self._maybe_compact()
+
+    def remove(self, name):
+        with self._write_lock:
+            rows = self._rows_of.pop(name, None)
+            if rows is None:
+                return False
+            version = self._snapshot.version + 1
+            self._removed_at[rows] = version
+            self._removed_count += len(rows)
+            self._publish(version)
+            self._maybe_compact()
+            return True
+
+    def _reset_storage(self, matrix, names, version):
+        count = len(matrix)
+        if count and matrix.flags['C_CONTIGUOUS']:
+            # Use the caller's matrix (e.g. the store's read-only mmap) as is; rows below
+            # `count` are never written, and the first append grows into a fresh buffer.
+            self._buffer = matrix
+        else:
+            self._buffer = np.empty((max(_INITIAL_CAPACITY, count), ENCODING_DIM), dtype=np.float32)
+            self._buffer[:count] = matrix
+        capacity = len(self._buffer)
+        self._sq_buffer = np.empty(capacity, dtype=np.float32)
+        self._sq_buffer[:count] = np.einsum('ij,ij->i', matrix, matrix)
+        self._removed_at = np.full(capacity, _NEVER_REMOVED, dtype=np.int64)
+        self._row_names = names
+        self._rows_of = {}
+        for row, name in enumerate(names):
+            self._rows_of.setdefault(name, []).append(row)
+        self._rows_per_identity = max((len(rows) for rows in self._rows_of.values()), default=1)
+        self._count = count
+        self._removed_count = 0
+
+        snapshot_matrix = self._buffer[:count]
+        snapshot_sq = self._sq_buffer[:count]
+        index = self._new_index().build(snapshot_matrix, snapshot_sq)
+        self._snapshot = GallerySnapshot(
+            version, snapshot_matrix, snapshot_sq, self._row_names, self._removed_at, False, index,
+            self._rows_per_identity,
+        )
+
+    def _ensure_capacity(self, needed):
+        capacity = len(self._buffer)
+        if needed <= capacity:
+            return
+        # Grow into fresh arrays; published snapshots keep referencing the old ones
+        capacity = max(needed, _INITIAL_CAPACITY, capacity * 2)
+        buffer = np.empty((capacity, ENCODING_DIM), dtype=np.float32)
+        buffer[:self._count] = self._buffer[:self._count]
+        sq_buffer = np.empty(capacity, dtype=np.float32)
+        sq_buffer[:self._count] = self._sq_buffer[:self._count]
+        removed_at = np.full(capacity, _NEVER_REMOVED, dtype=np.int64)
+        removed_at[:self._count] = self._removed_at[:self._count]
+        self._buffer, self._sq_buffer, self._removed_at = buffer, sq_buffer, removed_at
+
+    def _publish(self, version):
+        matrix = self._buffer[:self._count]
+        sq_norms = self._sq_buffer[:self._count]
+        index = self._snapshot.index.extended(matrix, sq_norms)
+        self._snapshot = GallerySnapshot(
+            version, matrix, sq_norms, self._row_names, self._removed_at,
+            self._removed_count > 0, index, self._rows_per_identity,
+        )
+
+    def _maybe_compact(self):
+        # Rewrite without removed rows once they outnumber live ones (amortised O(1))
+        if self._removed_count < max(_COMPACT_MIN_REMOVED, self._count - self._removed_count):
+            return
+        snapshot = self._snapshot
+        alive = snapshot.alive_mask()
+        names = [name for name, keep in zip(self._row_names[:self._count], alive) if keep]
+        self._reset_storage(snapshot.matrix[alive], names, snapshot.version + 1)
+
+    def _aggregate(self, templates):
+        """Reduces one identity's templates to the rows actually kept in the gallery."""
+        if self.aggregation == 'centroid':
+            return templates.mean(axis=0, keepdims=True)
+        if self.aggregation == 'medoid':
+            return templates[[medoid_index(templates)]]
+        return select_templates(templates, max_templates=self.max_templates)
+
+    def _aggregate_all(self, matrix, names):
+        grouped = {}
+        for row, name in enumerate(names):
+            grouped.setdefault(name, []).append(row)
+        rows = []
+        row_names = []
+        for name, indices in grouped.items():
+            kept = self._aggregate(matrix[indices])
+            rows.append(kept)
+            row_names.extend([name] * len(kept))
+        return np.concatenate(rows).astype(np.float32), row_names
+
+
+def _pairwise_distances(encodings):
+    sq = np.einsum('ij,ij->i', encodings, encodings)
+    d2 = sq[:, None] + sq[None, :] - 2.0 * (encodings @ encodings.T)
+    return np.sqrt(np.maximum(d2, 0.0))
+
+
+def medoid_index(templates):
+    """Index of the template with the smallest total distance to all the others."""
+    return int(np.argmin(_pairwise_distances(templates).sum(axis=1)))
+
+
+def select_templates(encodings, max_templates=DEFAULT_MAX_TEMPLATES, min_spacing=DEFAULT_TEMPLATE_SPACING):
+    """
+    De-duplicates one identity's templates and caps how many are kept.
+
+    Templates within `min_spacing` of an already kept one are dropped. If more
+    than `max_templates` remain, a diverse subset is chosen by farthest-point
+    sampling starting from the medoid.
+    """
+    encodings = np.asarray(encodings, dtype=np.float32).reshape(-1, ENCODING_DIM)
+    if len(encodings) <= 1:
+        return encodings
+    dists = _pairwise_distances(encodings)
+
+    kept = [0]
+    for i in range(1, len(encodings)):
+        if dists[i, kept].min() >= min_spacing:
+            kept.append(i)
+
+    if len(kept) > max_templates:
+        sub = dists[np.ix_(kept, kept)]
+        chosen = [int(np.argmin(sub.sum(axis=1)))]
+        nearest = sub[chosen[0]].copy()
+        while len(chosen) < max_templates:
+            nxt = int(np.argmax(nearest))
+            chosen.append(nxt)
+            np.minimum(nearest, sub[nxt], out=nearest)
+        kept = [kept[i] for i in chosen]
+    return encodings[kept]
+
+
+def _build_result(candidates, tolerance):
+    best_name, best_distance = candidates[0]
+    margin = candidates[1][1] - best_distance if len(candidates) > 1 else None
+    return {
+        "name": best_name if best_distance <= tolerance else "Unknown",
+        "distance": best_distance,
+        "candidates": candidates,
+        "margin": margin,
+    }
+
+
+def _empty_result():
+    return {"name": "Unknown", "distance": None, "candidates": [], "margin": None}
@@ -0,0 +1,232 @@
+"""
+Nearest-neighbour index backends for the face gallery.
+
+Every backend answers the same question: for a batch of probe encodings, which
+gallery rows are nearest and at what Euclidean distance. `search` always returns
+two (M, k) arrays, row ids (-1 for padding) and distances (inf for padding),
+nearest first.
+
+  brute - exact scan of the whole gallery matrix (default)
+  ivf   - inverted-file index: k-means partitions the gallery, each probe scans
+          only the `nprobe` nearest partitions. Raise `nprobe` for recall,
+          lower it for latency.
+
+Indexes are never mutated after `build`: `extended` returns a new index covering
+rows appended to the gallery since, so a gallery snapshot can keep using its
+own index while a newer one is being published. `search` accepts an optional
+boolean `alive` mask; rows where it is False (replaced or removed enrolments)
+are never returned.
+"""
+import copy
+
+import numpy as np
+
+_CHUNK_ROWS = 8192 # Bounds the temporary (rows x centroids) distance block
+
+
+def _row_sq_norms(matrix):
+    return np.einsum('ij,ij->i', matrix, matrix)
+
+
+def _sq_distances(probes, probe_sq, rows, rows_sq):
+    sq = probe_sq[:, None] + rows_sq[None, :] - 2.0 * (probes @ rows.T)
+    np.maximum(sq, 0.0, out=sq)
+    return sq
+
+
+def _top_k(sq, k):
+    """Indices and squared distances of the k smallest entries per row, sorted."""
+    n = sq.shape[1]
+    k = min(k, n)
+    if k < n:
+        idx = np.argpartition(sq, k - 1, axis=1)[:, :k]
+    else:
+        idx = np.broadcast_to(np.arange(n), sq.shape)
+    part = np.take_along_axis(sq, idx, axis=1)
+    order = np.argsort(part, axis=1, kind='stable')
+    return np.take_along_axis(idx, order, axis=1), np.take_along_axis(part, order, axis=1)
+
+
+def _pad(ids, dists, k):
+    if ids.shape[1] < k:
+        missing = k - ids.shape[1]
+        ids = np.pad(ids, ((0, 0), (0, missing)), constant_values=-1)
+        dists = np.pad(dists, ((0, 0), (0, missing)), constant_values=np.inf)
+    # Masked-out rows come back at infinite distance; report them as padding
+    ids = np.where(np.isinf(dists), -1, ids)
+    return ids, dists
+
+
+class BruteForceIndex:
+    name = 'brute'
+
+    def __init__(self):
+        self.matrix = np.empty((0, 0), dtype=np.float32)
+        self.sq_norms = np.empty(0, dtype=np.float32)
+
+    def build(self, matrix, sq_norms=None):
+        self.matrix = matrix
+        self.sq_norms = _row_sq_norms(matrix) if sq_norms is None else sq_norms
+        return self
+
+    def __len__(self):
+        return len(self.matrix)
+
+    def extended(self, matrix, sq_norms):
+        # The exact scan has no precomputed structure, so this only swaps the views
+        return BruteForceIndex().build(matrix, sq_norms)
+
+    def search(self, probes, k, alive=None):
+        m = len(probes)
+        if len(self) == 0:
+            return _pad(np.empty((m, 0), dtype=np.int64), np.empty((m, 0), dtype=np.float32), k)
+        probe_sq = _row_sq_norms(probes)
+        sq = _sq_distances(probes, probe_sq, self.matrix, self.sq_norms)
+        if alive is not None:
+            sq[:, ~alive] = np.inf
+        ids, sq_top = _top_k(sq, k)
+        return _pad(ids, np.sqrt(sq_top), k)
+
+
+class IVFIndex:
+    """
+    Pure-NumPy inverted-file index.
+
+    The gallery is partitioned with k-means into `nlist` cells and the rows are
+    stored grouped by cell, so scanning a cell is a contiguous slice. A query
+    ranks the centroids and computes exact distances only for rows in its
+    `nprobe` nearest cells. Galleries smaller than `min_train_size` are served
+    by an exact scan, where partitioning would not pay off.
+
+    Rows appended after training are kept in an exactly-scanned tail until it
+    grows past `retrain_fraction` of the partitioned rows, then the index is
+    retrained from scratch.
+    """
+    name = 'ivf'
+
+    def __init__(self, nlist=None, nprobe=8, train_iterations=10, min_train_size=1024,
+                 retrain_fraction=0.1, seed=0):
+        self.nlist = nlist
+        self.nprobe = nprobe
+        self.train_iterations = train_iterations
+        self.min_train_size = min_train_size
+        self.retrain_fraction = retrain_fraction
+        self.seed = seed
+        self._exact = BruteForceIndex()
+        self.centroids = None
+        self.indexed_rows = 0
+
+    def __len__(self):
+        return len(self._exact)
+
+    def build(self, matrix, sq_norms=None):
+        self._exact.build(matrix, sq_norms)
+        self.centroids = None
+        self.indexed_rows = 0
+        if len(matrix) < self.min_train_size:
+            return self
+
+        nlist = self.nlist or max(1, int(np.sqrt(len(matrix))))
+        self.centroids = self._train(matrix, nlist)
+        self.centroid_sq = _row_sq_norms(self.centroids)
+
+        assignments = self._assign(matrix)
+        # Group rows by cell so each inverted list is one contiguous slice
+        self.row_ids = np.argsort(assignments, kind='stable')
+        self.offsets = np.zeros(len(self.centroids) + 1, dtype=np.int64)
+        np.cumsum(np.bincount(assignments, minlength=len(self.centroids)), out=self.offsets[1:])
+        self.list_matrix = np.ascontiguousarray(matrix[self.row_ids])
+        self.list_sq_norms = self._exact.sq_norms[self.row_ids]
+        self.indexed_rows = len(matrix)
+        return self
+
+    def extended(self, matrix, sq_norms):
+        tail = len(matrix) - self.indexed_rows
+        if self.centroids is None or tail > max(1, self.retrain_fraction * self.indexed_rows):
+            fresh = copy.copy(self)
+            fresh._exact = BruteForceIndex()
+            return fresh.build(matrix, sq_norms)
+        index = copy.copy(self)
+        index._exact = BruteForceIndex().build(matrix, sq_norms)
+        return index
+
+    def _train(self, matrix, nlist):
+        rng = np.random.default_rng(self.seed)
+        sample_size = min(len(matrix), nlist * 64)
+        sample = matrix[rng.choice(len(matrix), sample_size, replace=False)]
+        centroids = sample[rng.choice(sample_size, nlist, replace=False)].copy()
+
+        for _ in range(self.train_iterations):
+            labels = self._nearest_centroid(sample, centroids)
+            sums = np.zeros_like(centroids)
+            np.add.at(sums, labels, sample)
+            counts = np.bincount(labels, minlength=nlist)
+            filled = counts > 0
+            centroids[filled] = sums[filled] / counts[filled, None]
+            # Re-seed empty cells from random sample points
+            empty = np.flatnonzero(~filled)
+            if len(empty):
+                centroids[empty] = sample[rng.choice(sample_size, len(empty), replace=False)]
+        return centroids
+
+    @staticmethod
+    def _nearest_centroid(rows, centroids):
+        centroid_sq = _row_sq_norms(centroids)
+        labels = np.empty(len(rows), dtype=np.int64)
+        for start in range(0, len(rows), _CHUNK_ROWS):
+            chunk = rows[start:start + _CHUNK_ROWS]
+            sq = _sq_distances(chunk, _row_sq_norms(chunk), centroids, centroid_sq)
+            labels[start:start + _CHUNK_ROWS] = np.argmin(sq, axis=1)
+        return labels
+
+    def _assign(self, rows):
+        return self._nearest_centroid(rows, self.centroids)
+
+    def search(self, probes, k, alive=None):
+        if self.centroids is None:
+            return self._exact.search(probes, k, alive)
+
+        nprobe = max(1, min(self.nprobe, len(self.centroids)))
+        probe_sq = _row_sq_norms(probes)
+        cell_sq = _sq_distances(probes, probe_sq, self.centroids, self.centroid_sq)
+        cells, _ = _top_k(cell_sq, nprobe)
+
+        tail_ids = np.arange(self.indexed_rows, len(self._exact))
+        tail_matrix = self._exact.matrix[self.indexed_rows:]
+        tail_sq_norms = self._exact.sq_norms[self.indexed_rows:]
+
+        ids = np.full((len(probes), k), -1, dtype=np.int64)
+        dists = np.full((len(probes), k), np.inf, dtype=np.float32)
+        for i, probe_cells in enumerate(cells):
+            probe, probe_norm = probes[i:i + 1], probe_sq[i:i + 1]
+            positions = np.concatenate(
+                [np.arange(self.offsets[c], self.offsets[c + 1]) for c in probe_cells]
+            )
+            row_ids = np.concatenate([self.row_ids[positions], tail_ids])
+            if len(row_ids) == 0:
+                continue
+            sq = np.concatenate([
+                _sq_distances(probe, probe_norm, self.list_matrix[positions], self.list_sq_norms[positions])[0],
+                _sq_distances(probe, probe_norm, tail_matrix, tail_sq_norms)[0],
+            ])
+            if alive is not None:
+                sq[~alive[row_ids]] = np.inf
+            top, sq_top = _top_k(sq[None, :], k)
+            found = top.shape[1]
+            ids[i, :found] = row_ids[top[0]]
+            dists[i, :found] = np.sqrt(sq_top[0])
+        return _pad(ids, dists, k)
+
+
+INDEX_BACKENDS = {
+    BruteForceIndex.name: BruteForceIndex,
+    IVFIndex.name: IVFIndex,
+}
+
+
+def make_index(kind='brute', **options):
+    try:
+        backend = INDEX_BACKENDS[kind]
+    except KeyError:
+        raise ValueError(f"Unknown gallery index '{kind}', expected one of {sorted(INDEX_BACKENDS)}")
+    return backend(**options)
@@ -0,0 +1,337 @@
+"""
+Single-file, memory-mapped on-disk store for the face gallery.
+
+Replaces the old layout of one `<name>_encoding.npy` per person. A store
+directory holds numbered generations plus a CURRENT pointer:
+
+    gallery/
+      CURRENT                  name of the live generation, e.g. "gen-000003"
+      gen-000003/
+        encodings.npy          float32 (N x 128) matrix, opened with mmap
+        identities.npy         structured table aligned with the matrix rows:
+                               id (int64), name (U128), enrolled_at (float64).
+                               A name owns one row per stored template.
+        append.log             JSON lines of enrolments since the generation
+                               was written ({"op": "upsert"|"remove", ...})
+        sources.json           optional: SHA-256 of every image file enrolled by
+                               bulk import -> name (see enroll_directory.py)
+
+Opening the store is one mmap of each file no matter how many people are
+enrolled. New enrolments only append one line to the log; once the log holds
+`compact_after` entries it is folded into a new generation, which is made live
+by atomically replacing CURRENT. A bulk import writes a new generation
+directly, so thousands of identities become visible at once or not at all.
+
+Writers hold an advisory lock on the store's LOCK file (flock, where the
+platform has it) besides the in-process lock, so a bulk import running next to
+the server cannot fold in the log and then lose an enrolment the server
+appended meanwhile.
+"""
+import base64
+import json
+import os
+import shutil
+import threading
+import time
+from contextlib import contextmanager
+
+try:
+    import fcntl
+except ImportError: # Windows: writers are only serialized within one process
+    fcntl = None
+
+import numpy as np
+
+from gallery import ENCODING_DIM
+
+LEGACY_SUFFIX = '_encoding.npy'
+MAX_NAME_LENGTH = 128
+IDENTITY_DTYPE = np.dtype([
+    ('id', '<i8'),
+    ('name', f'<U{MAX_NAME_LENGTH}'),
+    ('enrolled_at', '<f8'),
+])
+
+_CURRENT = 'CURRENT'
+_ENCODINGS = 'encodings.npy'
+_IDENTITIES = 'identities.npy'
+_LOG = 'append.log'
+_SOURCES = 'sources.json'
+_LOCK = 'LOCK'
+
+
+class GalleryStore:
+    def __init__(self, root, compact_after=1000):
+        self.root = root
+        self.compact_after = compact_after
+        self._lock = threading.Lock()
+        self._log_entries = 0
+        self._log_generation = None # Generation _log_entries was counted for
+        os.makedirs(root, exist_ok=True)
+
+    @contextmanager
+    def _locked(self, shared=False):
+        """The in-process lock plus the store's file lock (shared for readers)."""
+        with self._lock:
+            if fcntl is None:
+                yield
+                return
+            with open(os.path.join(self.root, _LOCK), 'a') as f:
+                fcntl.flock(f, fcntl.LOCK_SH if shared else fcntl.LOCK_EX)
+                try:
+                    yield
+                finally:
+                    fcntl.flock(f, fcntl.LOCK_UN)
+
+    # --- Reading ---
+
+    def exists(self):
+        return os.path.exists(os.path.join(self.root, _CURRENT))
+
+    def read_all(self):
+        """
+        Returns (encodings, names) for every stored template; a name appears once
+        per template. With an empty log the
+        encodings are the read-only mmap of the current generation itself.
+        """
+        with self._locked(shared=True):
+            encodings, names, _ = self._read_all()
+            return encodings, names
+
+    def _read_all(self):
+        encodings, identities = self._open_generation()
+        names = identities['name'].tolist()
+        ops = self._read_log()
+        if not ops:
+            return encodings, names, identities['enrolled_at']
+
+        # Later log entries win; None marks a removal
+        overrides = {}
+        for op in ops:
+            if op['op'] == 'upsert':
+                overrides.pop(op['name'], None) # Move to the end, like a fresh append
+                templates = [_decode_encoding(enc) for enc in op['encodings']]
+                overrides[op['name']] = (templates, op['enrolled_at'])
+            elif op['op'] == 'remove':
+                overrides[op['name']] = None
+
+        keep = np.array([name not in overrides for name in names], dtype=bool)
+        added = []
+        for name, entry in overrides.items():
+            if entry is not None:
+                templates, enrolled_at = entry
+                added.extend((name, enc, enrolled_at) for enc in templates)
+        merged = np.concatenate([
+            encodings[keep],
+            np.array([enc for _, enc, _ in added], dtype=np.float32).reshape(-1, ENCODING_DIM),
+        ])
+        merged_names = [name for name, k in zip(names, keep) if k] + [name for name, _, _ in added]
+        merged_enrolled_at = np.concatenate([
+            identities['enrolled_at'][keep],
+            np.array([enrolled_at for _, _, enrolled_at in added], dtype=np.float64),
+        ])
+        return merged, merged_names, merged_enrolled_at
+
+    def _current_dir(self):
+        try:
+            with open(os.path.join(self.root, _CURRENT)) as f:
+                return os.path.join(self.root, f.read().strip())
+        except FileNotFoundError:
+            return None
+
+    def _open_generation(self):
+        gen_dir = self._current_dir()
+        if gen_dir is None:
+            return np.empty((0, ENCODING_DIM), dtype=np.float32), np.empty(0, dtype=IDENTITY_DTYPE)
+        encodings = np.load(os.path.join(gen_dir, _ENCODINGS), mmap_mode='r')
+        identities = np.load(os.path.join(gen_dir, _IDENTITIES), mmap_mode='r')
+        return encodings, identities
+
+    def _read_log(self):
+        gen_dir = self._current_dir()
+        if gen_dir is None:
+            return []
+        ops = []
+        try:
+            with open(os.path.join(gen_dir, _LOG)) as f:
+                for line in f:
+                    try:
+                        ops.append(json.loads(line))
+                    except json.JSONDecodeError:
+                        # A torn final line from a crash mid-append; everything before it is intact
+                        print(f"Skipping unreadable gallery log entry in {gen_dir}")
+        except FileNotFoundError:
+            pass
+        return ops
+
+    def sources(self):
+        """{content hash: name} of the image files enrolled through bulk import."""
+        with self._locked(shared=True):
+            return self._read_sources()
+
+    def _read_sources(self):
+        gen_dir = self._current_dir()
+        if gen_dir is None:
+            return {}
+        try:
+            with open(os.path.join(gen_dir, _SOURCES)) as f:
+                return json.load(f)
+        except FileNotFoundError:
+            return {}
+
+    # --- Writing ---
+
+    def append(self, name, encodings):
+        """
+        Records an enrolment in the append log. `encodings` is one encoding or a
+        list of templates; they replace any templates already stored for `name`.
+        """
+        check_name(name)
+        encodings = np.asarray(encodings, dtype=np.float32).reshape(-1, ENCODING_DIM)
+        self._append_op({
+            'op': 'upsert',
+            'name': name,
+            'encodings': [_encode_encoding(enc) for enc in encodings],
+            'enrolled_at': time.time(),
+        })
+
+    def remove(self, name):
+        self._append_op({'op': 'remove', 'name': name})
+
+    def bulk_upsert(self, templates, sources=None):
+        """
+        Replaces the templates of many identities ({name: encodings}) in one new
+        generation, folding in the append log. `sources` ({content hash: name})
+        are added to the recorded image sources.
+        """
+        for name in templates:
+            check_name(name)
+        with self._locked():
+            # Read under the file lock, so log entries appended by another process are folded in
+            encodings, names, enrolled_at = self._read_all()
+            keep = np.array([name not in templates for name in names], dtype=bool)
+            added = [(name, enc) for name, encs in templates.items()
+                     for enc in np.asarray(encs, dtype=np.float32).reshape(-1, ENCODING_DIM)]
+            merged = np.concatenate([
+                np.asarray(encodings)[keep],
+                np.array([enc for _, enc in added], dtype=np.float32).reshape(-1, ENCODING_DIM),
+            ])
+            merged_names = [name for name, k in zip(names, keep) if k] + [name for name, _ in added]
+            merged_enrolled_at = np.concatenate([
+                np.asarray(enrolled_at, dtype=np.float64)[keep],
+                np.full(len(added), time.time()),
+            ])
+            all_sources = self._read_sources()
+            all_sources.update(sources or {})
+            self._write_generation(merged, merged_names, merged_enrolled_at, sources=all_sources)
+
+    def _append_op(self, op):
+        with self._locked():
+            if self._current_dir() is None:
+                self._write_generation(np.empty((0, ENCODING_DIM), dtype=np.float32), [])
+            if self._log_generation != self._current_dir():
+                # First append, or another process switched generations since
+                self._log_entries = len(self._read_log())
+                self._log_generation = self._current_dir()
+            with open(os.path.join(self._current_dir(), _LOG), 'a') as f:
+                f.write(json.dumps(op) + '\n')
+                f.flush()
+                os.fsync(f.fileno())
+            self._log_entries += 1
+            if self._log_entries >= self.compact_after:
+                self._compact()
+
+    def compact(self):
+        """Folds the append log into a new generation."""
+        with self._locked():
+            self._compact()
+
+    def _compact(self):
+        encodings, names, enrolled_at = self._read_all()
+        self._write_generation(encodings, names, enrolled_at, sources=self._read_sources())
+        print(f"Compacted gallery store: {len(names)} identities")
+
+    def write(self, encodings, names):
+        """Replaces the whole store with the given enrolments (used by migration)."""
+        for name in names:
+            check_name(name)
+        with self._locked():
+            self._write_generation(np.asarray(encodings, dtype=np.float32).reshape(-1, ENCODING_DIM), names)
+
+    def _write_generation(self, encodings, names, enrolled_at=None, sources=None):
+        previous = self._current_dir()
+        number = int(os.path.basename(previous).split('-')[1]) + 1 if previous else 1
+        gen_name = f'gen-{number:06d}'
+        gen_dir = os.path.join(self.root, gen_name)
+        os.makedirs(gen_dir, exist_ok=True)
+
+        matrix = np.lib.format.open_memmap(
+            os.path.join(gen_dir, _ENCODINGS), mode='w+', dtype=np.float32, shape=(len(names), ENCODING_DIM)
+        )
+        matrix[:] = encodings
+        matrix.flush()
+        del matrix
+
+        identities = np.zeros(len(names), dtype=IDENTITY_DTYPE)
+        identities['id'] = np.arange(len(names))
+        identities['name'] = names
+        identities['enrolled_at'] = time.time() if enrolled_at is None else enrolled_at
+        np.save(os.path.join(gen_dir, _IDENTITIES), identities)
+        if sources:
+            with open(os.path.join(gen_dir, _SOURCES), 'w') as f:
+                json.dump(sources, f)
+
+        # Switch generations atomically, then drop the old one
+        tmp_pointer = os.path.join(self.root, _CURRENT + '.tmp')
+        with open(tmp_pointer, 'w') as f:
+            f.write(gen_name)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_pointer, os.path.join(self.root, _CURRENT))
+        self._log_entries = 0
+        self._log_generation = gen_dir
+        if previous and previous != gen_dir:
+            # Readers that already mmapped the old files keep them alive until they close
+            shutil.rmtree(previous, ignore_errors=True)
+
+
+def load_legacy_encodings(faces_dir):
+    """Reads the old one-file-per-person layout (`<name>_encoding.npy`)."""
+    encodings = []
+    names = []
+    if not os.path.isdir(faces_dir):
+        return encodings, names
+    for file in sorted(os.listdir(faces_dir)):
+        if file.endswith(LEGACY_SUFFIX):
+            # Strip the suffix instead of splitting on '_', so names may contain underscores
+            name = file[:-len(LEGACY_SUFFIX)]
+            try:
+                encodings.append(np.load(os.path.join(faces_dir, file)))
+                names.append(name)
+            except Exception as e:
+                print(f"Error loading encoding from {file}: {e}")
+    return encodings, names
+
+
+def migrate_legacy(faces_dir, store, remove_legacy=False):
+    """Copies every legacy per-person encoding into `store`. Returns the migrated names."""
+    encodings, names = load_legacy_encodings(faces_dir)
+    store.write(np.array(encodings, dtype=np.float32).reshape(-1, ENCODING_DIM), names)
+    if remove_legacy:
+        for name in names:
+            os.remove(os.path.join(faces_dir, f'{name}{LEGACY_SUFFIX}'))
+    return names
+
+
+def check_name(name):
+    """Raises ValueError for a name the store cannot hold."""
+    if not name or len(name) > MAX_NAME_LENGTH:
+        raise ValueError(f"Name must be 1-{MAX_NAME_LENGTH} characters long")
+
+
+def _encode_encoding(encoding):
+    return base64.b64encode(encoding.astype('<f4').tobytes()).decode('ascii')
+
+
+def _decode_encoding(text):
+    return np.frombuffer(base64.b64decode(text), dtype='<f4')
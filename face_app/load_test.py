@@ -0,0 +1,337 @@
+"""
+Load generator: many simulated kiosk clients against one local server.
+
+Every client behaves like components/FaceRecognitionCamera.js: it connects,
+sends 'start_recognition', then sends a binary JPEG 'process_frame' whenever
+the server grants a 'ready_for_frame' credit (no faster than --fps), backs off
+on 'server_overloaded', and on 'recognition_complete' records the outcome,
+waits --think-time seconds (the next person stepping up) and starts again.
+
+Reports time-to-sign-in, frames per sign-in, sign-in throughput, error and
+overload rates, and the CPU used by the server and its recognition workers
+(sampled from /proc, so Linux only). Everything runs on this machine; frames
+come from --images (default faces/) with seeded noise variants so the
+embedding cache sees camera-like near-duplicates rather than identical bytes.
+
+Needs the Socket.IO client extras: pip install "python-socketio[client]"
+
+Usage:
+    python load_test.py --spawn-server --clients 50 --duration 60
+    python load_test.py --url http://localhost:5000 --server-pid 1234 --clients 200 --fps 5 --ramp-up 20
+    python load_test.py --spawn-server --clients 20 --output load.json
+"""
+import argparse
+import json
+import os
+import queue
+import signal
+import socket
+import subprocess
+import sys
+import threading
+import time
+from urllib.parse import urlparse
+
+import cv2
+import numpy as np
+import socketio
+
+from benchmark_pipeline import FACES_DIR, JPEG_QUALITY, jitter, load_faces
+
+SERVER_START_TIMEOUT = 120.0 # seconds; the server loads models and forks its workers first
+
+
+def prepare_frames(directory, size, variants, seed):
+    rng = np.random.default_rng(seed)
+    frames = []
+    for _, image in load_faces(directory):
+        resized = cv2.resize(image, size, interpolation=cv2.INTER_AREA)
+        for _ in range(variants):
+            frame = jitter(resized, rng)
+            frames.append(cv2.imencode('.jpg', frame, [cv2.IMWRITE_JPEG_QUALITY, JPEG_QUALITY])[1].tobytes())
+    return frames
+
+
+def process_tree(pid):
+    """`pid` and all of its descendants (reloader child, recognition workers)."""
+    children = {}
+    for entry in os.listdir('/proc'):
+        if entry.isdigit():
+            try:
+                with open(f'/proc/{entry}/stat') as f:
+                    ppid = int(f.read().rsplit(')', 1)[1].split()[1])
+            except (OSError, ValueError, IndexError):
+                continue
+            children.setdefault(ppid, []).append(int(entry))
+    tree, stack = [], [pid]
+    while stack:
+        current = stack.pop()
+        tree.append(current)
+        stack.extend(children.get(current, []))
+    return tree
+
+
+def cpu_seconds(pids):
+    total = 0
+    for pid in pids:
+        try:
+            with open(f'/proc/{pid}/stat') as f:
+                fields = f.read().rsplit(')', 1)[1].split()
+            total += int(fields[11]) + int(fields[12]) # utime + stime
+        except (OSError, ValueError, IndexError):
+            continue # Exited between listing and reading
+    return total / os.sysconf('SC_CLK_TCK')
+
+
+class CPUSampler(threading.Thread):
+    def __init__(self, pid, interval=1.0):
+        super().__init__(daemon=True)
+        self.pid = pid
+        self.interval = interval
+        self.samples = [] # percent of one core, per interval
+        self._stop_event = threading.Event()
+
+    def run(self):
+        last_time, last_cpu = time.perf_counter(), cpu_seconds(process_tree(self.pid))
+        while not self._stop_event.wait(self.interval):
+            now, cpu = time.perf_counter(), cpu_seconds(process_tree(self.pid))
+            self.samples.append(100.0 * (cpu - last_cpu) / (now - last_time))
+            last_time, last_cpu = now, cpu
+
+    def stop(self):
+        self._stop_event.set()
+        self.join()
+
+
+class Stats:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.time_to_sign_in = []
+        self.time_to_failure = []
+        self.frames_per_sign_in = []
+        self.frames_sent = 0
+        self.errors = 0
+        self.overloaded = 0
+        self.timeouts = 0
+        self.connect_failures = 0
+        self.disconnects = 0
+
+    def add(self, **counts):
+        with self.lock:
+            for key, value in counts.items():
+                setattr(self, key, getattr(self, key) + value)
+
+    def attempt(self, signed_in, seconds, frames):
+        with self.lock:
+            if signed_in:
+                self.time_to_sign_in.append(seconds)
+                self.frames_per_sign_in.append(frames)
+            else:
+                self.time_to_failure.append(seconds)
+
+
+class KioskClient(threading.Thread):
+    def __init__(self, index, url, frames, fps, think_time, reply_timeout, stop_at, stats, transports):
+        super().__init__(daemon=True)
+        self.index = index
+        self.url = url
+        self.frames = frames
+        self.interval = 1.0 / fps if fps > 0 else 0.0
+        self.think_time = think_time
+        self.reply_timeout = reply_timeout
+        self.stop_at = stop_at
+        self.stats = stats
+        self.transports = transports
+        self.events = queue.Queue()
+        self.sio = socketio.Client(reconnection=False)
+        self.sio.on('ready_for_frame', lambda data=None: self.events.put(('credit', None)))
+        self.sio.on('server_overloaded', lambda data: self.events.put(('overloaded', data)))
+        self.sio.on('recognition_complete', lambda data: self.events.put(('complete', data)))
+        self.sio.on('session_expired', lambda data: self.events.put(('expired', data)))
+        self.sio.on('error', lambda data: self.stats.add(errors=1))
+        self.sio.on('disconnect', lambda *args: self.events.put(('disconnected', None)))
+
+    def run(self):
+        try:
+            self.sio.connect(self.url, transports=self.transports, wait_timeout=self.reply_timeout)
+        except Exception as e:
+            print(f"client {self.index}: connect failed: {e}")
+            self.stats.add(connect_failures=1)
+            return
+        try:
+            while time.monotonic() < self.stop_at and self.sio.connected:
+                if not self.attempt():
+                    break
+                time.sleep(self.think_time)
+        finally:
+            self.sio.disconnect()
+
+    def attempt(self):
+        """One sign-in attempt; returns False when the client should stop."""
+        while not self.events.empty():
+            self.events.get_nowait() # Leftovers from the previous attempt
+        started = time.perf_counter()
+        sent, next_send = 0, 0.0
+        self.sio.emit('start_recognition')
+        while time.monotonic() < self.stop_at:
+            try:
+                kind, data = self.events.get(timeout=self.reply_timeout)
+            except queue.Empty:
+                self.stats.add(timeouts=1)
+                return False
+            if kind == 'complete':
+                self.stats.attempt(bool(data.get('is_signed_in')), time.perf_counter() - started, sent)
+                return True
+            if kind in ('disconnected', 'expired'):
+                self.stats.add(disconnects=1)
+                return False
+            if kind == 'overloaded':
+                self.stats.add(overloaded=1)
+                time.sleep(data.get('retry_after_ms', 500) / 1000.0)
+            # A credit (or a retry after overload): send the next frame, paced to --fps
+            delay = next_send - time.perf_counter()
+            if delay > 0:
+                time.sleep(delay)
+            next_send = time.perf_counter() + self.interval
+            self.sio.emit('process_frame', {'image': self.frames[(self.index + sent) % len(self.frames)]})
+            sent += 1
+            self.stats.add(frames_sent=1)
+        return False
+
+
+def wait_for_port(url, process, timeout):
+    address = urlparse(url)
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        if process is not None and process.poll() is not None:
+            sys.exit(f"Server exited with status {process.returncode}")
+        try:
+            with socket.create_connection((address.hostname, address.port or 80), timeout=1.0):
+                return
+        except OSError:
+            time.sleep(0.5)
+    sys.exit(f"Server at {url} did not come up within {timeout:.0f}s")
+
+
+def percentiles(values):
+    if not values:
+        return None
+    p50, p95, p99 = np.percentile(values, [50, 95, 99])
+    return {"p50": round(float(p50), 3), "p95": round(float(p95), 3), "p99": round(float(p99), 3),
+            "mean": round(float(np.mean(values)), 3)}
+
+
+def summarize(stats, elapsed, clients, cpu_samples):
+    attempts = len(stats.time_to_sign_in) + len(stats.time_to_failure)
+    failures = stats.errors + stats.timeouts + stats.connect_failures + stats.disconnects
+    return {
+        "clients": clients,
+        "elapsed_s": round(elapsed, 1),
+        "attempts": attempts,
+        "sign_ins": len(stats.time_to_sign_in),
+        "sign_ins_per_s": round(len(stats.time_to_sign_in) / elapsed, 3),
+        "failed_attempts": len(stats.time_to_failure),
+        "time_to_sign_in_s": percentiles(stats.time_to_sign_in),
+        "time_to_failure_s": percentiles(stats.time_to_failure),
+        "frames_per_sign_in": percentiles(stats.frames_per_sign_in),
+        "frames_sent": stats.frames_sent,
+        "frames_per_s": round(stats.frames_sent / elapsed, 2),
+        "errors": stats.errors,
+        "timeouts": stats.timeouts,
+        "connect_failures": stats.connect_failures,
+        "disconnects": stats.disconnects,
+        "error_rate": round(failures / max(1, stats.frames_sent), 4),
+        "overloaded": stats.overloaded,
+        "overload_rate": round(stats.overloaded / max(1, stats.frames_sent), 4),
+        "server_cpu_percent": percentiles(cpu_samples),
+        "cpus": os.cpu_count(),
+    }
+
+
+def report(summary):
+    print(f"\n{summary['clients']} clients for {summary['elapsed_s']}s: {summary['attempts']} attempts, "
+          f"{summary['sign_ins']} sign-ins ({summary['sign_ins_per_s']}/s), "
+          f"{summary['failed_attempts']} failed or unknown")
+    for key, unit in (("time_to_sign_in_s", "s"), ("time_to_failure_s", "s"), ("frames_per_sign_in", "frames"),
+                      ("server_cpu_percent", f"% of one core ({summary['cpus']} cores)")):
+        values = summary[key]
+        if values:
+            print(f"  {key:<20} p50 {values['p50']:8.2f}  p95 {values['p95']:8.2f}  p99 {values['p99']:8.2f}  "
+                  f"mean {values['mean']:8.2f} {unit}")
+    print(f"  frames sent {summary['frames_sent']} ({summary['frames_per_s']}/s), overloaded "
+          f"{summary['overloaded']} ({summary['overload_rate']:.1%}), errors {summary['errors']}, "
+          f"timeouts {summary['timeouts']}, connect failures {summary['connect_failures']}, "
+          f"disconnects {summary['disconnects']} (error rate {summary['error_rate']:.2%})")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--url', default='http://localhost:5000')
+    parser.add_argument('--spawn-server', action='store_true', help="Start app.py for the run and stop it afterwards")
+    parser.add_argument('--server-pid', type=int, default=None, help="PID of an already running server, for CPU")
+    parser.add_argument('--clients', type=int, default=10)
+    parser.add_argument('--ramp-up', type=float, default=5.0, help="Seconds over which clients connect")
+    parser.add_argument('--duration', type=float, default=60.0, help="Seconds of load after the ramp-up starts")
+    parser.add_argument('--fps', type=float, default=5.0, help="Upper bound on frames per second per client")
+    parser.add_argument('--think-time', type=float, default=1.0, help="Seconds between one sign-in and the next")
+    parser.add_argument('--images', default=FACES_DIR, help="Directory of face images to send")
+    parser.add_argument('--resolution', default='640x480', help="WIDTHxHEIGHT of the frames sent")
+    parser.add_argument('--variants', type=int, default=5, help="Noisy variants per image")
+    parser.add_argument('--transport', default='websocket', choices=['websocket', 'polling'])
+    parser.add_argument('--reply-timeout', type=float, default=30.0, help="Seconds to wait for any reply")
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--output', metavar='PATH', help="Also write the summary as JSON")
+    args = parser.parse_args()
+
+    here = os.path.dirname(os.path.abspath(__file__))
+    width, height = (int(v) for v in args.resolution.split('x'))
+    frames = prepare_frames(os.path.join(here, args.images), (width, height), args.variants, args.seed)
+    if not frames:
+        sys.exit(f"No images found in {args.images}/")
+
+    server, server_pid = None, args.server_pid
+    if args.spawn_server:
+        # Own process group, so stopping it also stops its workers (and a debug reloader child)
+        server = subprocess.Popen([sys.executable, 'app.py'], cwd=here, start_new_session=True,
+                                  stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        server_pid = server.pid
+    wait_for_port(args.url, server, SERVER_START_TIMEOUT)
+
+    sampler = CPUSampler(server_pid) if server_pid and os.path.isdir('/proc') else None
+    if sampler is not None:
+        sampler.start()
+    stats = Stats()
+    started = time.monotonic()
+    stop_at = started + args.duration
+    transports = ['websocket'] if args.transport == 'websocket' else ['polling']
+    clients = []
+    try:
+        for i in range(args.clients):
+            client = KioskClient(i, args.url, frames, args.fps, args.think_time, args.reply_timeout,
+                                 stop_at, stats, transports)
+            client.start()
+            clients.append(client)
+            if args.clients > 1:
+                time.sleep(args.ramp_up / args.clients)
+        while any(client.is_alive() for client in clients) and time.monotonic() < stop_at + args.reply_timeout:
+            time.sleep(0.5)
+    except KeyboardInterrupt:
+        print("Interrupted, reporting what was measured so far")
+    finally:
+        elapsed = time.monotonic() - started
+        if sampler is not None:
+            sampler.stop()
+        if server is not None:
+            os.killpg(server.pid, signal.SIGTERM)
+            server.wait(timeout=30)
+
+    summary = summarize(stats, elapsed, args.clients, sampler.samples if sampler is not None else [])
+    report(summary)
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(summary, f, indent=2)
+        print(f"Summary written to {args.output}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,218 @@
+"""
+Lightweight in-process metrics: per-stage latency histograms and counters,
+rendered in the Prometheus text format for the /metrics endpoint.
+
+Stage timings (decode, detection, encoding, ...) are measured where the work
+happens - mostly in the recognition workers, which already return them with
+each frame's result - and recorded here in the server process, so the
+histograms cover every worker. Histograms use fixed millisecond buckets, so
+recording is a bisect and two additions under a lock, and p50/p95/p99 are
+estimated from the buckets the way Prometheus' histogram_quantile does.
+
+A disabled `Metrics` returns immediately from every recording call, so the
+instrumentation can stay in place when metrics are switched off.
+
+`process_uptime` and `process_memory` read /proc, for reporting how long the
+server took to start and what its master and worker processes cost.
+"""
+import os
+import threading
+import time
+from bisect import bisect_left
+from contextlib import contextmanager
+
+# Upper bounds in milliseconds; faster than 0.5 ms is noise, slower than 5 s is a stall
+DEFAULT_BUCKETS_MS = (0.5, 1, 2, 5, 10, 20, 50, 100, 200, 500, 1000, 2000, 5000)
+QUANTILES = (0.5, 0.95, 0.99)
+
+
+class Histogram:
+    def __init__(self, buckets=DEFAULT_BUCKETS_MS):
+        self.buckets = tuple(sorted(buckets))
+        self.counts = [0] * (len(self.buckets) + 1) # Last slot: above the largest bound
+        self.count = 0
+        self.sum = 0.0
+        self.max = 0.0
+        self._lock = threading.Lock()
+
+    def observe(self, value):
+        slot = bisect_left(self.buckets, value)
+        with self._lock:
+            self.counts[slot] += 1
+            self.count += 1
+            self.sum += value
+            if value > self.max:
+                self.max = value
+
+    def quantile(self, q):
+        """Estimate by linear interpolation inside the bucket holding the q-th observation."""
+        with self._lock:
+            counts, count, largest = list(self.counts), self.count, self.max
+        if count == 0:
+            return 0.0
+        rank = q * count
+        seen = 0
+        for slot, in_bucket in enumerate(counts):
+            if in_bucket and seen + in_bucket >= rank:
+                lower = self.buckets[slot - 1] if slot > 0 else 0.0
+                upper = self.buckets[slot] if slot < len(self.buckets) else largest
+                return min(largest, lower + (upper - lower) * (rank - seen) / in_bucket)
+            seen += in_bucket
+        return largest
+
+    def snapshot(self):
+        summary = {f"p{int(q * 100)}": round(self.quantile(q), 3) for q in QUANTILES}
+        with self._lock:
+            summary.update({"count": self.count, "mean": round(self.sum / self.count, 3) if self.count else 0.0,
+                            "max": round(self.max, 3)})
+        return summary
+
+
+class Metrics:
+    def __init__(self, namespace='face_app', enabled=True, buckets=DEFAULT_BUCKETS_MS):
+        self.namespace = namespace
+        self.enabled = enabled
+        self.buckets = buckets
+        self._stages = {} # stage -> Histogram
+        self._counters = {} # (name, labels) -> value
+        self._gauges = {} # name -> (help, callable returning a number)
+        self._help = {}
+        self._lock = threading.Lock()
+
+    def observe(self, stage, ms):
+        if not self.enabled:
+            return
+        histogram = self._stages.get(stage)
+        if histogram is None:
+            with self._lock:
+                histogram = self._stages.setdefault(stage, Histogram(self.buckets))
+        histogram.observe(ms)
+
+    def observe_timings(self, timings, prefix=''):
+        """Records a result's {stage: ms} timings dict."""
+        if not self.enabled:
+            return
+        for stage, ms in timings.items():
+            self.observe(prefix + stage, ms)
+
+    @contextmanager
+    def timer(self, stage):
+        if not self.enabled:
+            yield
+            return
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(stage, (time.perf_counter() - started) * 1000.0)
+
+    def inc(self, name, amount=1, help=None, **labels):
+        if not self.enabled:
+            return
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            self._counters[key] = self._counters.get(key, 0) + amount
+            if help and name not in self._help:
+                self._help[name] = help
+
+    def gauge(self, name, read, help=''):
+        """Registers a gauge whose value `read()` is taken at scrape time."""
+        self._gauges[name] = (help, read)
+
+    def reset(self):
+        """Drops all recorded observations and counters (gauges stay registered)."""
+        with self._lock:
+            self._stages.clear()
+            self._counters.clear()
+
+    def stages(self):
+        with self._lock:
+            stages = dict(self._stages)
+        return {stage: histogram.snapshot() for stage, histogram in sorted(stages.items())}
+
+    def render(self):
+        """All metrics in the Prometheus text exposition format (latencies in seconds)."""
+        ns = self.namespace
+        lines = []
+        with self._lock:
+            stages = sorted(self._stages.items())
+            counters = sorted(self._counters.items())
+            help_texts = dict(self._help)
+
+        if stages:
+            name = f"{ns}_stage_duration_seconds"
+            lines += [f"# HELP {name} Time spent per frame processing stage.", f"# TYPE {name} histogram"]
+            for stage, histogram in stages:
+                with histogram._lock:
+                    counts, count, total = list(histogram.counts), histogram.count, histogram.sum
+                cumulative = 0
+                for bound, in_bucket in zip(histogram.buckets, counts):
+                    cumulative += in_bucket
+                    lines.append(f'{name}_bucket{{stage="{stage}",le="{bound / 1000.0:g}"}} {cumulative}')
+                lines.append(f'{name}_bucket{{stage="{stage}",le="+Inf"}} {count}')
+                lines.append(f'{name}_sum{{stage="{stage}"}} {total / 1000.0:.6f}')
+                lines.append(f'{name}_count{{stage="{stage}"}} {count}')
+
+            name = f"{ns}_stage_duration_quantile_seconds"
+            lines += [f"# HELP {name} Estimated p50/p95/p99 per stage since start.", f"# TYPE {name} gauge"]
+            for stage, histogram in stages:
+                for q in QUANTILES:
+                    lines.append(f'{name}{{stage="{stage}",quantile="{q}"}} {histogram.quantile(q) / 1000.0:.6f}')
+
+        typed = set()
+        for (name, labels), value in counters:
+            full = f"{ns}_{name}_total"
+            if name not in typed:
+                typed.add(name)
+                if name in help_texts:
+                    lines.append(f"# HELP {full} {help_texts[name]}")
+                lines.append(f"# TYPE {full} counter")
+            label_text = ",".join(f'{key}="{label}"' for key, label in labels)
+            lines.append(f"{full}{{{label_text}}} {value}" if label_text else f"{full} {value}")
+
+        for name, (help_text, read) in sorted(self._gauges.items()):
+            try:
+                value = read()
+            except Exception as e:
+                print(f"Error reading gauge {name}: {e}")
+                continue
+            full = f"{ns}_{name}"
+            if help_text:
+                lines.append(f"# HELP {full} {help_text}")
+            lines += [f"# TYPE {full} gauge", f"{full} {value}"]
+        return "\n".join(lines) + "\n"
+
+
+def process_uptime(pid='self'):
+    """Seconds since the process started, from /proc (None where that is unavailable)."""
+    try:
+        with open(f'/proc/{pid}/stat') as f:
+            start_ticks = int(f.read().rsplit(')', 1)[1].split()[19]) # Field 22, counted after the command name
+        with open('/proc/uptime') as f:
+            uptime = float(f.read().split()[0])
+    except (OSError, ValueError, IndexError):
+        return None
+    return uptime - start_ticks / os.sysconf('SC_CLK_TCK')
+
+
+def process_memory(pid='self'):
+    """
+    Memory of a process in MB, from /proc/<pid>/smaps_rollup: rss, pss (shared
+    pages split between the processes mapping them) and private (pages no other
+    process maps - what a forked worker really adds). Empty where unavailable.
+    """
+    fields = {}
+    try:
+        with open(f'/proc/{pid}/smaps_rollup') as f:
+            for line in f:
+                key, _, value = line.partition(':')
+                if value.rstrip().endswith('kB'):
+                    fields[key] = int(value.split()[0])
+    except (OSError, ValueError):
+        return {}
+    mb = lambda kb: round(kb / 1024.0, 1)
+    return {
+        "rss_mb": mb(fields.get('Rss', 0)),
+        "pss_mb": mb(fields.get('Pss', 0)),
+        "private_mb": mb(fields.get('Private_Clean', 0) + fields.get('Private_Dirty', 0)),
+    }
@@ -0,0 +1,33 @@
+"""
+One-shot migration from the old per-person `<name>_encoding.npy` files to the
+memory-mapped gallery store (see gallery_store.py).
+
+Usage:
+    python migrate_gallery.py
+    python migrate_gallery.py --faces faces --store faces/gallery --remove-legacy
+"""
+import argparse
+import os
+
+from gallery_store import GalleryStore, migrate_legacy
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--faces', default='faces', help="Directory holding the legacy *_encoding.npy files")
+    parser.add_argument('--store', default=None, help="Gallery store directory (default <faces>/gallery)")
+    parser.add_argument('--remove-legacy', action='store_true', help="Delete the .npy files once migrated")
+    parser.add_argument('--force', action='store_true', help="Overwrite an existing gallery store")
+    args = parser.parse_args()
+
+    store = GalleryStore(args.store or os.path.join(args.faces, 'gallery'))
+    if store.exists() and not args.force:
+        print(f"Gallery store already exists at '{store.root}'. Use --force to overwrite it.")
+        return
+
+    names = migrate_legacy(args.faces, store, remove_legacy=args.remove_legacy)
+    print(f"Migrated {len(names)} identities into '{store.root}': {names}")
+
+
+if __name__ == '__main__':
+    main()
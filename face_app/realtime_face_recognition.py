@@ -1,32 +1,31 @@
 import cv2
 import face_recognition
-import numpy as np
+import multiprocessing
 import os
 from collections import Counter
 import time
+import threading
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from gallery_store import GalleryStore
+from frame_pipeline import FramePipeline, format_timings
+from face_detectors import detector_from_env
 
 # Path for saved encodings
 encodings_path = 'faces'
 
-# Load encodings and class names
+# Load encodings and class names from the gallery store (see migrate_gallery.py)
 def load_encodings(encodings_path):
-    encodings = []
-    class_names = []
-    
     if not os.path.exists(encodings_path):
         print(f"Error: Encodings path '{encodings_path}' does not exist.")
         return [], []
 
-    for file in os.listdir(encodings_path):
-        if file.endswith("_encoding.npy"):
-            class_name = file.split('_')[0]
-            try:
-                encoding = np.load(os.path.join(encodings_path, file))
-                encodings.append(encoding)
-                class_names.append(class_name)
-            except Exception as e:
-                print(f"Error loading encoding from {file}: {e}")
-    return encodings, class_names
+    store = GalleryStore(os.path.join(encodings_path, 'gallery'))
+    if not store.exists():
+        print("No gallery store found. Run 'migrate_gallery.py' to convert old *_encoding.npy files.")
+        return [], []
+    return store.read_all()
 
 # Face detection state management
 class FaceDetectionState:
@@ -36,6 +35,7 @@ class FaceDetectionState:
         self.confirmed_user = None
         self.sign_in_time = None
         self.is_signed_in = False
+        self.attempt = 0 # Bumped on reset, so frames captured before it are dropped
         
     def add_detection(self, name):
         self.detection_count += 1
@@ -74,11 +74,12 @@ class FaceDetectionState:
         self.confirmed_user = None
         self.sign_in_time = None
         self.is_signed_in = False
+        self.attempt += 1
         print("\n🔄 Detection reset. Starting new recognition cycle...")
 
 known_encodings, class_names = load_encodings(encodings_path)
 
-if not known_encodings:
+if not class_names:
     print("No known face encodings found. Please run 'capture_training_images.py' first.")
     exit()
 
@@ -93,32 +94,53 @@ if not cap.isOpened():
 
 # Initialize face detection state
 face_state = FaceDetectionState()
+state_lock = threading.Lock() # The recognition thread adds detections while the render loop may reset
 
-# Downscale factor for performance (0.25 means 1/4th resolution)
-scale_factor = 0.25
+# Shared adaptive downscaling: the detection scale is picked from the frame size.
+# The detector backend is configured like the server's (FACE_DETECTOR, HOG_UPSAMPLE, ...).
+face_detector = detector_from_env()
+print(f"Face detector: {face_detector}")
+frame_pipeline = FramePipeline(detect=face_detector)
 
-print("\n--- Real-Time Face Recognition with 5-Detection Averaging ---")
-print("📋 Instructions:")
-print("  - Look directly at the camera for accurate detection")
-print("  - System will analyze first 5 detections to confirm identity")
-print("  - Press 'r' to RESET and start new detection cycle")
-print("  - Press 'q' to QUIT the recognition system")
-print("\n🎯 Starting detection cycle...")
+# Pipelined mode: a capture thread keeps only the newest camera frame, a recognition
+# thread hands the newest frame to a worker process at its own pace, and the main loop
+# redraws the last known boxes on every camera frame. The worker is a process, not the
+# thread itself, because dlib holds the GIL while it detects and encodes, which would
+# stall capture and drawing. REALTIME_PIPELINED=0 runs everything in one loop.
+PIPELINED = os.environ.get('REALTIME_PIPELINED', '1') == '1'
+
+def recognize(frame):
+    """Detects and identifies the first face; returns (result, [(name, box)])."""
+    # Detected at reduced resolution, boxes mapped back to the full frame
+    result = frame_pipeline.process(frame, max_faces=1)
+    faces = []
+    for face_encoding, face_location in zip(result["encodings"], result["locations"]):
+        # Compare current face with known faces
+        matches = face_recognition.compare_faces(known_encodings, face_encoding, tolerance=0.6)
+        name = "Unknown"
+
+        # If a match was found in known_face_encodings, use the first one
+        if True in matches:
+            first_match_index = matches.index(True)
+            name = class_names[first_match_index]
+        faces.append((name, face_location))
 
-while True:
-    success, frame = cap.read()
-    if not success:
-        print("Failed to capture frame from webcam. Exiting.")
+        # Break after first face to avoid multiple simultaneous detections
         break
+    return result, faces
 
+def collecting_detections():
+    return not face_state.is_signed_in and face_state.detection_count < 5
+
+def draw_status(frame):
     # Create info overlay
     overlay_y = 30
-    
+
     # Show current detection count and status
     if not face_state.is_signed_in:
         status_text = f"Detections: {face_state.detection_count}/5"
         cv2.putText(frame, status_text, (10, overlay_y), cv2.FONT_HERSHEY_SIMPLEX, 0.7, (0, 255, 255), 2)
-        
+
         if face_state.detection_count > 0:
             history_text = f"History: {', '.join(face_state.detection_history[-3:])}"  # Show last 3
             cv2.putText(frame, history_text, (10, overlay_y + 30), cv2.FONT_HERSHEY_SIMPLEX, 0.5, (255, 255, 0), 1)
@@ -129,61 +151,140 @@ while True:
         cv2.putText(frame, user_text, (10, overlay_y), cv2.FONT_HERSHEY_SIMPLEX, 0.7, (0, 255, 0), 2)
         cv2.putText(frame, time_text, (10, overlay_y + 30), cv2.FONT_HERSHEY_SIMPLEX, 0.5, (0, 255, 0), 1)
 
-    # Only process face detection if not signed in or still collecting samples
-    if not face_state.is_signed_in and face_state.detection_count < 5:
-        # Resize frame for faster processing
-        small_frame = cv2.resize(frame, (0, 0), fx=scale_factor, fy=scale_factor)
-        
-        # Convert the image from BGR color (which OpenCV uses) to RGB color (which face_recognition uses)
-        rgb_small_frame = cv2.cvtColor(small_frame, cv2.COLOR_BGR2RGB)
+def draw_faces(frame, faces):
+    for name, (y1, x2, y2, x1) in faces:
+        # Choose color based on detection status
+        if name == "Unknown":
+            color = (0, 0, 255)  # Red for unknown
+        else:
+            color = (0, 255, 0)  # Green for known
 
-        # Find all the faces and face encodings in the current frame of video
-        face_locations = face_recognition.face_locations(rgb_small_frame)
-        face_encodings = face_recognition.face_encodings(rgb_small_frame, face_locations)
+        # Draw a rectangle around the face
+        cv2.rectangle(frame, (x1, y1), (x2, y2), color, 2)
 
-        # Process each detected face (typically we expect one face for sign-in)
-        for face_encoding, face_location in zip(face_encodings, face_locations):
-            # Compare current face with known faces
-            matches = face_recognition.compare_faces(known_encodings, face_encoding, tolerance=0.6)
-            name = "Unknown"
+        # Draw a label with a name below the face
+        cv2.rectangle(frame, (x1, y2 - 25), (x2, y2), color, cv2.FILLED)
+        font = cv2.FONT_HERSHEY_DUPLEX
+        cv2.putText(frame, name.upper(), (x1 + 6, y2 - 6), font, 0.7, (255, 255, 255), 1)
 
-            # If a match was found in known_face_encodings, use the first one
-            if True in matches:
-                first_match_index = matches.index(True)
-                name = class_names[first_match_index]
+def draw_footer(frame, text):
+    cv2.putText(frame, text, (10, frame.shape[0] - 10), cv2.FONT_HERSHEY_SIMPLEX, 0.4, (200, 200, 200), 1)
 
-            # Add detection to history
-            face_state.add_detection(name)
+class RateMeter:
+    """Events per second over the last `window` seconds."""
+    def __init__(self, window=2.0):
+        self.window = window
+        self.times = deque()
+        self.lock = threading.Lock()
 
-            # Scale back up face locations to original frame size
-            y1, x2, y2, x1 = [int(loc / scale_factor) for loc in face_location]
+    def tick(self):
+        now = time.perf_counter()
+        with self.lock:
+            self.times.append(now)
+            while now - self.times[0] > self.window:
+                self.times.popleft()
 
-            # Choose color based on detection status
-            if name == "Unknown":
-                color = (0, 0, 255)  # Red for unknown
-            else:
-                color = (0, 255, 0)  # Green for known
+    def rate(self):
+        with self.lock:
+            if len(self.times) < 2:
+                return 0.0
+            return (len(self.times) - 1) / (self.times[-1] - self.times[0])
+
+class LatestFrame:
+    """Single-slot buffer: writers replace the frame, readers wait for a newer one."""
+    def __init__(self):
+        self.condition = threading.Condition()
+        self.frame = None
+        self.seq = 0
+        self.captured_at = 0.0
+        self.closed = False
 
-            # Draw a rectangle around the face
-            cv2.rectangle(frame, (x1, y1), (x2, y2), color, 2)
+    def put(self, frame):
+        with self.condition:
+            self.frame, self.captured_at = frame, time.perf_counter()
+            self.seq += 1
+            self.condition.notify_all()
 
-            # Draw a label with a name below the face
-            cv2.rectangle(frame, (x1, y2 - 25), (x2, y2), color, cv2.FILLED)
-            font = cv2.FONT_HERSHEY_DUPLEX
-            cv2.putText(frame, name.upper(), (x1 + 6, y2 - 6), font, 0.7, (255, 255, 255), 1)
+    def wait_newer(self, seq, timeout=None):
+        """Returns (seq, frame, captured_at) newer than `seq`, or None once closed."""
+        with self.condition:
+            self.condition.wait_for(lambda: self.seq > seq or self.closed, timeout)
+            if self.closed or self.seq <= seq:
+                return None
+            return self.seq, self.frame, self.captured_at
 
-            # Break after first face to avoid multiple simultaneous detections
+    def close(self):
+        with self.condition:
+            self.closed = True
+            self.condition.notify_all()
+
+def capture_loop(latest, capture_rate):
+    # Reading continuously keeps the driver's queue empty, so frames are never stale
+    while not latest.closed:
+        success, frame = cap.read()
+        if not success:
+            print("Failed to capture frame from webcam. Exiting.")
             break
+        latest.put(frame)
+        capture_rate.tick()
+    latest.close()
+
+class RecognitionOutput:
+    """What the render loop draws: the newest recognized faces and how old they are."""
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.faces = []
+        self.captured_at = None # Capture time of the frame the faces were found in
+        self.latency = 0.0 # Capture to result, seconds
+        self.text = ""
 
-    # Display the resulting image
-    cv2.imshow("Face Recognition System - Press 'r' to reset, 'q' to quit", frame)
+def recognition_loop(latest, output, recognition_rate, recognizer):
+    seq = 0
+    while True:
+        if not collecting_detections():
+            with output.lock:
+                output.faces = [] # Nothing more to recognize until reset
+            time.sleep(0.05)
+            if latest.closed:
+                break
+            continue
+        newest = latest.wait_newer(seq, timeout=0.5)
+        if newest is None:
+            if latest.closed:
+                break
+            continue
+        seq, frame, captured_at = newest
+        with state_lock:
+            attempt = face_state.attempt
+        try:
+            result, faces = recognizer.submit(recognize, frame).result()
+        except BrokenProcessPool as e:
+            print(f"Recognition worker died: {e}") # The preview keeps running without recognition
+            break
+        except Exception as e:
+            print(f"Error recognizing frame: {e}") # Keep the preview running; try the next frame
+            continue
+        with state_lock:
+            if face_state.attempt != attempt:
+                # Reset while recognizing: the frame may show the previous person
+                continue
+            if collecting_detections():
+                for name, _ in faces:
+                    face_state.add_detection(name)
+        recognition_rate.tick()
+        with output.lock:
+            output.faces = faces
+            output.captured_at = captured_at
+            output.latency = time.perf_counter() - captured_at
+            output.text = f"Scale {result['scale']:.2f} | ms: {format_timings(result['timings'])}"
 
-    key = cv2.waitKey(1) & 0xFF
-    
+def handle_key(key):
+    """Returns False when the user quits."""
     # Reset detection when 'r' is pressed
     if key == ord('r'):
-        face_state.reset()
-    
+        with state_lock:
+            face_state.reset()
+
     # Hit 'q' on the keyboard to quit
     elif key == ord('q'):
         if face_state.is_signed_in:
@@ -192,9 +293,103 @@ while True:
             print(f"   - User: {face_state.confirmed_user}")
             print(f"   - Sign-in Time: {face_state.sign_in_time}")
             print(f"   - Detection History: {face_state.detection_history}")
-        break
+        return False
+    return True
+
+WINDOW_NAME = "Face Recognition System - Press 'r' to reset, 'q' to quit"
+
+def run_sequential():
+    while True:
+        success, frame = cap.read()
+        if not success:
+            print("Failed to capture frame from webcam. Exiting.")
+            break
+
+        draw_status(frame)
+
+        # Only process face detection if not signed in or still collecting samples
+        if collecting_detections():
+            result, faces = recognize(frame)
+            draw_footer(frame, f"Scale {result['scale']:.2f} | ms: {format_timings(result['timings'])}")
+            for name, _ in faces:
+                # Add detection to history
+                face_state.add_detection(name)
+            draw_faces(frame, faces)
+
+        # Display the resulting image
+        cv2.imshow(WINDOW_NAME, frame)
+
+        if not handle_key(cv2.waitKey(1) & 0xFF):
+            break
+
+def run_pipelined():
+    cap.set(cv2.CAP_PROP_BUFFERSIZE, 1) # Not every backend honours it; the capture thread drains anyway
+    latest = LatestFrame()
+    output = RecognitionOutput()
+    capture_rate, recognition_rate, display_rate = RateMeter(), RateMeter(), RateMeter()
+    # fork: the worker inherits the loaded models and known encodings. It is started here,
+    # before any other thread exists, so no lock can be copied into it held.
+    frame_pipeline.warm_up()
+    recognizer = ProcessPoolExecutor(max_workers=1, mp_context=multiprocessing.get_context('fork'))
+    recognizer.submit(int).result()
+    threads = [
+        threading.Thread(target=capture_loop, args=(latest, capture_rate), daemon=True),
+        threading.Thread(target=recognition_loop, args=(latest, output, recognition_rate, recognizer), daemon=True),
+    ]
+    for thread in threads:
+        thread.start()
+
+    seq = 0
+    # imshow/waitKey stay on the main thread, as most GUI backends require
+    while True:
+        newest = latest.wait_newer(seq, timeout=1.0)
+        if newest is None:
+            if latest.closed:
+                break
+            continue
+        seq, frame, _ = newest
+        frame = frame.copy() # The recognition thread may be reading the same frame
+
+        with state_lock:
+            draw_status(frame)
+        with output.lock:
+            faces, captured_at, latency, text = output.faces, output.captured_at, output.latency, output.text
+        draw_faces(frame, faces) # Last known boxes, redrawn on every camera frame
+        box_age = (time.perf_counter() - captured_at) * 1000.0 if captured_at is not None else 0.0
+        display_rate.tick()
+        cv2.putText(frame, f"Display {display_rate.rate():.1f} fps | camera {capture_rate.rate():.1f} fps | "
+                           f"recognition {recognition_rate.rate():.1f} fps",
+                    (10, frame.shape[0] - 45), cv2.FONT_HERSHEY_SIMPLEX, 0.45, (200, 200, 200), 1)
+        cv2.putText(frame, f"Result latency {latency * 1000.0:.0f} ms | box age {box_age:.0f} ms",
+                    (10, frame.shape[0] - 27), cv2.FONT_HERSHEY_SIMPLEX, 0.45, (200, 200, 200), 1)
+        draw_footer(frame, text)
+
+        # Display the resulting image
+        cv2.imshow(WINDOW_NAME, frame)
+
+        if not handle_key(cv2.waitKey(1) & 0xFF):
+            break
+
+    latest.close()
+    for thread in threads:
+        thread.join(timeout=2.0)
+    # Waiting lets the executor close its pipes before the interpreter tears them down
+    recognizer.shutdown(wait=True, cancel_futures=True)
+
+print("\n--- Real-Time Face Recognition with 5-Detection Averaging ---")
+print("📋 Instructions:")
+print("  - Look directly at the camera for accurate detection")
+print("  - System will analyze first 5 detections to confirm identity")
+print("  - Press 'r' to RESET and start new detection cycle")
+print("  - Press 'q' to QUIT the recognition system")
+print(f"\n🎯 Starting detection cycle ({'pipelined' if PIPELINED else 'single-threaded'})...")
+
+if PIPELINED:
+    run_pipelined()
+else:
+    run_sequential()
 
 # Release handle to the webcam
 cap.release()
 cv2.destroyAllWindows()
-print("Resources released.")
\ No newline at end of file
+print("Resources released.")
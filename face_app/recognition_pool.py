@@ -0,0 +1,351 @@
+"""
+Bounded worker pool for per-frame recognition work.
+
+Socket.IO handlers only validate a frame and hand it to `RecognitionPool.submit`;
+frames arrive as binary JPEG attachments (or base64 strings from older clients).
+Unwrapping, image decode, detection and encoding run in a fixed-size process
+pool (dlib holds the GIL for long stretches, so threads would not scale). The
+gallery match stays in the server process, where the live gallery is.
+
+Admission is explicit and never blocks the handler:
+  ACCEPTED   - dispatched; `on_done(result, stream)` is called from a pool thread
+  QUEUED     - this session already has a frame in flight; the new frame is held
+               as the session's next frame, replacing (dropping) any older one
+               still waiting, so only the freshest frame is processed next
+  OVERLOADED - `max_pending` sessions already have frames in flight server-wide
+
+Each session therefore holds at most one frame in flight and one waiting, no
+matter how fast its client sends. The session's `FrameStream` (face track and
+embedding cache) travels to the worker with each frame and comes back advanced.
+
+With `batch_size` > 1, dispatched frames of different sessions are collected
+for up to `batch_wait_ms` (or until `batch_size` are ready) and sent to a
+worker as one task, which encodes all of their faces in one dlib batch. The
+optional `on_batch(results)` hook then sees the whole batch before results are
+fanned out per session, so the gallery match can be batched too.
+"""
+import atexit
+import base64
+import multiprocessing
+import threading
+import time
+from concurrent.futures import Future, ProcessPoolExecutor
+
+import cv2
+import numpy as np
+
+from frame_pipeline import FramePipeline, encode_photo
+
+ACCEPTED = 'accepted'
+QUEUED = 'queued'
+OVERLOADED = 'overloaded'
+
+_pipeline = None # Per-process pipeline, created by _init_worker
+
+
+class FrameStream:
+    """Per-session state a frame is processed with: the face track and the session's embedding cache."""
+
+    def __init__(self, tracker=None, cache=None):
+        self.tracker = tracker
+        self.cache = cache
+
+    def reset(self):
+        if self.tracker is not None:
+            self.tracker.reset()
+        if self.cache is not None:
+            self.cache.clear()
+
+
+def _init_worker(pipeline_options):
+    global _pipeline
+    _pipeline = FramePipeline(**pipeline_options)
+
+
+def frame_buffer(image_data):
+    """
+    Returns (buffer, wire_format) for a frame sent either as a binary Socket.IO
+    attachment (bytes) or, by older clients, as a base64 / data-URL string.
+    """
+    if isinstance(image_data, (bytes, bytearray, memoryview)):
+        return memoryview(image_data), 'binary' # No copy; imdecode reads it in place
+    # Clean the base64 string (remove 'data:image/jpeg;base64,' prefix if present)
+    if ',' in image_data:
+        image_data = image_data.split(',')[1]
+    return base64.b64decode(image_data), 'base64'
+
+
+def decode_frame(image_data, pipeline):
+    """
+    Decodes a binary or base64 frame, at reduced size when `pipeline` allows it.
+    Returns (image or None, original_shape, load_full, transport stats).
+    """
+    started = time.perf_counter()
+    buffer, wire_format = frame_buffer(image_data)
+    unwrapped = time.perf_counter()
+    image, original_shape, reduction = pipeline.decode(buffer)
+    decoded = time.perf_counter()
+    transport = {
+        "format": wire_format,
+        "wire_bytes": len(image_data),
+        "jpeg_bytes": len(buffer),
+        "reduction": reduction,
+        "b64_decode_ms": (unwrapped - started) * 1000.0,
+        "image_decode_ms": (decoded - unwrapped) * 1000.0,
+    }
+    load_full = lambda: cv2.imdecode(np.frombuffer(buffer, np.uint8), cv2.IMREAD_COLOR)
+    return image, original_shape, load_full, transport
+
+
+def run_recognition_batch(frames, max_faces=1):
+    """Worker entry point for a micro-batch of (image_data, stream). Returns [(result, stream)]."""
+    outputs = [None] * len(frames)
+    decoded, positions = [], []
+    for i, (image_data, stream) in enumerate(frames):
+        image, original_shape, load_full, transport = decode_frame(image_data, _pipeline)
+        if image is None:
+            outputs[i] = ({"error": "Could not decode image", "transport": transport}, stream)
+            continue
+        stream = stream or FrameStream()
+        decoded.append((image, stream, original_shape, load_full, transport))
+        positions.append(i)
+
+    results = _pipeline.process_batch(
+        [(image, stream.tracker, stream.cache, original_shape, load_full)
+         for image, stream, original_shape, load_full, _ in decoded],
+        max_faces=max_faces,
+    )
+    for i, (_, stream, _, _, transport), result in zip(positions, decoded, results):
+        result["transport"] = transport
+        outputs[i] = (result, stream)
+    return outputs
+
+
+def run_recognition(image_data, stream, max_faces=1):
+    """Worker entry point: decode, detect and encode one frame. Returns (result, stream)."""
+    image, original_shape, load_full, transport = decode_frame(image_data, _pipeline)
+    if image is None:
+        return {"error": "Could not decode image", "transport": transport}, stream
+    stream = stream or FrameStream()
+    result = _pipeline.process(image, tracker=stream.tracker, max_faces=max_faces,
+                               original_shape=original_shape, load_full=load_full, cache=stream.cache)
+    result["transport"] = transport
+    return result, stream
+
+
+def run_enrollment_photo(image_data):
+    """Worker entry point: encodes one uploaded enrolment photo. Returns (status, detail, encoding)."""
+    buffer, _ = frame_buffer(image_data)
+    image = cv2.imdecode(np.frombuffer(buffer, np.uint8), cv2.IMREAD_COLOR)
+    return encode_photo(image, _pipeline.detect)
+
+
+class RecognitionPool:
+    def __init__(self, workers, max_pending, pipeline_options=None, batch_size=1, batch_wait_ms=5, on_batch=None):
+        self.workers = workers
+        self.max_pending = max_pending
+        self.batch_size = batch_size
+        self.batch_wait = batch_wait_ms / 1000.0
+        self.on_batch = on_batch
+        self._lock = threading.Lock()
+        self._in_flight = set() # Session ids with a frame queued or running
+        self._waiting = {} # Session id -> newest frame waiting behind the in-flight one
+        self._batch = [] # Dispatched frames collecting into the next micro-batch
+        self._batch_timer = None
+        self.submitted = 0
+        self.completed = 0
+        self.superseded = 0 # Waiting frames dropped because a newer one arrived
+        self.rejected_overloaded = 0
+        self.batches = 0
+        self.batched_frames = 0
+
+        pipeline_options = pipeline_options or {}
+        if workers > 0:
+            # fork: workers inherit the already-imported dlib models instead of
+            # re-running the server module, as spawn/forkserver would
+            self._executor = ProcessPoolExecutor(
+                max_workers=workers,
+                mp_context=multiprocessing.get_context('fork'),
+                initializer=_init_worker,
+                initargs=(pipeline_options,),
+            )
+            # Stop the workers while the interpreter can still close their pipes cleanly
+            atexit.register(self.shutdown)
+        else:
+            # workers=0 runs inline on the calling thread (debugging / single-core hosts)
+            self._executor = None
+            _init_worker(pipeline_options)
+
+    def warm_up(self):
+        """Starts the worker processes now rather than on the first frame."""
+        if self._executor is not None:
+            self._executor.submit(int).result()
+
+    def worker_pids(self):
+        """Process ids of the live workers (empty when running inline)."""
+        if self._executor is None:
+            return []
+        return list((self._executor._processes or {}).keys())
+
+    def submit(self, sid, image_data, get_stream, on_done):
+        """
+        `get_stream()` is called when the frame is actually dispatched, so a frame
+        that waited behind another one starts from the track and cache that one produced.
+        """
+        with self._lock:
+            if sid in self._in_flight:
+                if sid in self._waiting:
+                    self.superseded += 1
+                self._waiting[sid] = (image_data, get_stream, on_done)
+                return QUEUED
+            if len(self._in_flight) >= self.max_pending:
+                self.rejected_overloaded += 1
+                return OVERLOADED
+            self._in_flight.add(sid)
+
+        self._dispatch(sid, image_data, get_stream, on_done)
+        return ACCEPTED
+
+    def run_task(self, fn, *args):
+        """
+        Runs `fn(*args)` on a worker outside frame admission (e.g. enrolment
+        photos) and returns its Future; inline pools run it right away.
+        """
+        if self._executor is not None:
+            return self._executor.submit(fn, *args)
+        future = Future()
+        try:
+            future.set_result(fn(*args))
+        except Exception as e:
+            future.set_exception(e)
+        return future
+
+    def has_waiting(self, sid):
+        """True when a newer frame of `sid` is waiting behind the in-flight one."""
+        with self._lock:
+            return sid in self._waiting
+
+    def discard(self, sid):
+        """Drops the session's waiting frame (e.g. it finished or disconnected)."""
+        with self._lock:
+            if self._waiting.pop(sid, None) is not None:
+                self.superseded += 1
+
+    def _dispatch(self, sid, image_data, get_stream, on_done):
+        with self._lock:
+            self.submitted += 1
+        stream = get_stream()
+        if self.batch_size > 1:
+            self._add_to_batch((sid, image_data, stream, on_done))
+            return
+        if self._executor is None:
+            self._finish(sid, on_done, lambda: self._single(run_recognition(image_data, stream)))
+            return
+        future = self._executor.submit(run_recognition, image_data, stream)
+        future.add_done_callback(lambda f: self._finish(sid, on_done, lambda: self._single(f.result())))
+
+    def _single(self, output):
+        self._run_batch_hook([output[0]])
+        return output
+
+    def _run_batch_hook(self, results):
+        if self.on_batch is None:
+            return
+        try:
+            self.on_batch(results)
+        except Exception as e:
+            print(f"Error in batch hook: {e}")
+
+    def _add_to_batch(self, frame):
+        with self._lock:
+            self._batch.append(frame)
+            if len(self._batch) >= self.batch_size:
+                batch = self._take_batch()
+            else:
+                batch = None
+                if self._batch_timer is None:
+                    self._batch_timer = threading.Timer(self.batch_wait, self._flush_batch)
+                    self._batch_timer.daemon = True
+                    self._batch_timer.start()
+        if batch:
+            self._run_batch(batch)
+
+    def _flush_batch(self):
+        with self._lock:
+            batch = self._take_batch()
+        if batch:
+            self._run_batch(batch)
+
+    def _take_batch(self):
+        # Caller holds self._lock
+        if self._batch_timer is not None:
+            self._batch_timer.cancel()
+            self._batch_timer = None
+        batch, self._batch = self._batch, []
+        if batch:
+            self.batches += 1
+            self.batched_frames += len(batch)
+        return batch
+
+    def _run_batch(self, batch):
+        frames = [(image_data, stream) for _, image_data, stream, _ in batch]
+        if self._executor is None:
+            self._finish_batch(batch, lambda: run_recognition_batch(frames))
+            return
+        future = self._executor.submit(run_recognition_batch, frames)
+        future.add_done_callback(lambda f: self._finish_batch(batch, f.result))
+
+    def _finish_batch(self, batch, get_outputs):
+        try:
+            outputs = get_outputs()
+        except Exception as e:
+            outputs = [({"error": f"Error processing frame: {e}"}, None)] * len(batch)
+        self._run_batch_hook([result for result, _ in outputs])
+        for (sid, _, _, on_done), output in zip(batch, outputs):
+            self._finish(sid, on_done, lambda output=output: output)
+
+    def _finish(self, sid, on_done, get_result):
+        try:
+            result, stream = get_result()
+        except Exception as e:
+            result, stream = {"error": f"Error processing frame: {e}"}, None
+        try:
+            # on_done may still discard() the waiting frame, e.g. once the session is decided
+            on_done(result, stream)
+        except Exception as e:
+            print(f"[{sid}] Error in frame callback: {e}")
+        finally:
+            # Always release the slot, or a failing callback would wedge the session and the pool
+            with self._lock:
+                self.completed += 1
+                waiting = self._waiting.pop(sid, None)
+                if waiting is None:
+                    self._in_flight.discard(sid)
+            if waiting is not None:
+                # The session keeps its slot and moves straight on to its freshest frame
+                self._dispatch(sid, *waiting)
+
+    def stats(self):
+        with self._lock:
+            return {
+                "workers": self.workers,
+                "pending": len(self._in_flight),
+                "waiting": len(self._waiting),
+                "max_pending": self.max_pending,
+                "submitted": self.submitted,
+                "completed": self.completed,
+                "superseded": self.superseded,
+                "rejected_overloaded": self.rejected_overloaded,
+                "batches": self.batches,
+                "mean_batch_size": self.batched_frames / self.batches if self.batches else 0.0,
+            }
+
+    def shutdown(self):
+        """
+        Drops frames not yet started and waits for the running ones; waiting lets
+        the executor close its wakeup pipe itself instead of failing on it at exit.
+        """
+        with self._lock:
+            self._take_batch()
+        if self._executor is not None:
+            self._executor.shutdown(wait=True, cancel_futures=True)
@@ -0,0 +1,315 @@
+"""
+Thread-safe registry of per-connection recognition sessions.
+
+Sessions are spread over `shards` independently locked shards (by hash of the
+session id), so handlers for different connections rarely contend, and every
+lock is held only for a dict operation - never while a session is created,
+reset or notified.
+
+Each shard keeps its sessions in least-recently-used order (an OrderedDict,
+moved to the end on every access). Because every session has the same idle
+timeout, that order is also expiry order: `expire()` pops sessions off the
+front of each shard until it meets one still alive, so a sweep costs O(expired
+sessions), not a scan of everything. The same order gives LRU eviction beyond
+`max_sessions`: the globally least recently used session is the oldest of the
+shards' front entries.
+
+`on_evict(sid, state, reason)` is called outside all locks for sessions that
+expired ('expired') or were pushed out by the cap ('evicted'), never for ones
+removed explicitly with `pop`.
+
+`RedisSessionStore` offers the same interface on top of Redis (or anything
+speaking its protocol, e.g. fakeredis in tests), so several server processes
+or nodes share sessions. Redis key TTLs do the expiry there. Code that changes
+a session goes through `transaction(sid)`, which loads the state, yields it
+and writes it back under a per-session Redis lock; for the in-memory store
+the state is live and nothing needs writing back. The lock is a plain
+`SET key token NX PX` released by a WATCH/MULTI compare-and-delete, so it needs
+no Lua scripting and works on any Redis-compatible server.
+"""
+import json
+import threading
+import time
+import uuid
+from collections import OrderedDict
+from contextlib import contextmanager
+
+EXPIRED = 'expired'
+EVICTED = 'evicted'
+
+
+class _Shard:
+    __slots__ = ('lock', 'sessions')
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.sessions = OrderedDict() # sid -> (last_access, state), least recently used first
+
+
+class SessionStore:
+    def __init__(self, timeout, max_sessions=0, shards=16, on_evict=None, clock=time.monotonic):
+        self.timeout = timeout
+        self.max_sessions = max_sessions # 0 = unbounded
+        self.on_evict = on_evict
+        self.clock = clock
+        self._shards = [_Shard() for _ in range(max(1, shards))]
+        self._stats_lock = threading.Lock()
+        self.expired = 0
+        self.evicted = 0
+
+    def _shard(self, sid):
+        return self._shards[hash(sid) % len(self._shards)]
+
+    def get(self, sid, default=None):
+        """Returns the session's state and marks it as active."""
+        shard = self._shard(sid)
+        with shard.lock:
+            entry = shard.sessions.get(sid)
+            if entry is None:
+                return default
+            shard.sessions[sid] = (self.clock(), entry[1])
+            shard.sessions.move_to_end(sid)
+            return entry[1]
+
+    def peek(self, sid, default=None):
+        """Returns the session's state without counting it as activity."""
+        shard = self._shard(sid)
+        with shard.lock:
+            entry = shard.sessions.get(sid)
+        return entry[1] if entry is not None else default
+
+    def __contains__(self, sid):
+        shard = self._shard(sid)
+        with shard.lock:
+            return sid in shard.sessions
+
+    def __getitem__(self, sid):
+        state = self.get(sid)
+        if state is None:
+            raise KeyError(sid)
+        return state
+
+    def __setitem__(self, sid, state):
+        self.put(sid, state)
+
+    def put(self, sid, state):
+        """Adds or replaces a session, evicting the least recently used ones over the cap."""
+        shard = self._shard(sid)
+        with shard.lock:
+            shard.sessions[sid] = (self.clock(), state)
+            shard.sessions.move_to_end(sid)
+        if self.max_sessions and len(self) > self.max_sessions:
+            self._evict_over_cap()
+
+    def _evict_over_cap(self):
+        evicted = []
+        while len(self) > self.max_sessions:
+            oldest, oldest_shard = None, None
+            for shard in self._shards: # O(shards) per eviction, each lock held for one peek
+                with shard.lock:
+                    if shard.sessions:
+                        last_access = next(iter(shard.sessions.values()))[0]
+                        if oldest is None or last_access < oldest:
+                            oldest, oldest_shard = last_access, shard
+            if oldest_shard is None:
+                break
+            with oldest_shard.lock:
+                if oldest_shard.sessions:
+                    sid, (_, state) = oldest_shard.sessions.popitem(last=False)
+                    evicted.append((sid, state))
+        self._notify(evicted, EVICTED)
+
+    def pop(self, sid, default=None):
+        shard = self._shard(sid)
+        with shard.lock:
+            entry = shard.sessions.pop(sid, None)
+        return entry[1] if entry is not None else default
+
+    def __len__(self):
+        return sum(len(shard.sessions) for shard in self._shards)
+
+    @contextmanager
+    def transaction(self, sid):
+        """Yields the session's state (None if absent) for a read-modify-write."""
+        yield self.get(sid)
+
+    def items(self):
+        """Snapshot of (sid, state) pairs, taken one shard at a time."""
+        pairs = []
+        for shard in self._shards:
+            with shard.lock:
+                pairs.extend((sid, state) for sid, (_, state) in shard.sessions.items())
+        return pairs
+
+    def expire(self, now=None):
+        """Removes sessions idle for longer than `timeout`. Returns how many were removed."""
+        now = self.clock() if now is None else now
+        expired = []
+        for shard in self._shards:
+            with shard.lock:
+                while shard.sessions:
+                    sid, (last_access, state) = next(iter(shard.sessions.items()))
+                    if now - last_access <= self.timeout:
+                        break
+                    del shard.sessions[sid]
+                    expired.append((sid, state))
+        self._notify(expired, EXPIRED)
+        return len(expired)
+
+    def _notify(self, removed, reason):
+        if not removed:
+            return
+        with self._stats_lock:
+            if reason == EXPIRED:
+                self.expired += len(removed)
+            else:
+                self.evicted += len(removed)
+        if self.on_evict is None:
+            return
+        for sid, state in removed:
+            try:
+                self.on_evict(sid, state, reason)
+            except Exception as e:
+                print(f"[{sid}] Error in session eviction callback: {e}")
+
+    def stats(self):
+        return {
+            "backend": "memory",
+            "sessions": len(self),
+            "max_sessions": self.max_sessions,
+            "shards": len(self._shards),
+            "timeout": self.timeout,
+            "expired": self.expired,
+            "evicted": self.evicted,
+        }
+
+
+def redis_client(url):
+    """Client for `url`; redis-py is only needed when the Redis backend is used."""
+    try:
+        import redis
+    except ImportError:
+        raise RuntimeError("SESSION_BACKEND=redis needs the 'redis' package (pip install redis)")
+    return redis.Redis.from_url(url)
+
+
+class RedisSessionStore:
+    """
+    Sessions as JSON strings under `<prefix>session:<sid>`, each with a TTL of
+    `timeout` that is renewed on every access. `dumps(state)` returns a
+    JSON-able dict and `loads(sid, data)` rebuilds the state from it.
+    """
+
+    def __init__(self, client, timeout, dumps, loads, prefix='face_app:', lock_timeout=10.0):
+        self.client = client
+        self.timeout = timeout
+        self.dumps = dumps
+        self.loads = loads
+        self.prefix = prefix
+        self.lock_timeout = lock_timeout # Auto-release if a node dies holding a session lock
+
+    def _key(self, sid):
+        return f"{self.prefix}session:{sid}"
+
+    def _decode(self, sid, raw):
+        return self.loads(sid, json.loads(raw)) if raw is not None else None
+
+    def get(self, sid, default=None):
+        """Returns the session's state and renews its TTL."""
+        pipe = self.client.pipeline()
+        pipe.get(self._key(sid))
+        pipe.pexpire(self._key(sid), int(self.timeout * 1000))
+        raw, _ = pipe.execute()
+        state = self._decode(sid, raw)
+        return state if state is not None else default
+
+    def peek(self, sid, default=None):
+        """Returns the session's state without counting it as activity."""
+        state = self._decode(sid, self.client.get(self._key(sid)))
+        return state if state is not None else default
+
+    def __contains__(self, sid):
+        return bool(self.client.exists(self._key(sid)))
+
+    def __getitem__(self, sid):
+        state = self.get(sid)
+        if state is None:
+            raise KeyError(sid)
+        return state
+
+    def __setitem__(self, sid, state):
+        self.put(sid, state)
+
+    def put(self, sid, state):
+        self.client.set(self._key(sid), json.dumps(self.dumps(state)), px=int(self.timeout * 1000))
+
+    def pop(self, sid, default=None):
+        pipe = self.client.pipeline()
+        pipe.get(self._key(sid))
+        pipe.delete(self._key(sid))
+        raw, _ = pipe.execute()
+        state = self._decode(sid, raw)
+        return state if state is not None else default
+
+    @contextmanager
+    def transaction(self, sid):
+        """
+        Yields the session's state (None if absent) while holding its lock, then
+        saves it, so frames of one session handled on different nodes do not
+        overwrite each other's updates.
+        """
+        with self._locked(sid):
+            state = self.get(sid)
+            yield state
+            if state is not None and sid in self:
+                self.put(sid, state)
+
+    @contextmanager
+    def _locked(self, sid):
+        key = f"{self.prefix}lock:{sid}"
+        token = uuid.uuid4().hex # Only the holder may release; an expired lock may have a new holder
+        deadline = time.monotonic() + self.lock_timeout
+        delay = 0.002
+        while not self.client.set(key, token, nx=True, px=int(self.lock_timeout * 1000)):
+            if time.monotonic() >= deadline:
+                raise TimeoutError(f"Could not lock session {sid} within {self.lock_timeout}s")
+            time.sleep(delay)
+            delay = min(delay * 2, 0.05)
+        try:
+            yield
+        finally:
+            def release(pipe):
+                holder = pipe.get(key)
+                if (holder.decode() if isinstance(holder, bytes) else holder) == token:
+                    pipe.multi()
+                    pipe.delete(key)
+            self.client.transaction(release, key)
+
+    def _keys(self):
+        return self.client.scan_iter(match=self._key('*'), count=500)
+
+    def __len__(self):
+        return sum(1 for _ in self._keys())
+
+    def items(self):
+        pairs = []
+        keys = list(self._keys())
+        for start in range(0, len(keys), 500):
+            batch = keys[start:start + 500]
+            for key, raw in zip(batch, self.client.mget(batch)):
+                if raw is None:
+                    continue # Expired between SCAN and MGET
+                key = key.decode() if isinstance(key, bytes) else key
+                sid = key[len(self._key('')):]
+                pairs.append((sid, self._decode(sid, raw)))
+        return pairs
+
+    def expire(self, now=None):
+        return 0 # Redis expires keys itself
+
+    def stats(self):
+        return {
+            "backend": "redis",
+            "sessions": len(self),
+            "timeout": self.timeout,
+        }
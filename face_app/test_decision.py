@@ -0,0 +1,93 @@
+import pytest
+
+
+def decide(server, detections, sid='s1'):
+    state = server.FaceDetectionState(sid)
+    for name, distance in detections:
+        state.add_detection(name, distance=distance, margin=0.3)
+    return state
+
+
+def test_evidence_weights(server):
+    assert server.match_evidence(0.3, None) == 1.0
+    assert server.match_evidence(0.6, None) == pytest.approx(server.MIN_MATCH_EVIDENCE)
+    assert server.match_evidence(0.3, 0.0) == 0.0 # Tied with another identity
+    assert server.unknown_evidence(0.61) < 0.1 # A borderline miss says little
+    assert server.unknown_evidence(0.9) == 1.0
+    assert server.unknown_evidence(None) == 1.0
+
+
+def test_strong_matches_sign_in_early(server):
+    state = decide(server, [('alice', 0.3), ('alice', 0.35)])
+    assert state.is_signed_in and state.confirmed_user == 'alice'
+    assert state.detection_count == 2
+    state.add_detection('bob', distance=0.3)
+    assert state.detection_count == 2 # Decided; further frames are ignored until reset
+
+
+def test_weak_matches_still_confirm_like_three_of_five(server):
+    state = decide(server, [('alice', 0.59)] * 5)
+    assert state.is_signed_in and state.detection_count == 3
+
+
+def test_borderline_misses_do_not_outvote_matches(server):
+    state = decide(server, [('Unknown', 0.62), ('Unknown', 0.63), ('alice', 0.55), ('alice', 0.57), ('alice', 0.58)])
+    assert state.is_signed_in and state.confirmed_user == 'alice'
+
+
+def test_far_misses_deny_a_stranger(server):
+    state = decide(server, [('Unknown', 0.85), ('Unknown', 0.9)])
+    assert state.recognition_failed and not state.is_signed_in
+    assert state.confirmed_user == 'Unknown'
+
+
+def test_split_votes_give_up_once_nobody_can_win(server):
+    state = decide(server, [('alice', 0.45), ('bob', 0.45), ('alice', 0.45), ('bob', 0.45)])
+    assert not state.recognition_failed
+    state.add_detection('carol', distance=0.45, margin=0.3)
+    assert state.recognition_failed and not state.is_signed_in
+
+
+def test_majority_mode(server, monkeypatch):
+    monkeypatch.setattr(server, 'DECISION_MODE', 'majority')
+    state = decide(server, [('alice', 0.3), ('alice', 0.3), ('Unknown', 0.9), ('alice', 0.3)])
+    assert not state.is_complete() # Majority mode only decides after MAX_DETECTIONS frames
+    state.add_detection('bob', distance=0.3)
+    assert state.is_signed_in and state.confirmed_user == 'alice'
+
+
+@pytest.mark.parametrize('max_detections, votes, signed_in', [
+    (3, ['alice', 'alice', 'bob'], True),
+    (9, ['alice'] * 3 + ['bob', 'carol', 'dave', 'erin', 'frank', 'gina'], False), # Plurality only
+    (9, ['alice'] * 5 + ['bob'] * 4, True),
+])
+def test_majority_threshold_follows_max_detections(server, monkeypatch, max_detections, votes, signed_in):
+    monkeypatch.setattr(server, 'DECISION_MODE', 'majority')
+    monkeypatch.setattr(server, 'MAX_DETECTIONS', max_detections)
+    state = decide(server, [(name, 0.3) for name in votes])
+    assert state.is_complete() and state.is_signed_in == signed_in
+
+
+def test_frames_without_a_usable_face_fail_the_attempt(server):
+    state = server.FaceDetectionState('s1')
+    for _ in range(server.MAX_NO_FACE_FRAMES - 1):
+        state.add_detection('NoFace')
+    state.add_quality_reject('blurry')
+    assert state.recognition_failed
+    assert state.detection_count == 0 and state.quality_rejects == 1
+    assert state.get_status()["quality"]["reason"] == 'blurry'
+
+
+def test_reset_starts_a_new_attempt(server):
+    state = decide(server, [('alice', 0.3), ('alice', 0.3)])
+    state.reset()
+    assert state.attempt == 1
+    assert not state.is_complete() and state.evidence == {} and state.detection_count == 0
+
+
+def test_shared_fields_round_trip(server):
+    state = decide(server, [('alice', 0.3)])
+    copy = server.FaceDetectionState.from_dict('s1', state.to_dict())
+    assert copy.evidence == state.evidence and copy.detection_history == ['alice']
+    copy.add_detection('alice', distance=0.3)
+    assert copy.is_signed_in
@@ -0,0 +1,118 @@
+import io
+
+import cv2
+import numpy as np
+import pytest
+
+from frame_pipeline import NO_FACE
+from gallery import ENCODING_DIM
+from gallery_store import GalleryStore
+
+
+def photo(shade):
+    ok, jpeg = cv2.imencode('.jpg', np.full((120, 160, 3), shade, np.uint8))
+    return jpeg.tobytes()
+
+
+def encoding(seed):
+    return np.random.default_rng(seed).normal(scale=0.1, size=ENCODING_DIM).astype(np.float32)
+
+
+@pytest.fixture
+def enrol(server, tmp_path, monkeypatch):
+    """The server with an empty gallery in tmp_path; photos brighter than 128 show a face."""
+    monkeypatch.setattr(server, 'ENCODINGS_PATH', str(tmp_path))
+    monkeypatch.setattr(server, 'gallery_store', GalleryStore(str(tmp_path / 'gallery')))
+    monkeypatch.setattr(server, 'gallery', server.build_gallery([], []))
+    events = []
+    monkeypatch.setattr(server.socketio, 'emit', lambda event, data=None, room=None: events.append((event, data)))
+
+    def run_enrollment_photo(image_data):
+        image = cv2.imdecode(np.frombuffer(image_data, np.uint8), cv2.IMREAD_COLOR)
+        if image.mean() < 128:
+            return NO_FACE, "No face found", None
+        return 'ok', None, encoding(int(image.mean()))
+
+    monkeypatch.setattr(server, 'run_enrollment_photo', run_enrollment_photo)
+    return server, events
+
+
+def test_job_enrols_accepted_photos_and_reports_rejects(enrol, tmp_path):
+    server, events = enrol
+    job, error = server.create_enrollment('alice', [photo(60), photo(200), photo(240)])
+    assert error is None and job.status == 'running'
+    job.start() # Inline pool: every photo is processed before start() returns
+
+    status = job.to_dict()
+    assert status["status"] == 'done' and status["success"]
+    assert status["processed"] == 3 and status["accepted"] == 2
+    assert status["rejected"] == [{"index": 0, "reason": NO_FACE, "detail": "No face found"}]
+    assert status["templates"] == 2
+    assert [event for event, _ in events] == ['enrollment_progress'] * 3 + ['enrollment_complete']
+    assert job.images is None
+
+    assert server.gallery.match(encoding(240))["name"] == 'alice'
+    assert server.gallery_store.read_all()[1] == ['alice', 'alice']
+    assert (tmp_path / 'alice.jpg').exists()
+
+
+def test_job_without_a_usable_photo_fails(enrol):
+    server, _ = enrol
+    job, _ = server.create_enrollment('bob', [photo(10), photo(20)])
+    job.start()
+    assert job.status == 'failed' and job.to_dict()["accepted"] == 0
+    assert 'bob' not in server.gallery.names
+
+
+def test_photo_errors_count_as_unreadable(enrol, monkeypatch):
+    server, _ = enrol
+
+    def run_enrollment_photo(image_data):
+        raise ValueError("corrupt upload")
+
+    monkeypatch.setattr(server, 'run_enrollment_photo', run_enrollment_photo)
+    job, _ = server.create_enrollment('carol', [photo(200)])
+    job.start()
+    assert job.status == 'failed'
+    assert job.rejected == [{"index": 0, "reason": 'unreadable', "detail": "corrupt upload"}]
+
+
+@pytest.mark.parametrize('name, images', [
+    ('', [b'x']),
+    ('../etc', [b'x']),
+    ('x' * 129, [b'x']),
+    ('dave', []),
+])
+def test_invalid_uploads_are_refused(enrol, name, images):
+    server, _ = enrol
+    job, error = server.create_enrollment(name, images)
+    assert job is None and error
+
+
+def test_too_many_photos_are_refused(enrol):
+    server, _ = enrol
+    job, error = server.create_enrollment('erin', [b'x'] * (server.ENROLL_MAX_IMAGES + 1))
+    assert job is None and 'At most' in error
+
+
+def test_enroll_endpoint_returns_a_pollable_job(enrol):
+    server, _ = enrol
+    client = server.app.test_client()
+    response = client.post('/enroll', data={
+        'name': 'frank', 'images': [(io.BytesIO(photo(200)), 'a.jpg'), (io.BytesIO(photo(220)), 'b.jpg')],
+    }, content_type='multipart/form-data')
+    assert response.status_code == 202
+    job_id = response.get_json()["job_id"]
+
+    status = client.get(f'/enroll/{job_id}').get_json()
+    assert status["status"] == 'done' and status["accepted"] == 2
+    assert client.get('/enroll/missing').status_code == 404
+    assert client.post('/enroll', data={'name': ''}, content_type='multipart/form-data').status_code == 400
+
+
+@pytest.mark.parametrize('name', ['', '../../etc/cron.d/x', 'x' * 129])
+def test_train_face_refuses_bad_names_before_opening_the_camera(enrol, monkeypatch, name):
+    server, _ = enrol
+    monkeypatch.setattr(server.cv2, 'VideoCapture', lambda *args: pytest.fail("camera opened"))
+    response = server.app.test_client().post('/train_face', json={'name': name})
+    assert response.status_code == 400 and not response.get_json()["success"]
@@ -0,0 +1,85 @@
+from collections import namedtuple
+
+import numpy as np
+import pytest
+
+from face_quality import BLURRY, TOO_BRIGHT, TOO_DARK, TOO_SMALL, TURNED_AWAY, QualityGate, estimate_yaw
+from frame_pipeline import FramePipeline
+
+Point = namedtuple('Point', 'x y')
+
+
+class Shape:
+    """Stands in for a dlib full_object_detection."""
+
+    def __init__(self, points):
+        self.points = [Point(x, y) for x, y in points]
+        self.num_parts = len(points)
+
+    def part(self, i):
+        return self.points[i]
+
+
+def five_point_face(nose_x):
+    # Corners of one eye, of the other, then the base of the nose
+    return Shape([(100, 100), (120, 100), (160, 100), (180, 100), (nose_x, 130)])
+
+
+def textured(brightness, size=120):
+    noise = np.random.default_rng(0).integers(-40, 41, size=(size, size, 1))
+    return np.clip(brightness + noise, 0, 255).astype(np.uint8).repeat(3, axis=2)
+
+
+def test_size_check():
+    gate = QualityGate(min_face=64)
+    assert gate.check_size((0, 50, 50, 0)) == (TOO_SMALL, {"face_px": 50})
+    assert gate.check_size((0, 100, 80, 0)) == (None, {"face_px": 80})
+    assert QualityGate(min_face=0).check_size((0, 10, 10, 0))[0] is None
+
+
+@pytest.mark.parametrize('image, reason', [
+    (textured(20), TOO_DARK),
+    (textured(235), TOO_BRIGHT),
+    (np.full((120, 120, 3), 128, np.uint8), BLURRY),
+    (textured(128), None),
+])
+def test_crop_check(image, reason):
+    assert QualityGate().check_crop(image, (0, 120, 120, 0))[0] == reason
+
+
+def test_crop_check_measures_and_empty_crop():
+    reason, measures = QualityGate().check_crop(textured(128), (10, 110, 110, 10))
+    assert reason is None and 120 < measures["brightness"] < 136 and measures["sharpness"] > 40
+    assert QualityGate().check_crop(textured(128), (200, 300, 300, 200)) == (None, {})
+
+
+def test_yaw_estimate():
+    assert estimate_yaw(five_point_face(140)) == pytest.approx(0.0)
+    assert estimate_yaw(five_point_face(170)) > 35
+    assert estimate_yaw(five_point_face(110)) < -35
+    assert estimate_yaw(Shape([(0, 0)] * 3)) is None # Unknown landmark model
+
+
+def test_pose_check():
+    gate = QualityGate(max_yaw=35)
+    assert gate.check_pose(five_point_face(145))[0] is None
+    assert gate.check_pose(five_point_face(170))[0] == TURNED_AWAY
+    assert QualityGate(max_yaw=None).check_pose(five_point_face(170)) == (None, {})
+
+
+def gated_pipeline(box):
+    return FramePipeline(detect=lambda rgb: [box], quality_gate=QualityGate(), encode_min_face=0)
+
+
+def test_pipeline_skips_encoding_of_a_small_face():
+    result = gated_pipeline((100, 140, 140, 100)).process(textured(128, size=480), max_faces=1)
+    assert result["encodings"] == []
+    assert result["quality"]["reason"] == TOO_SMALL
+    assert 'quality' in result["timings"]
+
+
+def test_pipeline_skips_encoding_of_a_dark_face():
+    result = gated_pipeline((100, 300, 300, 100)).process(textured(15, size=480), max_faces=1)
+    assert result["encodings"] == [] # Rejected before face_recognition is even imported
+    assert result["quality"]["reason"] == TOO_DARK
+    assert result["quality"]["face_px"] >= 200 # Passed the size check first
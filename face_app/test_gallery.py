@@ -0,0 +1,124 @@
+import numpy as np
+import pytest
+
+from gallery import ENCODING_DIM, FaceGallery, select_templates
+from gallery_index import IVFIndex, make_index
+
+
+def identities(count, seed=0):
+    # Pairwise ~1.6 apart, far beyond the 0.6 tolerance
+    return np.random.default_rng(seed).normal(scale=0.1, size=(count, ENCODING_DIM)).astype(np.float32)
+
+
+def near(center, seed, scale=0.005):
+    return center + np.random.default_rng(seed).normal(scale=scale, size=ENCODING_DIM).astype(np.float32)
+
+
+def test_match_returns_nearest_identity_and_margin():
+    centers = identities(3)
+    gallery = FaceGallery(centers, ['alice', 'bob', 'carol'])
+    result = gallery.match(near(centers[1], 1))
+    assert result["name"] == 'bob'
+    assert result["distance"] < 0.1
+    assert [name for name, _ in result["candidates"]][0] == 'bob'
+    assert result["margin"] == pytest.approx(result["candidates"][1][1] - result["distance"])
+
+    stranger = gallery.match(identities(1, seed=9)[0])
+    assert stranger["name"] == 'Unknown'
+    assert stranger["distance"] > 0.6
+
+
+def test_empty_gallery_is_unknown():
+    gallery = FaceGallery()
+    assert gallery.match(identities(1)[0]) == {"name": "Unknown", "distance": None, "candidates": [], "margin": None}
+
+
+def test_upsert_replaces_templates_without_touching_old_snapshots():
+    centers = identities(3)
+    gallery = FaceGallery(centers[:2], ['alice', 'bob'])
+    before = gallery.snapshot()
+
+    gallery.upsert('alice', centers[2])
+    assert gallery.match(centers[2])["name"] == 'alice'
+    assert gallery.match(centers[0])["name"] == 'Unknown'
+    assert gallery.snapshot().version == before.version + 1
+
+    # A match that started before the upsert still sees the old templates
+    assert before.match_batch([centers[0]])[0]["name"] == 'alice'
+    assert before.match_batch([centers[2]])[0]["name"] == 'Unknown'
+
+
+def test_remove_and_names():
+    centers = identities(3)
+    gallery = FaceGallery(centers, ['alice', 'bob', 'carol'])
+    assert gallery.remove('bob')
+    assert not gallery.remove('bob')
+    assert gallery.names == ['alice', 'carol']
+    assert len(gallery) == 2
+    assert gallery.match(centers[1])["name"] == 'Unknown'
+
+
+def test_many_upserts_grow_and_compact():
+    centers = identities(200)
+    gallery = FaceGallery()
+    for round_ in range(2):
+        for i, center in enumerate(centers):
+            gallery.upsert(f'person-{i}', near(center, round_))
+    assert len(gallery) == 200
+    results = gallery.match_batch(centers[::20])
+    assert [r["name"] for r in results] == [f'person-{i}' for i in range(0, 200, 20)]
+
+
+def test_centroid_aggregation_keeps_one_row_per_identity():
+    centers = identities(2)
+    templates = [near(centers[0], seed, scale=0.05) for seed in range(4)]
+    gallery = FaceGallery(templates + [centers[1]], ['alice'] * 4 + ['bob'], aggregation='centroid')
+    assert len(gallery.snapshot().matrix) == 2
+    assert gallery.match(centers[0])["name"] == 'alice'
+
+    with pytest.raises(ValueError):
+        FaceGallery(aggregation='mode')
+
+
+def test_select_templates_drops_duplicates_and_caps():
+    centers = identities(6)
+    duplicates = np.stack([centers[0], near(centers[0], 1, scale=0.001)])
+    assert len(select_templates(duplicates)) == 1
+    assert len(select_templates(centers, max_templates=4)) == 4
+
+
+def test_ivf_with_every_cell_probed_matches_brute_force():
+    rng = np.random.default_rng(3)
+    matrix = identities(64, seed=3)[rng.integers(0, 64, 600)]
+    matrix += rng.normal(scale=0.02, size=matrix.shape).astype(np.float32)
+    probes = matrix[::37] + 0.001
+
+    brute = make_index('brute').build(matrix)
+    ivf = IVFIndex(nlist=8, nprobe=8, min_train_size=100).build(matrix)
+    assert ivf.centroids is not None
+    brute_ids, brute_dists = brute.search(probes, 5)
+    ivf_ids, ivf_dists = ivf.search(probes, 5)
+    np.testing.assert_array_equal(ivf_ids, brute_ids)
+    np.testing.assert_allclose(ivf_dists, brute_dists, atol=1e-4) # float32 expansion noise
+
+
+def test_ivf_gallery_finds_rows_added_after_training():
+    centers = identities(300, seed=4)
+    names = [f'person-{i}' for i in range(300)]
+    gallery = FaceGallery(centers, names, index='ivf', nprobe=4, min_train_size=100)
+    assert gallery.snapshot().index.centroids is not None
+
+    extra = identities(5, seed=5)
+    for i, encoding in enumerate(extra):
+        gallery.upsert(f'new-{i}', encoding)
+    index = gallery.snapshot().index
+    assert index.indexed_rows == 300 # Served from the exact tail, not retrained yet
+    assert [r["name"] for r in gallery.match_batch(extra)] == [f'new-{i}' for i in range(5)]
+    assert gallery.match(near(centers[42], 1))["name"] == 'person-42'
+
+
+def test_ivf_small_gallery_uses_exact_scan():
+    index = make_index('ivf').build(identities(10))
+    assert index.centroids is None
+    with pytest.raises(ValueError):
+        make_index('hnsw')
@@ -0,0 +1,104 @@
+import os
+
+import numpy as np
+import pytest
+
+from gallery import ENCODING_DIM
+from gallery_store import LEGACY_SUFFIX, GalleryStore, migrate_legacy
+
+
+def encoding(seed):
+    return np.random.default_rng(seed).normal(size=ENCODING_DIM).astype(np.float32)
+
+
+def test_append_and_read(tmp_path):
+    store = GalleryStore(str(tmp_path / 'gallery'))
+    assert not store.exists()
+    store.append('alice', [encoding(1), encoding(2)])
+    store.append('bob', encoding(3))
+    encodings, names = store.read_all()
+    assert names == ['alice', 'alice', 'bob']
+    np.testing.assert_allclose(encodings[2], encoding(3))
+
+
+def test_later_upsert_replaces_and_remove_drops(tmp_path):
+    store = GalleryStore(str(tmp_path / 'gallery'))
+    store.append('alice', encoding(1))
+    store.append('bob', encoding(2))
+    store.append('alice', [encoding(4), encoding(5)])
+    store.remove('bob')
+    encodings, names = store.read_all()
+    assert names == ['alice', 'alice']
+    np.testing.assert_allclose(encodings, np.stack([encoding(4), encoding(5)]))
+
+
+def test_compaction_keeps_contents_and_empties_log(tmp_path):
+    root = str(tmp_path / 'gallery')
+    store = GalleryStore(root, compact_after=3)
+    for i, name in enumerate(['a', 'b', 'c', 'd']):
+        store.append(name, encoding(i))
+    with open(os.path.join(root, 'CURRENT')) as f:
+        generation = f.read().strip()
+    assert generation == 'gen-000002' # Written by the third append
+    assert sorted(os.listdir(root)) == ['CURRENT', 'LOCK', generation] # Old generation removed
+
+    reopened = GalleryStore(root)
+    encodings, names = reopened.read_all()
+    assert names == ['a', 'b', 'c', 'd']
+    np.testing.assert_allclose(encodings[3], encoding(3))
+    with open(os.path.join(root, generation, 'append.log')) as f:
+        assert len(f.readlines()) == 1
+
+
+def test_torn_log_line_is_skipped(tmp_path):
+    root = str(tmp_path / 'gallery')
+    store = GalleryStore(root)
+    store.append('alice', encoding(1))
+    with open(os.path.join(root, 'gen-000001', 'append.log'), 'a') as f:
+        f.write('{"op": "upsert", "na')
+    assert store.read_all()[1] == ['alice']
+
+
+def test_bulk_upsert_writes_one_generation_with_sources(tmp_path):
+    store = GalleryStore(str(tmp_path / 'gallery'))
+    store.append('alice', encoding(1))
+    store.append('bob', encoding(2))
+    store.bulk_upsert({'bob': [encoding(5)], 'carol': [encoding(6), encoding(7)]}, {'hash-c': 'carol'})
+    encodings, names = store.read_all()
+    assert names == ['alice', 'bob', 'carol', 'carol']
+    np.testing.assert_allclose(encodings[1], encoding(5))
+    assert store.sources() == {'hash-c': 'carol'}
+
+    store.bulk_upsert({'dave': [encoding(8)]}, {'hash-d': 'dave'})
+    assert store.sources() == {'hash-c': 'carol', 'hash-d': 'dave'}
+
+
+def test_bulk_upsert_keeps_appends_of_another_process(tmp_path):
+    # The server and enroll_directory.py each have their own GalleryStore on one directory
+    root = str(tmp_path / 'gallery')
+    server, importer = GalleryStore(root), GalleryStore(root)
+    server.append('alice', encoding(1))
+    importer.read_all()
+    server.append('bob', encoding(2))
+    importer.bulk_upsert({'carol': [encoding(3)]})
+    server.append('dave', encoding(4)) # Goes to the generation the import just wrote
+    assert GalleryStore(root).read_all()[1] == ['alice', 'bob', 'carol', 'dave']
+
+
+def test_invalid_names_are_rejected(tmp_path):
+    store = GalleryStore(str(tmp_path / 'gallery'))
+    with pytest.raises(ValueError):
+        store.append('', encoding(1))
+    with pytest.raises(ValueError):
+        store.bulk_upsert({'x' * 200: [encoding(1)]})
+    assert store.read_all()[1] == []
+
+
+def test_migrate_legacy(tmp_path):
+    faces = tmp_path / 'faces'
+    faces.mkdir()
+    np.save(faces / f'mary_jane{LEGACY_SUFFIX}', encoding(1))
+    store = GalleryStore(str(faces / 'gallery'))
+    assert migrate_legacy(str(faces), store, remove_legacy=True) == ['mary_jane']
+    assert store.read_all()[1] == ['mary_jane']
+    assert not (faces / f'mary_jane{LEGACY_SUFFIX}').exists()
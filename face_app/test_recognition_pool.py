@@ -0,0 +1,194 @@
+import threading
+from contextlib import contextmanager
+
+import pytest
+
+import recognition_pool
+from recognition_pool import ACCEPTED, OVERLOADED, QUEUED, FrameStream, RecognitionPool
+
+
+@pytest.fixture
+def gated(monkeypatch):
+    """Inline recognition that holds each frame until `release` is set; records frames in order."""
+    release = threading.Event()
+    started = threading.Event()
+    frames = []
+
+    def run_recognition(image_data, stream, max_faces=1):
+        frames.append(image_data)
+        started.set()
+        release.wait(5)
+        return {"frame": image_data}, stream
+
+    monkeypatch.setattr(recognition_pool, 'run_recognition', run_recognition)
+    return release, started, frames
+
+
+def submit_in_thread(pool, sid, image_data, on_done):
+    # Inline pools process on the submitting thread, so hold that in the background
+    thread = threading.Thread(target=pool.submit, args=(sid, image_data, FrameStream, on_done))
+    thread.start()
+    return thread
+
+
+def test_admission_queues_one_frame_per_session_and_caps_sessions(gated):
+    release, started, frames = gated
+    pool = RecognitionPool(0, max_pending=1)
+    done = []
+    on_done = lambda result, stream: done.append(result["frame"])
+
+    thread = submit_in_thread(pool, 'a', 'a1', on_done)
+    assert started.wait(5)
+    assert pool.submit('a', 'a2', FrameStream, on_done) == QUEUED
+    assert pool.submit('a', 'a3', FrameStream, on_done) == QUEUED # Replaces a2
+    assert pool.submit('b', 'b1', FrameStream, on_done) == OVERLOADED
+    assert pool.stats()["pending"] == 1 and pool.stats()["waiting"] == 1
+
+    release.set()
+    thread.join(5)
+    assert frames == ['a1', 'a3'] and done == ['a1', 'a3']
+    stats = pool.stats()
+    assert stats["pending"] == 0 and stats["waiting"] == 0
+    assert stats["submitted"] == 2 and stats["completed"] == 2
+    assert stats["superseded"] == 1 and stats["rejected_overloaded"] == 1
+    assert pool.submit('b', 'b1', FrameStream, on_done) == ACCEPTED
+
+
+def test_discard_drops_the_waiting_frame(gated):
+    release, started, frames = gated
+    pool = RecognitionPool(0, max_pending=4)
+    done = []
+
+    thread = submit_in_thread(pool, 'a', 'a1', lambda result, stream: done.append(result["frame"]))
+    assert started.wait(5)
+    pool.submit('a', 'a2', FrameStream, lambda result, stream: done.append(result["frame"]))
+    assert pool.has_waiting('a')
+    pool.discard('a')
+    assert not pool.has_waiting('a')
+
+    release.set()
+    thread.join(5)
+    assert done == ['a1']
+    assert pool.stats()["pending"] == 0 and pool.stats()["superseded"] == 1
+
+
+def test_failing_callback_releases_the_slot(gated):
+    release, started, frames = gated
+    pool = RecognitionPool(0, max_pending=1)
+    done = []
+
+    def on_done(result, stream):
+        done.append(result["frame"])
+        raise RuntimeError("callback failed")
+
+    thread = submit_in_thread(pool, 'a', 'a1', on_done)
+    assert started.wait(5)
+    pool.submit('a', 'a2', FrameStream, on_done)
+    release.set()
+    thread.join(5)
+    assert done == ['a1', 'a2'] # The waiting frame still ran after the first callback failed
+    assert pool.stats()["pending"] == 0
+    assert pool.submit('b', 'b1', FrameStream, on_done) == ACCEPTED
+
+
+def test_recognition_error_is_reported_to_the_callback(monkeypatch):
+    def run_recognition(image_data, stream, max_faces=1):
+        raise ValueError("bad frame")
+
+    monkeypatch.setattr(recognition_pool, 'run_recognition', run_recognition)
+    pool = RecognitionPool(0, max_pending=1)
+    done = []
+    assert pool.submit('a', 'a1', FrameStream, lambda result, stream: done.append((result, stream))) == ACCEPTED
+    assert done == [({"error": "Error processing frame: bad frame"}, None)]
+    assert pool.stats()["pending"] == 0
+
+
+def test_batches_frames_of_different_sessions(monkeypatch):
+    def run_recognition_batch(frames, max_faces=1):
+        return [({"frame": image_data}, stream) for image_data, stream in frames]
+
+    monkeypatch.setattr(recognition_pool, 'run_recognition_batch', run_recognition_batch)
+    hooked = []
+    pool = RecognitionPool(0, max_pending=4, batch_size=2, batch_wait_ms=1000, on_batch=hooked.append)
+    done = []
+    on_done = lambda result, stream: done.append(result["frame"])
+
+    assert pool.submit('a', 'a1', FrameStream, on_done) == ACCEPTED
+    assert done == [] # Waiting for a second frame to fill the batch
+    assert pool.submit('b', 'b1', FrameStream, on_done) == ACCEPTED
+    assert done == ['a1', 'b1']
+    assert hooked == [[{"frame": 'a1'}, {"frame": 'b1'}]]
+    stats = pool.stats()
+    assert stats["batches"] == 1 and stats["mean_batch_size"] == 2.0 and stats["pending"] == 0
+
+
+def test_partial_batch_is_flushed_after_the_wait(monkeypatch):
+    monkeypatch.setattr(recognition_pool, 'run_recognition_batch',
+                        lambda frames, max_faces=1: [({"frame": data}, stream) for data, stream in frames])
+    pool = RecognitionPool(0, max_pending=4, batch_size=4, batch_wait_ms=10)
+    flushed = threading.Event()
+    pool.submit('a', 'a1', FrameStream, lambda result, stream: flushed.set())
+    assert flushed.wait(5)
+    assert pool.stats()["mean_batch_size"] == 1.0
+
+
+def no_face_result():
+    return {"encodings": [], "frame_shape": (480, 640), "scale": 1.0, "timings": {}}
+
+
+@pytest.fixture
+def emitted(server, monkeypatch):
+    events = []
+    monkeypatch.setattr(server.socketio, 'emit', lambda event, data=None, room=None: events.append((event, room)))
+    return events
+
+
+def test_processed_frame_grants_a_credit(server, emitted):
+    state = server.FaceDetectionState('credit')
+    server.session_states['credit'] = state
+    server.on_frame_processed('credit', no_face_result(), None, attempt=state.attempt)
+    assert ('ready_for_frame', 'credit') in emitted
+    assert state.no_face_count == 1
+    server.session_states.pop('credit')
+
+
+def test_frame_of_a_reset_attempt_is_dropped(server, emitted):
+    state = server.FaceDetectionState('stale')
+    server.session_states['stale'] = state
+    stream = state.stream
+    state.reset()
+    emitted.clear()
+    server.on_frame_processed('stale', no_face_result(), FrameStream(), attempt=0)
+    assert emitted == [] # No vote, no credit
+    assert state.no_face_count == 0 and state.stream is stream
+    server.session_states.pop('stale')
+
+
+def test_emits_wait_until_the_session_lock_is_released(server, monkeypatch):
+    transaction = server.session_states.transaction
+    locked = []
+
+    @contextmanager
+    def tracked(sid):
+        with transaction(sid) as state:
+            locked.append(True)
+            try:
+                yield state
+            finally:
+                locked.pop()
+
+    events = []
+
+    def emit(event, data=None, room=None):
+        assert not locked, f"{event} emitted under the session lock"
+        events.append(event)
+
+    monkeypatch.setattr(server.session_states, 'transaction', tracked)
+    monkeypatch.setattr(server.socketio, 'emit', emit)
+    monkeypatch.setattr(server, 'MAX_NO_FACE_FRAMES', 1)
+    state = server.FaceDetectionState('locked')
+    server.session_states['locked'] = state
+    server.on_frame_processed('locked', no_face_result(), None, attempt=state.attempt)
+    assert state.recognition_failed
+    assert events == ['recognition_status', 'recognition_complete']
+    server.session_states.pop('locked')
@@ -0,0 +1,131 @@
+import threading
+
+import pytest
+
+from session_store import EVICTED, EXPIRED, RedisSessionStore, SessionStore
+
+
+class FakeClock:
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self):
+        return self.now
+
+
+def test_expire_removes_only_idle_sessions():
+    clock = FakeClock()
+    removed = []
+    store = SessionStore(10, shards=4, clock=clock, on_evict=lambda sid, state, reason: removed.append((sid, reason)))
+    store['a'] = 'A'
+    clock.now = 5
+    store['b'] = 'B'
+    clock.now = 12
+    assert store.expire() == 1
+    assert 'a' not in store and store.get('b') == 'B'
+    assert removed == [('a', EXPIRED)]
+
+
+def test_get_renews_activity():
+    clock = FakeClock()
+    store = SessionStore(10, shards=1, clock=clock)
+    store['a'] = 'A'
+    clock.now = 8
+    store.get('a')
+    clock.now = 15
+    assert store.expire() == 0
+    assert store.peek('a') == 'A'
+
+
+def test_cap_evicts_least_recently_used():
+    clock = FakeClock()
+    removed = []
+    store = SessionStore(100, max_sessions=2, shards=4, clock=clock,
+                         on_evict=lambda sid, state, reason: removed.append((sid, reason)))
+    for i, sid in enumerate(['a', 'b']):
+        clock.now = i
+        store[sid] = sid.upper()
+    clock.now = 2
+    store.get('a')
+    clock.now = 3
+    store['c'] = 'C'
+    assert removed == [('b', EVICTED)]
+    assert sorted(sid for sid, _ in store.items()) == ['a', 'c']
+    assert store.stats()["evicted"] == 1
+
+
+def test_pop_does_not_notify():
+    removed = []
+    store = SessionStore(10, on_evict=lambda *args: removed.append(args))
+    store['a'] = 'A'
+    assert store.pop('a') == 'A'
+    assert store.pop('a', 'gone') == 'gone'
+    assert removed == []
+
+
+@pytest.fixture
+def redis_store():
+    fakeredis = pytest.importorskip('fakeredis')
+    client = fakeredis.FakeRedis()
+    return RedisSessionStore(client, 60, dumps=dict, loads=lambda sid, data: data, lock_timeout=5), client
+
+
+def test_redis_round_trip_and_ttl(redis_store):
+    store, client = redis_store
+    store['a'] = {'count': 1}
+    assert 'a' in store and len(store) == 1
+    assert store['a'] == {'count': 1}
+    assert 0 < client.pttl('face_app:session:a') <= 60000
+    assert store.items() == [('a', {'count': 1})]
+    assert store.pop('a') == {'count': 1}
+    assert store.get('a') is None
+
+
+def test_redis_transaction_saves_changes(redis_store):
+    store, client = redis_store
+    store['a'] = {'count': 0}
+    with store.transaction('a') as state:
+        state['count'] += 1
+    assert store.get('a') == {'count': 1}
+    assert client.keys('face_app:lock:*') == [] # Released
+
+
+def test_redis_transaction_does_not_resurrect_popped_session(redis_store):
+    store, _ = redis_store
+    store['a'] = {'count': 0}
+    with store.transaction('a') as state:
+        store.pop('a')
+        state['count'] += 1
+    assert store.get('a') is None
+    with store.transaction('missing') as state:
+        assert state is None
+
+
+def test_redis_transactions_serialize_concurrent_updates(redis_store):
+    # Two "nodes" sharing one Redis: without the lock, read-modify-writes would lose updates
+    store, client = redis_store
+    other = RedisSessionStore(client, 60, dumps=dict, loads=lambda sid, data: data, lock_timeout=5)
+    store['a'] = {'count': 0}
+
+    def work(node):
+        for _ in range(25):
+            with node.transaction('a') as state:
+                state['count'] += 1
+
+    threads = [threading.Thread(target=work, args=(node,)) for node in (store, other, store, other)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert store.get('a') == {'count': 100}
+
+
+def test_redis_lock_times_out_while_held_elsewhere(redis_store):
+    store, client = redis_store
+    store.lock_timeout = 0.05
+    client.set('face_app:lock:a', 'someone-else')
+    store['a'] = {'count': 0}
+    with pytest.raises(TimeoutError):
+        with store.transaction('a'):
+            pass
+    assert client.get('face_app:lock:a') == b'someone-else' # Not released by a non-holder
@@ -53,6 +53,37 @@ class FaceRecognitionService {
     }
   }
 
+  // Upload enrolment: photos taken on the device are encoded on the server's workers.
+  // The reply carries a job id; its progress is at /enroll/<job_id> (or via the
+  // 'watch_enrollment' socket event) and the face is usable as soon as it completes.
+  async enrollFace(name, photoUris) {
+    try {
+      const form = new FormData();
+      form.append('name', name);
+      photoUris.forEach((uri, index) => {
+        form.append('images', { uri, name: `photo-${index}.jpg`, type: 'image/jpeg' });
+      });
+      const response = await fetch(`${this.baseUrl}/enroll`, { method: 'POST', body: form });
+      return await response.json();
+    } catch (error) {
+      console.error('Error uploading enrolment photos:', error);
+      return {
+        success: false,
+        message: 'Failed to connect to face recognition service',
+      };
+    }
+  }
+
+  async getEnrollmentStatus(jobId) {
+    try {
+      const response = await fetch(`${this.baseUrl}/enroll/${jobId}`);
+      return await response.json();
+    } catch (error) {
+      console.error('Error fetching enrolment status:', error);
+      return { success: false, message: 'Failed to connect to face recognition service' };
+    }
+  }
+
   // recognizeFace (HTTP POST) is no longer used for streaming,
   // it's replaced by emitting 'image_stream' via socket.
   // Keeping it as a placeholder if you need it for single image POST elsewhere.